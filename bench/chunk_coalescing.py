@@ -0,0 +1,48 @@
+# Measures what chunk_coalesce_size saves when a chunked body is streamed as
+# lots of tiny Data events, like a template renderer yielding small strings:
+# bytes on the wire, and the number of socket writes (one per non-empty
+# result from Connection.send, which is what a typical server loop does).
+#
+# Run from the top of the source tree:
+#
+#   PYTHONPATH=. python bench/chunk_coalescing.py
+
+import random
+import time
+
+import h11
+
+def make_pieces(count):
+    rng = random.Random(0)
+    return [b"x" * rng.randrange(5, 60) for _ in range(count)]
+
+def stream(pieces, coalesce_size):
+    conn = h11.Connection(h11.SERVER, chunk_coalesce_size=coalesce_size)
+    conn.receive_data(b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    writes = 0
+    wire = 0
+    events = [h11.Response(status_code=200, headers=[])]
+    events += [h11.Data(data=piece) for piece in pieces]
+    events.append(h11.EndOfMessage())
+    for event in events:
+        data = conn.send(event)
+        if data:
+            writes += 1
+            wire += len(data)
+    return writes, wire
+
+def main():
+    pieces = make_pieces(100000)
+    payload = sum(len(piece) for piece in pieces)
+    print("{} pieces, {} bytes of payload".format(len(pieces), payload))
+    for coalesce_size in [None, 512, 4096, 16384]:
+        start = time.perf_counter()
+        writes, wire = stream(pieces, coalesce_size)
+        elapsed = time.perf_counter() - start
+        print("chunk_coalesce_size={!s:>5}: {:6} writes, {:8} bytes on the "
+              "wire ({:4.1f}% overhead), {:.2f} s".format(
+                  coalesce_size, writes, wire,
+                  100 * (wire - payload) / payload, elapsed))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Measures how fast a Connection with decode_content=True can decode a large
+# gzip or deflate body, for small and large max_decoded_data_size, against a
+# single zlib.decompress call on the whole body.
+#
+# Run from the top of the source tree:
+#
+#   PYTHONPATH=. python bench/content_decoding.py [megabytes]
+
+import gzip
+import random
+import sys
+import time
+import zlib
+
+import h11
+
+RECV_SIZE = 65536
+
+def make_body(size):
+    # Random words from a small vocabulary, which compresses about as well
+    # as typical text or JSON.
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz")
+                   for _ in range(rng.randrange(2, 10)))
+             for _ in range(2000)]
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(words) for _ in range(1000)) + b"\n"
+    return bytes(out[:size])
+
+def receive(coding, compressed, size, max_data_size):
+    conn = h11.Connection(h11.CLIENT, decode_content=True,
+                          max_decoded_data_size=max_data_size,
+                          max_decompression_ratio=None)
+    conn.send(h11.Request(method="GET", target="/",
+                          headers=[("Host", "example.com")]))
+    conn.send(h11.EndOfMessage())
+    head = ("HTTP/1.1 200 OK\r\nContent-Encoding: {}\r\n"
+            "Content-Length: {}\r\n\r\n"
+            .format(coding, len(compressed)).encode("ascii"))
+    received = 0
+    start = time.perf_counter()
+    conn.receive_data(head)
+    for i in range(0, len(compressed), RECV_SIZE):
+        for event in conn.receive_data(compressed[i:i + RECV_SIZE]):
+            if type(event) is h11.Data:
+                received += len(event.data)
+    elapsed = time.perf_counter() - start
+    assert received == size
+    return elapsed
+
+def one_shot(compressed):
+    start = time.perf_counter()
+    # 32 + MAX_WBITS auto-detects the gzip or zlib header
+    zlib.decompress(compressed, 32 + zlib.MAX_WBITS)
+    return time.perf_counter() - start
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    size = megabytes * 2**20
+    body = make_body(size)
+    print("{} MiB body".format(megabytes))
+    for coding, compressed in [("gzip", gzip.compress(body)),
+                               ("deflate", zlib.compress(body))]:
+        print("{}: {} bytes compressed".format(coding, len(compressed)))
+        elapsed = min(one_shot(compressed) for _ in range(3))
+        print("  {:>26}: {:6.3f} s  {:6.0f} MiB/s".format(
+            "zlib.decompress", elapsed, megabytes / elapsed))
+        for max_data_size in [16 * 1024, 64 * 1024, 256 * 1024, 4 * 2**20]:
+            elapsed = min(receive(coding, compressed, size, max_data_size)
+                          for _ in range(3))
+            print("  {:>26}: {:6.3f} s  {:6.0f} MiB/s".format(
+                "max_data_size={}".format(max_data_size), elapsed,
+                megabytes / elapsed))
+
+if __name__ == "__main__":
+    main()
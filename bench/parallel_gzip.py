@@ -0,0 +1,64 @@
+# Measures how parallel_gzip's throughput scales with the number of worker
+# threads, compared to a single streaming gzip compressor.
+#
+# Run from the top of the source tree:
+#
+#   PYTHONPATH=. python bench/parallel_gzip.py [megabytes]
+#
+# The speedup you see is capped by the number of cores on the machine.
+
+import random
+import sys
+import time
+import zlib
+
+from h11._compression import parallel_gzip, _cpu_count
+
+def make_body(size):
+    # Something that compresses about as well as typical text or JSON:
+    # random words from a small vocabulary.
+    rng = random.Random(0)
+    words = [bytes(rng.choice(b"abcdefghijklmnopqrstuvwxyz")
+                   for _ in range(rng.randrange(2, 10)))
+             for _ in range(2000)]
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rng.choice(words) for _ in range(1000)) + b"\n"
+    return bytes(out[:size])
+
+def chunks(body, size=65536):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+def best_of(n, fn):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    body = make_body(megabytes * 2**20)
+    print("{} MiB body, {} CPUs".format(megabytes, _cpu_count()))
+
+    def single():
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks(body):
+            c.compress(chunk)
+        c.flush()
+    base = best_of(3, single)
+    print("{:>12}: {:6.2f} s  {:7.1f} MiB/s".format(
+        "zlib", base, megabytes / base))
+
+    workers = 1
+    while workers <= max(_cpu_count(), 1) * 2:
+        elapsed = best_of(3, lambda: sum(
+            1 for _ in parallel_gzip(chunks(body), workers=workers)))
+        print("{:>3} workers: {:6.2f} s  {:7.1f} MiB/s  ({:.2f}x)".format(
+            workers, elapsed, megabytes / elapsed, base / elapsed))
+        workers *= 2
+
+if __name__ == "__main__":
+    main()
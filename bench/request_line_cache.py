@@ -0,0 +1,73 @@
+# Measures the process-wide request line cache on a workload where request
+# targets follow a Zipf distribution -- a few hot endpoints and a long tail --
+# comparing several cache sizes against the cache being disabled.
+#
+# Run from the top of the source tree:
+#
+#   PYTHONPATH=. python bench/request_line_cache.py
+
+import bisect
+import itertools
+import random
+import time
+
+import h11
+from h11 import request_line_cache
+
+TARGETS = 1000
+REQUESTS = 50000
+ZIPF_S = 1.1
+
+def make_requests():
+    rng = random.Random(0)
+    targets = ["/api/v1/items/{}?fields=name,price".format(i)
+               for i in range(TARGETS)]
+    weights = list(itertools.accumulate(
+        1 / (rank + 1) ** ZIPF_S for rank in range(TARGETS)))
+    requests = []
+    for _ in range(REQUESTS):
+        target = targets[bisect.bisect(weights, rng.random() * weights[-1])]
+        requests.append("GET {} HTTP/1.1\r\nHost: example.com\r\n\r\n"
+                        .format(target).encode("ascii"))
+    return requests
+
+def keep_alive_cycle(requests):
+    conn = h11.Connection(h11.SERVER)
+    response = h11.Response(status_code=200,
+                            headers=[("Content-Length", "0")])
+    start = time.perf_counter()
+    for request in requests:
+        conn.receive_data(request)
+        conn.send(response)
+        conn.send(h11.EndOfMessage())
+        conn.prepare_to_reuse()
+    return time.perf_counter() - start
+
+def parse_only(lines):
+    start = time.perf_counter()
+    for line in lines:
+        request_line_cache.parse(line)
+    return time.perf_counter() - start
+
+def main():
+    requests = make_requests()
+    lines = [request.split(b"\r\n", 1)[0] for request in requests]
+    print("{} requests over {} targets, Zipf s={}".format(
+        REQUESTS, TARGETS, ZIPF_S))
+    old_maxsize = request_line_cache.maxsize
+    try:
+        for maxsize in [0, 128, 512, 4096]:
+            request_line_cache.maxsize = maxsize
+            full = min(keep_alive_cycle(requests) for _ in range(3))
+            request_line_cache.maxsize = maxsize
+            parse = parse_only(lines)
+            hits, misses = request_line_cache.hits, request_line_cache.misses
+            rate = "{:.0%}".format(hits / (hits + misses)) if maxsize else "-"
+            print("maxsize={:<5} parse {:5.1f} ms  hit rate {:>4}  "
+                  "full cycle {:.2f} s".format(
+                      maxsize, parse * 1000, rate, full))
+    finally:
+        request_line_cache.maxsize = old_maxsize
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Serves a large file over loopback TCP with h11, once by reading it into memory
+# and sending Data events of bytes, and once by sending a FileSegment with
+# os.sendfile, and compares the throughput.
+#
+# Run from the top of the source tree:
+#
+#   PYTHONPATH=. python bench/sendfile.py [megabytes]
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import h11
+
+READ_SIZE = 256 * 1024
+
+def drain(sock, results):
+    # A minimal client: reads until the server closes the connection.
+    total = 0
+    buf = bytearray(1024 * 1024)
+    while True:
+        got = sock.recv_into(buf)
+        if not got:
+            break
+        total += got
+    results.append(total)
+
+def send_all(sock, data_list):
+    for data in data_list:
+        if isinstance(data, h11.FileSegment):
+            offset, count = data.offset, data.count
+            while count:
+                sent = os.sendfile(sock.fileno(), data.fd, offset, count)
+                offset += sent
+                count -= sent
+        else:
+            sock.sendall(data)
+
+def tcp_pair():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client_sock = socket.create_connection(listener.getsockname())
+    server_sock, _ = listener.accept()
+    listener.close()
+    return server_sock, client_sock
+
+def serve(f, size, use_sendfile):
+    server_sock, client_sock = tcp_pair()
+    results = []
+    client = threading.Thread(target=drain, args=(client_sock, results))
+    client.start()
+    start = time.perf_counter()
+
+    conn = h11.Connection(h11.SERVER)
+    conn.receive_data(b"GET / HTTP/1.1\r\nHost: example.com\r\n\r\n")
+    send_all(server_sock, conn.send_with_data_passthrough(
+        h11.Response(status_code=200,
+                     headers=[("Content-Length", str(size))])))
+    if use_sendfile:
+        send_all(server_sock, conn.send_with_data_passthrough(
+            h11.Data(data=h11.FileSegment(f, 0, size))))
+    else:
+        f.seek(0)
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            send_all(server_sock, conn.send_with_data_passthrough(
+                h11.Data(data=block)))
+    send_all(server_sock, conn.send_with_data_passthrough(h11.EndOfMessage()))
+    server_sock.close()
+
+    client.join()
+    elapsed = time.perf_counter() - start
+    client_sock.close()
+    assert results[0] > size
+    return elapsed
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    size = megabytes * 2**20
+    with tempfile.TemporaryFile() as f:
+        block = os.urandom(2**20)
+        for _ in range(megabytes):
+            f.write(block)
+        f.flush()
+        print("{} MiB file".format(megabytes))
+        for name, use_sendfile in [("read + sendall", False),
+                                   ("FileSegment + os.sendfile", True)]:
+            elapsed = min(serve(f, size, use_sendfile) for _ in range(3))
+            print("{:>26}: {:6.3f} s  {:7.0f} MiB/s".format(
+                name, elapsed, megabytes / elapsed))
+
+if __name__ == "__main__":
+    main()
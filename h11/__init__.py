@@ -10,11 +10,23 @@ from ._version import __version__
 PRODUCT_ID = "h11/" + __version__
 
 from ._util import ProtocolError
+from ._headers import Headers
+from ._compression import parallel_gzip
+from ._readers import RequestLineCache, request_line_cache
 from ._events import *
 from ._connection import *
 from ._state import *
+from ._sendfile import *
+from ._multipart import *
+from ._assembler import *
 
-__all__ = ["ProtocolError"]
+__all__ = [
+    "ProtocolError", "Headers", "parallel_gzip", "RequestLineCache",
+    "request_line_cache",
+]
 __all__ += _events.__all__
 __all__ += _connection.__all__
 __all__ += _state.__all__
+__all__ += _sendfile.__all__
+__all__ += _multipart.__all__
+__all__ += _assembler.__all__
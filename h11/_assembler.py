@@ -0,0 +1,281 @@
+# Helper for collecting a complete message -- head, body, and trailers -- out
+# of the stream of events that a Connection produces.
+#
+# This is for handlers that just want the whole body in memory. The point of
+# having a helper, rather than letting everyone write "body += event.data", is
+# that when the message has a Content-Length we know exactly how big the body
+# will be before any of it arrives, so we can allocate a single buffer of the
+# right size up front and copy each Data event straight into place. That
+# avoids both the quadratic behavior of repeated bytes concatenation and the
+# doubled peak memory of b"".join.
+#
+# For bodies that might be too big to want in memory at all, the body can
+# instead be spooled: kept in memory up to a threshold, and written out to a
+# temporary file after that (like tempfile.SpooledTemporaryFile, except that
+# knowing the Content-Length lets us skip the in-memory stage entirely when we
+# can already see that it's going to overflow).
+
+import mmap
+import tempfile
+
+from ._util import ProtocolError
+from ._events import *
+from ._headers import get_comma_header
+from ._connection import _body_framing
+
+__all__ = ["MessageAssembler", "SpooledBody"]
+
+class SpooledBody:
+    """A message body collected by a :class:`MessageAssembler` with
+    spooling enabled. It's kept in memory if it's no larger than the
+    assembler's *spool_threshold*, and in an anonymous temporary file
+    otherwise.
+
+    .. attribute:: file
+
+       If the body was spooled to disk, then the temporary file containing
+       it, positioned at the start. Otherwise, ``None``.
+
+    The temporary file is deleted when the :class:`SpooledBody` is closed.
+    It can also be used as a context manager, which closes it on exit.
+
+    """
+    def __init__(self, length=None, *, spool_threshold=None, dir=None):
+        self._spool_threshold = spool_threshold
+        self._dir = dir
+        self._length = 0
+        self._memory = bytearray()
+        self._view = None
+        self.file = None
+        self._mmap = None
+        self._mmap_view = None
+        if length is not None:
+            if self._overflows(length):
+                self._roll_over()
+            else:
+                # Exact size known: preallocate, and fill through a
+                # memoryview.
+                self._memory = bytearray(length)
+                self._view = memoryview(self._memory)
+
+    def _overflows(self, size):
+        return (self._spool_threshold is not None
+                and size > self._spool_threshold)
+
+    def _roll_over(self):
+        self.file = tempfile.TemporaryFile(dir=self._dir)
+        self.file.write(self._memory)
+        self._memory = None
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def rolled_over(self):
+        """True if the body was spooled to disk."""
+        return self.file is not None
+
+    def write(self, data):
+        start = self._length
+        self._length += len(data)
+        if self._view is not None:
+            # Preallocated at the declared Content-Length, which the body
+            # readers never let us go past.
+            self._view[start:self._length] = data
+            return
+        if self.file is None and self._overflows(self._length):
+            self._roll_over()
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self._memory += data
+
+    # Called when the body is complete.
+    def _finish(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self.file is not None:
+            self.file.flush()
+            self.file.seek(0)
+
+    def read(self):
+        """Returns the complete body as :class:`bytes`. If it was spooled to
+        disk, this reads the whole thing back into memory.
+
+        """
+        if self.file is None:
+            return bytes(self._memory)
+        self.file.seek(0)
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+    def getbuffer(self):
+        """Returns a :class:`memoryview` of the complete body.
+
+        If the body was spooled to disk, then this is a read-only view backed
+        by a memory map of the temporary file, so you can treat it like an
+        in-memory buffer without actually reading the file into memory. The
+        view stays valid until the :class:`SpooledBody` is closed.
+
+        """
+        if self.file is None:
+            return memoryview(self._memory)
+        if self._mmap_view is None:
+            if self._length == 0:
+                # Empty files can't be mapped
+                self._mmap_view = memoryview(b"")
+            else:
+                self._mmap = mmap.mmap(self.file.fileno(), self._length,
+                                       access=mmap.ACCESS_READ)
+                self._mmap_view = memoryview(self._mmap)
+        return self._mmap_view
+
+    def close(self):
+        """Release the memory map (if any) and delete the temporary file (if
+        any).
+
+        """
+        if self._mmap_view is not None:
+            self._mmap_view.release()
+            self._mmap_view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MessageAssembler:
+    """Collects the events for a complete message into a head, body, and
+    trailers.
+
+    Args:
+        conn (Connection): The connection whose incoming messages we're
+            assembling. This is used to work out how the body is framed.
+
+        max_body_size (int or None): The largest body we're willing to
+            buffer. If the message declares a larger ``Content-Length``, then
+            :exc:`ProtocolError` is raised as soon as the head arrives,
+            before any of the body is buffered; if the body has no declared
+            length, then it's raised as soon as the total exceeds the limit.
+            Either way, the error's ``error_status_hint`` is 413 (Payload Too
+            Large). ``None`` (the default) means no limit.
+
+        spool_threshold (int or None): If given, then bodies larger than
+            this many bytes are written to a temporary file instead of being
+            kept in memory, and :attr:`body` is a :class:`SpooledBody`.
+
+        spool_dir (str or None): Where to create those temporary files; the
+            default is chosen by :mod:`tempfile`.
+
+    Once :meth:`receive_event` returns True, the complete message is
+    available as the following attributes, until the next :class:`Request`
+    or :class:`Response` starts a new one:
+
+    .. attribute:: head
+
+       The :class:`Request` or :class:`Response` that began the message.
+
+    .. attribute:: body
+
+       A :class:`bytearray` containing the complete body -- or, if
+       *spool_threshold* was given, a :class:`SpooledBody`.
+
+    .. attribute:: trailers
+
+       The trailing headers from the :class:`EndOfMessage` (usually empty).
+
+    """
+    def __init__(self, conn, *, max_body_size=None, spool_threshold=None,
+                 spool_dir=None):
+        self._conn = conn
+        self._max_body_size = max_body_size
+        self._spool_threshold = spool_threshold
+        self._spool_dir = spool_dir
+        self._reset()
+
+    def _reset(self):
+        self.head = None
+        self.body = None
+        self.trailers = None
+        self._buffer = None
+        self._declared_length = None
+
+    def receive_event(self, event):
+        """Feed in the next event from :meth:`Connection.receive_data`.
+
+        Returns:
+            True if *event* completed a message, and False otherwise. Events
+            that aren't part of a message -- :class:`InformationalResponse`,
+            :class:`Paused`, :class:`ConnectionClosed` -- are ignored.
+
+        """
+        if type(event) in (Request, Response):
+            self._reset()
+            self.head = event
+            self._start_body(self._expected_length(event))
+        elif type(event) is Data:
+            if self.head is None:
+                raise RuntimeError("got Data before Request or Response")
+            self._add_data(event.data)
+        elif type(event) is EndOfMessage:
+            if self.head is None:
+                raise RuntimeError(
+                    "got EndOfMessage before Request or Response")
+            self.body = self._finish_body()
+            self.trailers = event.headers
+            return True
+        return False
+
+    # Returns the body's length if we know it in advance, or else None.
+    def _expected_length(self, event):
+        framing_type, args = _body_framing(self._conn.request_method, event)
+        if framing_type != "content-length":
+            return None
+        # If the Connection is decoding the body, then Content-Length
+        # describes the compressed body, not what we'll actually receive.
+        if get_comma_header(event.headers, "Content-Encoding"):
+            return None
+        (length,) = args
+        return length
+
+    def _check_size(self, size):
+        if self._max_body_size is not None and size > self._max_body_size:
+            raise ProtocolError("message body too large",
+                                error_status_hint=413)
+
+    def _start_body(self, length):
+        if length is not None:
+            self._check_size(length)
+        self._declared_length = length
+        self._buffer = SpooledBody(length,
+                                   spool_threshold=self._spool_threshold,
+                                   dir=self._spool_dir)
+
+    def _add_data(self, data):
+        if self._declared_length is None:
+            self._check_size(len(self._buffer) + len(data))
+        self._buffer.write(data)
+
+    def _finish_body(self):
+        # The body readers make sure a Content-Length body is all there, so
+        # this only happens if the Connection was told not to give us all of
+        # it -- and then we'd be handing back a buffer with a hole in it.
+        if (self._declared_length is not None
+              and len(self._buffer) != self._declared_length):
+            raise RuntimeError(
+                "got {} of {} body bytes; was the body discarded or passed "
+                "through raw?".format(len(self._buffer),
+                                      self._declared_length))
+        self._buffer._finish()
+        if self._spool_threshold is None:
+            return self._buffer._memory
+        return self._buffer
@@ -0,0 +1,319 @@
+# Support for gzip and deflate content codings (the Content-Encoding header).
+#
+# Strictly speaking, content codings are a property of the representation
+# (RFC 7231), not of the message framing (RFC 7230), so they're a bit outside
+# h11's usual territory. But undoing them is mechanical, almost everyone needs
+# it, and it's easy to get wrong in ways that matter (unbounded memory use on
+# decompression bombs, in particular), so we provide an opt-in implementation.
+#
+# On the receive side, the decoder wraps one of the regular body readers from
+# _readers.py: it pulls Data events out of the wrapped reader, and returns
+# Data events containing decompressed bytes instead. Each output event is
+# capped at max_data_size bytes, using the max_length argument to
+# decompressobj.decompress(), so we never inflate more than one event's worth
+# at a time no matter how much compressed data arrived.
+#
+# On the send side, the encoder wraps one of the regular body writers from
+# _writers.py: Data payloads are run through a gzip compressor, and whatever
+# compressed bytes come out are passed on to the wrapped writer (which is
+# normally a ChunkedWriter, since we can't know the compressed length ahead of
+# time).
+
+import multiprocessing
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ._util import ProtocolError
+from ._events import Data, EndOfMessage
+from ._headers import get_comma_header
+from ._writers import BodyWriter
+
+__all__ = [
+    "decoding_reader", "ContentEncodingWriter", "accepts_gzip",
+    "parallel_gzip",
+]
+
+# wbits values for zlib.decompressobj
+_DECODERS = {
+    b"gzip": 16 + zlib.MAX_WBITS,
+    b"x-gzip": 16 + zlib.MAX_WBITS,
+    b"deflate": zlib.MAX_WBITS,
+}
+
+class ContentDecodingReader:
+    def __init__(self, reader, coding, max_data_size, max_ratio):
+        self._reader = reader
+        self._wbits = _DECODERS[coding]
+        self._decompressor = zlib.decompressobj(self._wbits)
+        self._max_data_size = max_data_size
+        self._max_ratio = max_ratio
+        # Compressed bytes that we haven't managed to feed through zlib yet,
+        # either because of max_length or because they belong to the next
+        # member of a multi-member gzip stream.
+        self._input = b""
+        self._bytes_in = 0
+        self._bytes_out = 0
+        # Once the wrapped reader has given us its EndOfMessage, we hold onto
+        # it here while we drain our remaining output.
+        self._eom = None
+        if hasattr(reader, "read_eof"):
+            self.read_eof = self._read_eof
+
+    # Returns at most max_data_size bytes of output, or b"" if we need more
+    # input.
+    def _decompress(self):
+        while self._input:
+            if self._decompressor.eof:
+                if self._wbits == zlib.MAX_WBITS:
+                    raise ProtocolError("trailing garbage after deflate data")
+                # Multi-member gzip streams are legal; start the next member.
+                self._decompressor = zlib.decompressobj(self._wbits)
+            decompressor = self._decompressor
+            try:
+                out = decompressor.decompress(
+                    self._input, self._max_data_size)
+            except zlib.error as exc:
+                raise ProtocolError(
+                    "invalid compressed body: {}".format(exc))
+            if decompressor.eof:
+                self._input = decompressor.unused_data
+            else:
+                self._input = decompressor.unconsumed_tail
+            if out:
+                self._bytes_out += len(out)
+                if (self._max_ratio is not None
+                    and self._bytes_out > self._max_ratio * self._bytes_in):
+                    raise ProtocolError(
+                        "decompressed body exceeds maximum compression ratio",
+                        error_status_hint=413)
+                return out
+        return b""
+
+    def _finish(self):
+        out = self._decompress()
+        if out:
+            return Data(data=out)
+        if self._bytes_in and not self._decompressor.eof:
+            raise ProtocolError("compressed body was truncated")
+        return self._eom
+
+    # When discarding (see Connection.discard_incoming_body), there's no
+    # point in decompressing anything: we let the wrapped reader skip over
+    # the compressed data, and just pass along its EndOfMessage.
+    @property
+    def discarding(self):
+        return self._reader.discarding
+
+    @discarding.setter
+    def discarding(self, value):
+        self._reader.discarding = value
+
+    # Counted in compressed bytes, since that's what's on the wire.
+    @property
+    def bytes_needed(self):
+        return getattr(self._reader, "bytes_needed", None)
+
+    def __call__(self, buf):
+        if self.discarding:
+            if self._eom is None:
+                return self._reader(buf)
+            return self._eom
+        if self._eom is not None:
+            return self._finish()
+        while True:
+            out = self._decompress()
+            if out:
+                return Data(data=out)
+            event = self._reader(buf)
+            if event is None:
+                return None
+            if type(event) is EndOfMessage:
+                self._eom = event
+                return self._finish()
+            assert type(event) is Data
+            self._bytes_in += len(event.data)
+            self._input = event.data
+
+    def _read_eof(self):
+        if self.discarding:
+            return self._eom or self._reader.read_eof()
+        if self._eom is None:
+            self._eom = self._reader.read_eof()
+        return self._finish()
+
+
+def decoding_reader(reader, headers, max_data_size, max_ratio):
+    # Returns a reader that decodes the body described by headers, or the
+    # original reader if there's nothing we know how to decode.
+    codings = get_comma_header(headers, "Content-Encoding")
+    if len(codings) == 1 and codings[0] in _DECODERS:
+        return ContentDecodingReader(
+            reader, codings[0], max_data_size, max_ratio)
+    return reader
+
+
+# Parses an Accept-Encoding header, e.g.
+#
+#   Accept-Encoding: gzip;q=1.0, identity; q=0.5, *;q=0
+#
+# See https://tools.ietf.org/html/rfc7231#section-5.3.4
+def accepts_gzip(headers):
+    qvalues = {}
+    for item in get_comma_header(headers, "Accept-Encoding"):
+        coding, _, params = item.partition(b";")
+        qvalue = 1.0
+        for param in params.split(b";"):
+            name, _, value = param.partition(b"=")
+            if name.strip() == b"q":
+                try:
+                    qvalue = float(value.strip())
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding.strip()] = qvalue
+    for coding in (b"gzip", b"x-gzip"):
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return qvalues.get(b"*", 0) > 0
+
+
+class ContentEncodingWriter(BodyWriter):
+    def __init__(self, writer, level, sync_flush):
+        self._writer = writer
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self._sync_flush = sync_flush
+
+    def _send_compressed(self, data, write):
+        # Never pass along an empty payload: to a ChunkedWriter, that would
+        # look like the end of the body.
+        if data:
+            self._writer.send_data(data, write)
+
+    def send_data(self, data, write):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            raise TypeError(
+                "can't compress {!r}; only bytes-like data can be sent with "
+                "Content-Encoding: gzip".format(data))
+        out = self._compressor.compress(data)
+        if self._sync_flush:
+            out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._send_compressed(out, write)
+
+    def flush(self, write):
+        self._send_compressed(
+            self._compressor.flush(zlib.Z_SYNC_FLUSH), write)
+        flush = getattr(self._writer, "flush", None)
+        if flush is not None:
+            flush(write)
+
+    def send_eom(self, headers, write):
+        self._send_compressed(self._compressor.flush(), write)
+        self._writer.send_eom(headers, write)
+
+
+# Parallel compression, in the style of pigz.
+#
+# zlib releases the GIL while compressing, so we can use threads to compress
+# several blocks at once. The trick that makes this produce a single valid
+# gzip stream is that raw deflate streams can be concatenated, so long as
+# every stream except the last ends on a byte boundary without setting the
+# "final block" bit -- which is exactly what Z_SYNC_FLUSH does. Each block is
+# compressed independently, but primed with the last 32 KiB of the previous
+# block as a preset dictionary (zdict), so back-references can still reach
+# across block boundaries and we lose almost nothing in compression ratio.
+# The only sequential work is the CRC32, which is cheap.
+
+PARALLEL_GZIP_BLOCK_SIZE = 128 * 1024
+_DEFLATE_WINDOW = 32 * 1024
+
+# 10-byte gzip header: magic, CM=deflate, no flags, no mtime, no extra flags,
+# OS=unknown
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+def _deflate_block(block, dictionary, level):
+    if dictionary:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def _blocks(chunks, block_size):
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        while len(pending) >= block_size:
+            yield bytes(pending[:block_size])
+            del pending[:block_size]
+    if pending:
+        yield bytes(pending)
+
+# os.cpu_count is new in Python 3.4
+def _cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def parallel_gzip(chunks, executor=None, level=6,
+                  block_size=PARALLEL_GZIP_BLOCK_SIZE, max_pending=None,
+                  workers=None):
+    """Gzip-compress a large body using multiple threads.
+
+    Takes an iterable of :term:`bytes-like objects <bytes-like object>`, and
+    returns an iterator of byte-strings which, concatenated, form a single
+    gzip stream. The input is split into *block_size* blocks, which are
+    compressed concurrently on *executor*, and the results are yielded in
+    order as they become available. This lets a single large body use more
+    than one CPU core.
+
+    The output is meant to be sent as the body of a message with
+    ``Content-Encoding: gzip``, one :class:`Data` event per item. See
+    :ref:`content-coding`.
+
+    Args:
+        chunks: An iterable of :term:`bytes-like objects <bytes-like
+            object>` containing the uncompressed body.
+        executor (concurrent.futures.Executor): Where to run the
+            compression. Should be a thread pool. If None, a
+            :class:`~concurrent.futures.ThreadPoolExecutor` with *workers*
+            threads is created for the duration of the compression.
+        level (int): The zlib compression level, from 1 to 9.
+        block_size (int): How much uncompressed data to put in each
+            independently compressed block.
+        max_pending (int): The maximum number of blocks to have in flight at
+            once, which bounds memory use. Defaults to twice *workers*.
+        workers (int): How many threads to compress with -- or, if you
+            pass an *executor*, how many it has. Defaults to the number of
+            CPUs.
+
+    """
+    if workers is None:
+        workers = _cpu_count()
+    if max_pending is None:
+        max_pending = 2 * workers
+    if executor is None:
+        with ThreadPoolExecutor(workers) as executor:
+            yield from parallel_gzip(
+                chunks, executor, level, block_size, max_pending, workers)
+        return
+    crc = 0
+    size = 0
+    dictionary = b""
+    pending = deque()
+    yield _GZIP_HEADER
+    for block in _blocks(chunks, block_size):
+        crc = zlib.crc32(block, crc)
+        size += len(block)
+        pending.append(
+            executor.submit(_deflate_block, block, dictionary, level))
+        dictionary = block[-_DEFLATE_WINDOW:]
+        while len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+    # An empty final block, to terminate the deflate stream
+    yield (zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+           + struct.pack("<II", crc & 0xffffffff, size & 0xffffffff))
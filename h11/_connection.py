@@ -1,23 +1,40 @@
 # This contains the main Connection class. Everything in h11 revolves around
 # this.
 
+import time
+from collections import deque
+
 # Import all event types
 from ._events import *
 # Import all state sentinels
 from ._state import *
 # Import the internal things we need
-from ._util import ProtocolError
+from ._util import ProtocolError, Sentinel
 from ._state import ConnectionState, _SWITCH_UPGRADE, _SWITCH_CONNECT
 from ._headers import (
     get_comma_header, set_comma_header, has_expect_100_continue,
+    get_date_header_value,
 )
 from ._receivebuffer import ReceiveBuffer
-from ._readers import READERS
+from ._readers import READERS, configured_readers
 from ._writers import WRITERS
+from ._compression import (
+    decoding_reader, ContentEncodingWriter, accepts_gzip,
+)
 
 # Everything in __all__ gets re-exported as part of the h11 public API.
 __all__ = ["Connection"]
 
+# Values returned by Connection.next_action. It can also return MUST_CLOSE,
+# SWITCHED_PROTOCOL, or ERROR, which are the state sentinels of the same
+# names.
+_actions = ("NEED_DATA RECEIVE_BUFFERED NEED_TO_SEND SEND_100_CONTINUE "
+            "PAUSED").split()
+for token in _actions:
+    globals()[token] = Sentinel(token)
+
+__all__ += _actions
+
 # If we ever have this much buffered without it making a complete parseable
 # event, we error out. The only time we really buffer is when reading the
 # request/reponse line + headers together, so this is effectively the limit on
@@ -30,6 +47,20 @@ __all__ = ["Connection"]
 # - Apache: <8 KiB per line>
 HTTP_DEFAULT_MAX_BUFFER_SIZE = 16 * 1024
 
+# When decoding compressed bodies, this is the most decompressed data we'll
+# return in a single Data event.
+DEFAULT_MAX_DECODED_DATA_SIZE = 64 * 1024
+
+# ...and if the decompressed body is ever more than this many times bigger
+# than the compressed data we've received so far, we assume it's a
+# decompression bomb and give up. Real-world content rarely gets past ~20x;
+# the theoretical limit for deflate is ~1000x.
+DEFAULT_MAX_DECOMPRESSION_RATIO = 100
+
+# Below this size, gzip's overhead (CPU, plus ~20 bytes of header and
+# trailer) isn't worth it.
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+
 # RFC 7230's rules for connection lifecycles:
 # - If either side says they want to close the connection, then the connection
 #   must close.
@@ -38,16 +69,22 @@ HTTP_DEFAULT_MAX_BUFFER_SIZE = 16 * 1024
 #   (and even this is a mess -- e.g. if you're implementing a proxy then
 #   sending Connection: keep-alive is forbidden).
 #
-# We simplify life by simply not supporting keep-alive with HTTP/1.0 peers. So
-# our rule is:
+# By default we simplify life by simply not supporting keep-alive with
+# HTTP/1.0 peers. So our rule is:
 # - If someone says Connection: close, we will close
 # - If someone uses HTTP/1.0, we will close.
-def _keep_alive(event):
+#
+# With http10_keep_alive enabled, we relax the second rule: an HTTP/1.0 peer
+# that says Connection: keep-alive gets to keep the connection. (When we're
+# the server, we then have to say Connection: keep-alive back, and give the
+# response an explicit Content-Length -- see
+# _clean_up_response_headers_for_sending.)
+def _keep_alive(event, http10_keep_alive=False):
     connection = get_comma_header(event.headers, "Connection")
     if b"close" in connection:
         return False
     if getattr(event, "http_version", b"1.1") < b"1.1":
-        return False
+        return http10_keep_alive and b"keep-alive" in connection
     return True
 
 def _body_framing(request_method, event):
@@ -97,6 +134,22 @@ def _body_framing(request_method, event):
     else:
         return ("http/1.0", ())
 
+# Parses the (non-standard, but widely used) Keep-Alive header, e.g.
+#
+#   Keep-Alive: timeout=5, max=100
+#
+# Returns (timeout, max), where each is an int or None if missing or garbled.
+# See https://tools.ietf.org/html/draft-thomson-hybi-http-timeout-03
+def _keep_alive_params(headers):
+    params = {}
+    for item in get_comma_header(headers, "Keep-Alive"):
+        name, _, value = item.partition(b"=")
+        try:
+            params[name.strip()] = int(value.strip())
+        except ValueError:
+            pass
+    return params.get(b"timeout"), params.get(b"max")
+
 ################################################################
 #
 # The main Connection class
@@ -117,13 +170,195 @@ class Connection:
             exceeded, then :meth:`receive_data` will raise
             :exc:`ProtocolError`.
 
+        chunk_coalesce_size (int or None):
+            If set, then when sending a body with ``Transfer-Encoding:
+            chunked``, small :class:`Data` payloads are buffered and sent as
+            a single chunk once this many bytes have accumulated, rather than
+            one chunk per event. Buffered data is always sent along with the
+            :class:`EndOfMessage`, or earlier if you call :meth:`flush`. See
+            :ref:`chunk-coalescing`.
+
+        add_date_header (bool):
+            If True, then when acting as a server we add a ``Date:`` header to
+            every :class:`Response` that doesn't already have one. The
+            formatted date is cached and regenerated at most once per second.
+
+        clock (callable):
+            Returns the current time in seconds since the epoch, like
+            :func:`time.time` (which is the default). Used for the ``Date:``
+            header; mostly useful for testing.
+
+        decode_content (bool):
+            If True, then incoming bodies with ``Content-Encoding: gzip`` or
+            ``deflate`` are decompressed on the fly, and the :class:`Data`
+            events you receive contain the decompressed bytes. See
+            :ref:`content-coding`.
+
+        max_decoded_data_size (int):
+            When *decode_content* is enabled, the largest amount of
+            decompressed data returned in a single :class:`Data` event.
+
+        max_decompression_ratio (int or None):
+            When *decode_content* is enabled, if the decompressed body ever
+            grows to more than this many times the size of the compressed data
+            received so far, :meth:`receive_data` raises
+            :exc:`ProtocolError`. This protects against decompression
+            bombs. ``None`` disables the check.
+
+        compress_responses (bool):
+            If True, then when acting as a server we gzip-compress response
+            bodies for clients that send ``Accept-Encoding: gzip``. See
+            :ref:`content-coding`.
+
+        compress_min_size (int):
+            Responses with a ``Content-Length`` smaller than this are not
+            compressed.
+
+        compress_level (int):
+            The zlib compression level, from 1 (fastest) to 9 (smallest).
+
+        compress_sync_flush (bool):
+            If True, then the compressor is flushed after every :class:`Data`
+            event, so the peer can decompress everything sent so far. This
+            costs some compression ratio. If False (the default), compressed
+            data is sent as zlib produces it, and you can call :meth:`flush`
+            to force it out.
+
+        max_body_size (int or None):
+            The largest body we're willing to receive from the peer. If a
+            message declares a larger ``Content-Length``, then
+            :meth:`receive_data` raises :exc:`ProtocolError` as soon as the
+            headers arrive, without reading any of the body; for chunked and
+            HTTP/1.0-style bodies, it's raised as soon as the total grows past
+            the limit. The error's ``error_status_hint`` is 413. This counts
+            the body as sent on the wire, i.e. before any *decode_content*
+            decompression. ``None`` (the default) means no limit.
+
+        http10_keep_alive (bool):
+            If True, then HTTP/1.0 peers that send ``Connection:
+            keep-alive`` get to keep their connection open, using the
+            traditional HTTP/1.0 keep-alive handshake. Otherwise (the
+            default), connections with HTTP/1.0 peers are always closed after
+            one request/response cycle. See :ref:`keepalive-and-pipelining`.
+
+        pipeline_depth (int):
+            Servers only. If greater than zero, then when a client pipelines
+            requests, :meth:`receive_data` parses ahead and returns up to this
+            many complete requests beyond the one you're currently responding
+            to, instead of pausing after each one. Their total size is limited
+            by *max_buffer_size*. See :ref:`keepalive-and-pipelining`.
+
+        max_requests (int or None):
+            Servers only. The most request/response cycles we'll handle on
+            this connection. The response to the last allowed request
+            automatically gets ``Connection: close``. ``None`` (the default)
+            means no limit.
+
+        max_request_line (int or None):
+            The longest request line (or, for clients, status line) we'll
+            accept, not counting the CRLF. A longer one makes
+            :meth:`receive_data` raise :exc:`ProtocolError` as soon as we've
+            received that much of it. The ``error_status_hint`` is 414 (URI
+            Too Long) for a request line, and 400 for a status line.
+
+        max_header_line (int or None):
+            The longest header line we'll accept, not counting the CRLF (or,
+            for headers using the obsolete line folding syntax, the total
+            length of the joined-up lines). This also applies to the trailer
+            of a chunked body. Exceeding it raises :exc:`ProtocolError` with
+            an ``error_status_hint`` of 431.
+
+        max_header_count (int or None):
+            The most header fields we'll accept in a single request or
+            response, and, separately, in its trailer. Exceeding it raises
+            :exc:`ProtocolError` with an ``error_status_hint`` of 431.
+
+        These last three are in addition to *max_buffer_size*, which limits
+        the size of the whole head; ``None`` (the default) means no separate
+        limit.
+
+        memoize_headers (bool):
+            If True, then we remember the raw header block of the last
+            request or response we received, along with the parsed
+            :class:`Headers`. If the next one has byte-for-byte identical
+            headers -- as consecutive requests from the same client usually
+            do -- then we skip parsing and validating them, and its event
+            gets the same :class:`Headers` object. This costs a copy of the
+            last header block per connection.
+
     """
-    def __init__(self, our_role, max_buffer_size=HTTP_DEFAULT_MAX_BUFFER_SIZE):
+    def __init__(self, our_role, max_buffer_size=HTTP_DEFAULT_MAX_BUFFER_SIZE,
+                 chunk_coalesce_size=None, add_date_header=False,
+                 clock=time.time, decode_content=False,
+                 max_decoded_data_size=DEFAULT_MAX_DECODED_DATA_SIZE,
+                 max_decompression_ratio=DEFAULT_MAX_DECOMPRESSION_RATIO,
+                 compress_responses=False,
+                 compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+                 compress_level=6, compress_sync_flush=False,
+                 max_body_size=None, http10_keep_alive=False,
+                 pipeline_depth=0, max_requests=None, max_request_line=None,
+                 max_header_line=None, max_header_count=None,
+                 memoize_headers=False):
         self._max_buffer_size = max_buffer_size
+        self._http10_keep_alive = http10_keep_alive
+        self._compress_responses = compress_responses
+        self._compress_min_size = compress_min_size
+        self._compress_level = compress_level
+        self._compress_sync_flush = compress_sync_flush
+        self._decode_content = decode_content
+        self._max_decoded_data_size = max_decoded_data_size
+        self._max_decompression_ratio = max_decompression_ratio
+        self._add_date_header = add_date_header
+        self._clock = clock
+        if (max_request_line is None and max_header_line is None
+              and max_header_count is None and not memoize_headers):
+            self._readers = READERS
+        else:
+            self._readers = configured_readers(
+                memoize_headers=memoize_headers,
+                max_start_line=max_request_line,
+                max_header_line=max_header_line,
+                max_header_count=max_header_count)
+        # Extra keyword arguments for the body reader/writer factories, keyed
+        # by framing type
+        self._reader_options = {}
+        self._writer_options = {}
+        if max_body_size is not None:
+            for framing_type in READERS[SEND_BODY]:
+                self._reader_options[framing_type] = {
+                    "max_body_size": max_body_size,
+                }
+        if chunk_coalesce_size is not None:
+            if chunk_coalesce_size <= 0:
+                raise ValueError("chunk_coalesce_size must be positive")
+            self._writer_options["chunked"] = {
+                "coalesce_size": chunk_coalesce_size,
+            }
         # State and role tracking
         if our_role not in (CLIENT, SERVER):
             raise ValueError(
                 "expected CLIENT or SERVER, not {!r}".format(our_role))
+        if pipeline_depth and our_role is not SERVER:
+            raise ValueError("pipeline_depth is only supported for servers")
+        self._pipeline_depth = pipeline_depth
+        if max_requests is not None:
+            if our_role is not SERVER:
+                raise ValueError("max_requests is only supported for servers")
+            if max_requests <= 0:
+                raise ValueError("max_requests must be positive")
+        self._max_requests = max_requests
+        self._request_count = 0
+        # Requests that we've parsed ahead of time and already returned, but
+        # that haven't gone through the state machine yet. Each entry is a
+        # (list of events, size in bytes) pair, for one complete request.
+        self._pipeline = deque()
+        self._pipeline_size = 0
+        # If a request that we tried to parse ahead was only partly there, the
+        # buffer length we're waiting for before trying again.
+        self._parse_ahead_wait = 0
+        # If a request that we tried to parse ahead was broken, the
+        # ProtocolError, which gets raised when we catch up to it.
+        self._parse_ahead_error = None
         self.our_role = our_role
         if our_role is CLIENT:
             self.their_role = SERVER
@@ -133,14 +368,22 @@ class Connection:
 
         # Callables for converting data->events or vice-versa given the
         # current state
-        self._writer = self._get_io_object(self.our_role, None, WRITERS)
-        self._reader = self._get_io_object(self.their_role, None, READERS)
+        self._writer = self._get_io_object(
+            self.our_role, None, WRITERS, self._writer_options)
+        self._reader = self._get_io_object(
+            self.their_role, None, self._readers, self._reader_options)
 
         # Holds any unprocessed received data
         self._receive_buffer = ReceiveBuffer()
         # If this is true, then it indicates that the incoming connection was
         # closed *after* the end of whatever's in self._receive_buffer:
         self._receive_buffer_closed = False
+        # True if there might be events sitting in self._receive_buffer that
+        # we haven't tried to parse yet, i.e., the user needs to call
+        # receive_data(None). See next_action.
+        self._receive_buffer_unparsed = False
+        # Set by detach_receive_buffer.
+        self._receive_buffer_detached = False
 
         # Extra bits of state that don't fit into the state machine.
         #
@@ -148,7 +391,20 @@ class Connection:
         # out how to read/write response bodies. their_http_version is also
         # made available as a convenient public API.
         self.their_http_version = None
+        self.their_keep_alive_timeout = None
+        self.their_keep_alive_max = None
         self._request_method = None
+        # Only tracked if compress_responses is enabled. The first is whether
+        # the peer's request said they'd take gzip; the second is whether
+        # we've decided to compress the response we're sending.
+        self._request_accepts_gzip = False
+        self._compressing_response = False
+        # Set by start_raw_body, and cleared by end_raw_body.
+        self._raw_body = False
+        # Set by discard_incoming_body, and cleared when the body ends.
+        self._discarding = False
+        self._discard_max_bytes = None
+        self._discarded = 0
         # This is pure flow-control and doesn't at all affect the set of legal
         # transitions, so no need to bother ConnectionState with it:
         self.client_is_waiting_for_100_continue = False
@@ -212,10 +468,25 @@ class Connection:
         old_states = dict(self._cstate.states)
         self._cstate.prepare_to_reuse()
         self._request_method = None
+        self._request_accepts_gzip = False
+        self._compressing_response = False
         # self.their_http_version gets left alone, since it presumably lasts
         # beyond a single request/response cycle
         assert not self.client_is_waiting_for_100_continue
         self._respond_to_state_changes(old_states)
+        if self._pipeline:
+            # The next request was parsed ahead of time; now that we've
+            # caught up to it, run it through the state machine.
+            events, size = self._pipeline.popleft()
+            self._pipeline_size -= size
+            for event in events:
+                self._process_event(self.their_role, event)
+        else:
+            # The regular machinery is about to start reading the buffer, so
+            # whatever we were waiting for is moot.
+            self._parse_ahead_wait = 0
+        if self._receive_buffer or self._parse_ahead_error is not None:
+            self._receive_buffer_unparsed = True
 
     def _process_error(self, role):
         old_states = dict(self._cstate.states)
@@ -255,11 +526,17 @@ class Connection:
         # self._request_method
         if type(event) is Request:
             self._request_method = event.method
+            self._request_count += 1
+            if self._compress_responses:
+                self._request_accepts_gzip = accepts_gzip(event.headers)
 
         # self.their_http_version
         if (role is self.their_role
             and type(event) in (Request, Response, InformationalResponse)):
             self.their_http_version = event.http_version
+            if type(event) is not InformationalResponse:
+                (self.their_keep_alive_timeout,
+                 self.their_keep_alive_max) = _keep_alive_params(event.headers)
 
         # Keep alive handling
         #
@@ -267,7 +544,8 @@ class Connection:
         # shows up on a 1xx InformationalResponse. I think the idea is that
         # this is not supposed to happen. In any case, if it does happen, we
         # ignore it.
-        if type(event) in (Request, Response) and not _keep_alive(event):
+        if (type(event) in (Request, Response)
+              and not _keep_alive(event, self._http10_keep_alive)):
             self._cstate.process_keep_alive_disabled()
 
         # 100-continue
@@ -280,14 +558,15 @@ class Connection:
 
         self._respond_to_state_changes(old_states, event)
 
-    def _get_io_object(self, role, event, io_dict):
+    def _get_io_object(self, role, event, io_dict, options):
         # event may be None; it's only used when entering SEND_BODY
         state = self._cstate.states[role]
         if state is SEND_BODY:
             # Special case: the io_dict has a dict of reader/writer factories
             # that depend on the request/response framing.
             framing_type, args = _body_framing(self._request_method, event)
-            return io_dict[SEND_BODY][framing_type](*args)
+            kwargs = options.get(framing_type, {})
+            return io_dict[SEND_BODY][framing_type](*args, **kwargs)
         else:
             # General case: the io_dict just has the appropriate reader/writer
             # for this state
@@ -298,9 +577,30 @@ class Connection:
     def _respond_to_state_changes(self, old_states, event=None):
         # Update reader/writer
         if self.our_state != old_states[self.our_role]:
-            self._writer = self._get_io_object(self.our_role, event, WRITERS)
+            self._writer = self._get_io_object(
+                self.our_role, event, WRITERS, self._writer_options)
+            if self._compressing_response and self.our_state is SEND_BODY:
+                self._writer = ContentEncodingWriter(
+                    self._writer, self._compress_level,
+                    self._compress_sync_flush)
         if self.their_state != old_states[self.their_role]:
-            self._reader = self._get_io_object(self.their_role, event, READERS)
+            self._discarding = False
+            self._reader = self._get_io_object(
+                self.their_role, event, self._readers, self._reader_options)
+            if self._decode_content and self.their_state is SEND_BODY:
+                self._reader = decoding_reader(
+                    self._reader, event.headers,
+                    self._max_decoded_data_size,
+                    self._max_decompression_ratio)
+
+    @property
+    def request_method(self):
+        """The method of the request in the current request/response cycle
+        (as :class:`bytes`), whichever of us sent it, or ``None`` if there
+        hasn't been one yet.
+
+        """
+        return self._request_method
 
     @property
     def trailing_data(self):
@@ -311,8 +611,39 @@ class Connection:
 
         See :ref:`switching-protocols` for discussion of why you'd want this.
         """
+        if self._receive_buffer_detached:
+            raise RuntimeError("receive buffer has been detached")
         return (bytes(self._receive_buffer), self._receive_buffer_closed)
 
+    def detach_receive_buffer(self):
+        """Take the unprocessed data after a protocol switch, without copying
+        it.
+
+        This is like :attr:`trailing_data`, except that instead of a copy you
+        get the buffer itself: h11 drops its own reference, so if a client
+        sent a lot of data right after its ``CONNECT`` or ``Upgrade:``
+        request, you can start forwarding it immediately. It can only be
+        called once, and only after the switch has happened (i.e., when
+        :attr:`our_state` is :data:`SWITCHED_PROTOCOL`); after that, this
+        connection can't receive any more data, and :attr:`trailing_data` is
+        no longer available.
+
+        See :ref:`switching-protocols`.
+
+        Returns:
+            A tuple with two elements: a :class:`memoryview` of the
+            unprocessed data, and a bool that is True if the receive
+            connection was closed.
+
+        """
+        if self.our_state is not SWITCHED_PROTOCOL:
+            raise RuntimeError(
+                "can only detach the receive buffer after switching protocols")
+        if self._receive_buffer_detached:
+            raise RuntimeError("receive buffer has already been detached")
+        self._receive_buffer_detached = True
+        return (self._receive_buffer.detach(), self._receive_buffer_closed)
+
     def receive_data(self, data):
         """Convert bytes received from the remote peer into high-level events,
         while updating our internal state machine.
@@ -368,50 +699,65 @@ class Connection:
 
         """
 
+        return self.receive_data_many([data])
+
+    def receive_data_many(self, buffers):
+        """Like :meth:`receive_data`, but for several pieces of data at once.
+
+        This is for transports that hand over received data in batches --
+        e.g. a queue of chunks, or the buffers filled by a single
+        :func:`socket.recvmsg_into` call. The result is the same as calling
+        :meth:`receive_data` on each buffer in turn and concatenating the
+        returned lists (including how ``b""`` and ``None`` are handled, and
+        when the buffer size limit is enforced), except that there may be
+        fewer :class:`Data` and :class:`Paused` events, and the overhead of
+        parsing is only paid once instead of once per buffer.
+
+        Args:
+            buffers: An iterable of :term:`bytes-like objects <bytes-like
+                object>` (or ``None``), each with the same meaning as the
+                *data* argument to :meth:`receive_data`.
+
+        Returns:
+            A list of :ref:`event <events>` objects.
+
+        """
         if self.their_state is ERROR:
             raise ProtocolError("Can't receive data when peer state is ERROR")
+        if self._raw_body:
+            raise RuntimeError(
+                "can't receive data while the body is being passed through "
+                "raw; call end_raw_body first")
+        if self._receive_buffer_detached:
+            raise RuntimeError("receive buffer has been detached")
         try:
-            # Update self._receive_buffer with new data
-            if data is not None:
-                if data:
-                    if self._receive_buffer_closed:
-                        raise RuntimeError(
-                            "received close, then received more data?")
-                    self._receive_buffer += data
-                else:
-                    self._receive_buffer_closed = True
-
-            # Read out all the events we can
             events = []
-            while True:
-                event = self._next_receive_event()
-                if event is None:
-                    break
-                events.append(event)
-                # The Paused pseudo-event doesn't go through the state
-                # machine, because it's purely a local signal.
-                if type(event) is Paused:
-                    break
-                self._process_event(self.their_role, event)
-                if type(event) is ConnectionClosed:
-                    break
-
-            # Buffer maintainence
-            self._receive_buffer.compress()
-            if events and type(events[-1]) is Paused:
-                # We don't enforce buffer size limits when Paused, because
-                # avoiding ever-growing buffers here indicates a problem with
-                # the user code, not with the remote client (and otherwise
-                # it's entirely possible that a single receive_data call all
-                # by itself could put us over the limit, with no real way to
-                # avoid it)
-                pass
-            else:
+            parsed = True
+            for data in buffers:
+                # Update self._receive_buffer with new data
+                if data is not None:
+                    if data:
+                        if self._receive_buffer_closed:
+                            raise RuntimeError(
+                                "received close, then received more data?")
+                        # Once parse-ahead has found a broken request, we're
+                        # going to error out when we get to it, so there's no
+                        # point keeping anything else they send.
+                        if self._parse_ahead_error is None:
+                            self._receive_buffer += data
+                    else:
+                        self._receive_buffer_closed = True
+                parsed = False
+                # Parsing once at the end gives the same events as parsing
+                # after each buffer. The exception is the buffer size limit:
+                # if we're over it now, then a separate receive_data call
+                # would have parsed and then checked the limit here, so we do
+                # the same.
                 if len(self._receive_buffer) > self._max_buffer_size:
-                    # 431 is "Request header fields too large" which is pretty
-                    # much the only situation where we can get here
-                    raise ProtocolError("Receive buffer too long",
-                                        error_status_hint=431)
+                    events += self._receive_events()
+                    parsed = True
+            if not parsed:
+                events += self._receive_events()
 
             # We've greedily processed all possible events, so if there's no
             # more data coming, we better either be paused or else have
@@ -429,18 +775,159 @@ class Connection:
             self._process_error(self.their_role)
             raise
 
+    # Reads out all the events we can from self._receive_buffer, and then
+    # enforces the buffer size limit on whatever's left.
+    def _receive_events(self):
+        self._receive_buffer_unparsed = False
+        events = []
+        while True:
+            event = self._next_receive_event()
+            if event is None:
+                break
+            # The Paused pseudo-event doesn't go through the state
+            # machine, because it's purely a local signal.
+            if type(event) is Paused:
+                if event.reason is DONE and self._pipeline_depth:
+                    events += self._parse_ahead()
+                events.append(event)
+                break
+            events.append(event)
+            self._process_event(self.their_role, event)
+            if type(event) is ConnectionClosed:
+                break
+
+        # Buffer maintainence
+        self._receive_buffer.compress()
+        if events and type(events[-1]) is Paused:
+            # We don't enforce buffer size limits when Paused, because
+            # avoiding ever-growing buffers here indicates a problem with
+            # the user code, not with the remote client (and otherwise
+            # it's entirely possible that a single receive_data call all
+            # by itself could put us over the limit, with no real way to
+            # avoid it)
+            pass
+        else:
+            if len(self._receive_buffer) > self._max_buffer_size:
+                # 431 is "Request header fields too large" which is pretty
+                # much the only situation where we can get here
+                raise ProtocolError("Receive buffer too long",
+                                    error_status_hint=431)
+        return events
+
+    # Used when pipeline_depth is set: while the client is DONE, parses as
+    # many more complete requests out of the receive buffer as we're allowed
+    # to, adds them to self._pipeline, and returns their events. The events
+    # skip the state machine until prepare_to_reuse catches up with them.
+    #
+    # A request that isn't complete yet is left in the buffer, to be dealt
+    # with by the regular machinery once we get there. We're careful not to
+    # keep re-parsing it from scratch as it trickles in, since that would
+    # make a slow client cost us quadratic time. A request that has something
+    # wrong with it -- including breaking the line or buffer size limits --
+    # is thrown away, and we save the ProtocolError to raise when we get to
+    # it.
+    def _parse_ahead(self):
+        events = []
+        while (self._receive_buffer
+               and len(self._pipeline) < self._pipeline_depth
+               and len(self._receive_buffer) >= self._parse_ahead_wait):
+            # No point parsing requests we aren't going to handle.
+            if (self._max_requests is not None
+                  and self._request_count + len(self._pipeline)
+                      >= self._max_requests):
+                break
+            if self._pipeline:
+                last_request = self._pipeline[-1][0][0]
+                # Nothing can follow a request that closes the connection or
+                # switches protocols.
+                if (not _keep_alive(last_request, self._http10_keep_alive)
+                      or any(self._client_switch_events(last_request))):
+                    break
+            request_events = self._parse_ahead_one()
+            if request_events is None:
+                break
+            events += request_events
+        return events
+
+    def _parse_ahead_one(self):
+        buf = self._receive_buffer
+        mark = buf.mark()
+        start_size = len(buf)
+        try:
+            request = self._readers[CLIENT, IDLE](buf)
+            if request is None:
+                # Nothing has been extracted, and the head reader carries on
+                # from where it left off next time, so there's no need to
+                # rewind. But like the regular machinery, we won't wait
+                # forever for the end of the head.
+                if start_size > self._max_buffer_size:
+                    raise ProtocolError("Receive buffer too long",
+                                        error_status_hint=431)
+                return None
+            framing_type, args = _body_framing(None, request)
+            reader = self._readers[SEND_BODY][framing_type](
+                *args, **self._reader_options.get(framing_type, {}))
+            if self._decode_content:
+                reader = decoding_reader(
+                    reader, request.headers,
+                    self._max_decoded_data_size,
+                    self._max_decompression_ratio)
+            events = [request]
+            while type(events[-1]) is not EndOfMessage:
+                event = reader(buf)
+                if event is None:
+                    break
+                events.append(event)
+                if (self._pipeline_size + start_size - len(buf)
+                      > self._max_buffer_size):
+                    break
+            else:
+                size = start_size - len(buf)
+                self._pipeline.append((events, size))
+                self._pipeline_size += size
+                self._parse_ahead_wait = 0
+                return events
+        except ProtocolError as exc:
+            buf.rewind(mark)
+            buf.skip_at_most(len(buf))
+            self._parse_ahead_error = exc
+            return None
+        buf.rewind(mark)
+        # We'll have to parse this request again from the top, so don't try
+        # until there's a chance of getting all of it: for a Content-Length
+        # body, that's when the rest of the body arrives. Otherwise we can't
+        # tell, so we wait until the buffer has doubled, which keeps the
+        # total time spent re-parsing proportional to the data received.
+        needed = getattr(reader, "bytes_needed", None)
+        if framing_type != "content-length" or needed is None:
+            needed = max(needed or 1, start_size)
+        self._parse_ahead_wait = start_size + needed
+        return None
+
     def _next_receive_event(self):
         state = self.their_state
         # We don't pause immediately when they enter DONE, because even in
         # DONE state we can still process a ConnectionClosed() event. But
         # if we have data in our buffer, then we definitely aren't getting
         # a ConnectionClosed() immediately and we need to pause.
-        if state is DONE and self._receive_buffer:
+        if state is DONE and (self._receive_buffer or self._pipeline
+                              or self._parse_ahead_error is not None):
             return Paused(reason=state)
+        if state is IDLE and self._parse_ahead_error is not None:
+            raise self._parse_ahead_error
         if state is MIGHT_SWITCH_PROTOCOL or state is SWITCHED_PROTOCOL:
             return Paused(reason=state)
         assert self._reader is not None
-        event = self._reader(self._receive_buffer)
+        if self._discarding:
+            before = len(self._receive_buffer)
+            event = self._reader(self._receive_buffer)
+            self._discarded += before - len(self._receive_buffer)
+            if (self._discard_max_bytes is not None
+                  and self._discarded > self._discard_max_bytes):
+                raise ProtocolError("discarded more than max_bytes of body",
+                                    error_status_hint=413)
+        else:
+            event = self._reader(self._receive_buffer)
         if event is None:
             if not self._receive_buffer and self._receive_buffer_closed:
                 # In some unusual cases (basically just HTTP/1.0 bodies), EOF
@@ -453,6 +940,178 @@ class Connection:
                     event = ConnectionClosed()
         return event
 
+    def next_action(self):
+        """Work out what needs to happen next to make progress on this
+        connection.
+
+        This is for event loops that want to know whether it's worth reading
+        from the socket right now, without piecing it together from
+        :attr:`our_state`, :attr:`their_state`, and friends. See
+        :ref:`next-action`.
+
+        Returns:
+            One of the following sentinel values, checked in this order:
+
+            * :data:`ERROR`: One side or the other is in the :data:`ERROR`
+              state; the connection is unusable, so close it.
+            * :data:`SWITCHED_PROTOCOL`: We've switched protocols, so h11 is
+              done with this connection. See :ref:`switching-protocols`.
+            * :data:`MUST_CLOSE`: Neither side can send anything else over
+              HTTP. Send whatever you have left, and then close the
+              connection.
+            * :data:`SEND_100_CONTINUE`: The client is waiting for a ``100
+              Continue`` before sending the request body. Send one (or your
+              final response) before you read.
+            * :data:`PAUSED`: Both sides are in :data:`DONE`; call
+              :meth:`prepare_to_reuse` to start the next cycle.
+            * :data:`RECEIVE_BUFFERED`: There's data in our receive buffer
+              that hasn't been parsed since :meth:`prepare_to_reuse`; call
+              ``receive_data(None)`` before reading any more from the
+              network.
+            * :data:`NEED_DATA`: We're waiting for the peer to send
+              something; read from the network and pass it to
+              :meth:`receive_data`. See also :attr:`bytes_needed`.
+            * :data:`NEED_TO_SEND`: It's our turn; nothing more will arrive
+              until we send something (a request, a response, or the rest of
+              a body).
+
+        """
+        our_state = self.our_state
+        their_state = self.their_state
+        if our_state is ERROR or their_state is ERROR:
+            return ERROR
+        if our_state is SWITCHED_PROTOCOL:
+            return SWITCHED_PROTOCOL
+        if (our_state in (MUST_CLOSE, CLOSED)
+              and their_state in (MUST_CLOSE, CLOSED)):
+            return MUST_CLOSE
+        if self.they_are_waiting_for_100_continue:
+            return SEND_100_CONTINUE
+        if our_state is DONE and their_state is DONE:
+            return PAUSED
+        if not self._their_turn():
+            return NEED_TO_SEND
+        if self._receive_buffer_unparsed:
+            return RECEIVE_BUFFERED
+        return NEED_DATA
+
+    # Whether the peer is expected to send something before we do.
+    def _their_turn(self):
+        their_state = self.their_state
+        if their_state is SEND_BODY:
+            return True
+        if self.their_role is CLIENT:
+            # A server waits for each request.
+            return their_state is IDLE
+        # A client waits for the response once it has sent its request --
+        # or, with Expect: 100-continue, as soon as it has sent the head.
+        return their_state is SEND_RESPONSE and (
+            self.our_state is not SEND_BODY
+            or self.client_is_waiting_for_100_continue)
+
+    @property
+    def bytes_needed(self):
+        """The number of bytes the peer still has to send before h11 can make
+        progress, if we know it, or else ``None``.
+
+        This is only known partway through a body: for a ``Content-Length``
+        body it's the rest of the body, and for a chunked body it's the rest
+        of the current chunk (plus the CRLF that ends it). You can use it to
+        size your reads, e.g. with :meth:`socket.socket.recv_into`, so that
+        each read completes exactly the data h11 is waiting for. Reading
+        more than this is harmless; the extra data is buffered as usual.
+
+        This is always ``None`` when :meth:`next_action` isn't
+        :data:`NEED_DATA`.
+
+        """
+        if self._raw_body or self.next_action() is not NEED_DATA:
+            return None
+        return getattr(self._reader, "bytes_needed", None)
+
+    def discard_incoming_body(self, max_bytes=None):
+        """Throw away the rest of the body that the peer is currently sending.
+
+        This is for when you've decided not to read a body -- e.g., a server
+        that's rejecting an upload with a 401 or 413 -- but still want to
+        reuse the connection afterwards, which means reading the body off the
+        wire anyway. After calling this, :meth:`receive_data` skips over the
+        body data without creating :class:`Data` events for it, so the next
+        event you see for this message is its :class:`EndOfMessage`.
+
+        If the body has already been completely received, this does nothing.
+
+        Args:
+            max_bytes (int or None): The most data we're willing to read and
+                throw away. If the peer sends more than this before the body
+                ends, then :meth:`receive_data` raises :exc:`ProtocolError`
+                (and :attr:`their_state` becomes :data:`ERROR`), which is your
+                signal to give up and close the connection instead. ``None``
+                means no limit.
+
+        Returns:
+            The same as ``receive_data(None)``: any events that can now be
+            parsed from data that's already been received -- normally either
+            nothing, or the :class:`EndOfMessage`.
+
+        """
+        if self.their_state in (IDLE, SEND_RESPONSE):
+            raise RuntimeError("no incoming body to discard")
+        if self.their_state is SEND_BODY:
+            self._discarding = True
+            self._discard_max_bytes = max_bytes
+            self._discarded = 0
+            self._reader.discarding = True
+        return self.receive_data(None)
+
+    def start_raw_body(self):
+        """Take over responsibility for the rest of the incoming body.
+
+        This is for proxies that want to relay a body from one socket to
+        another without it passing through Python -- e.g. using
+        :func:`os.splice` -- and so don't want h11 to read it at all. It's
+        only possible for bodies with a ``Content-Length`` (and without
+        *decode_content* decompression), since otherwise we'd need to parse
+        the framing as we go. See :ref:`raw-body`.
+
+        After calling this, you must not call :meth:`receive_data` until
+        you've relayed the rest of the body yourself and called
+        :meth:`end_raw_body`.
+
+        Returns:
+            A tuple ``(data, remaining)``. *data* is a :term:`bytes-like
+            object` containing any body data that h11 had already received
+            but not yet returned as :class:`Data` events; send this first.
+            *remaining* is the number of further body bytes that you need to
+            read directly from the socket.
+
+        """
+        if self.their_state is not SEND_BODY:
+            raise RuntimeError("no incoming body to pass through")
+        hand_off = getattr(self._reader, "hand_off", None)
+        if hand_off is None:
+            raise RuntimeError(
+                "raw body passthrough requires a Content-Length body "
+                "without content decoding")
+        data, remaining = hand_off(self._receive_buffer)
+        self._receive_buffer.compress()
+        self._raw_body = True
+        return data, remaining
+
+    def end_raw_body(self):
+        """Tell h11 that you've finished relaying the body you took over with
+        :meth:`start_raw_body`, and resume normal parsing.
+
+        Returns:
+            The same as ``receive_data(None)`` -- in particular, the first
+            event is the :class:`EndOfMessage` for the body.
+
+        """
+        if not self._raw_body:
+            raise RuntimeError("start_raw_body wasn't called")
+        self._raw_body = False
+        return self.receive_data(None)
+
     def send(self, event):
         """Convert a high-level event into bytes that can be sent to the peer,
         while updating our internal state machine.
@@ -474,7 +1133,7 @@ class Connection:
         :ref:`error-handling` for discussion.
 
         """
-        data_list = self.send_with_data_passthrough(event)
+        data_list = self._send(event)
         if data_list is None:
             return None
         else:
@@ -487,7 +1146,16 @@ class Connection:
         list is guaranteed to contain the exact object you passed in as
         :attr:`Data.data`. See :ref:`sendfile` for discussion.
 
+        To keep that promise, *chunk_coalesce_size* doesn't apply to
+        :class:`Data` sent this way: anything already being held back is
+        sent first, followed by your object as a chunk of its own. (The
+        exception is a response that *compress_responses* has decided to
+        compress, since then what goes on the wire is the compressed data.)
+
         """
+        return self._send(event, coalesce=False)
+
+    def _send(self, event, coalesce=True):
         if self.our_state is ERROR:
             raise ProtocolError("Can't send data when our state is ERROR")
         try:
@@ -507,12 +1175,115 @@ class Connection:
                 # have raised ProtocolError
                 assert writer is not None
                 data_list = []
-                writer(event, data_list.append)
+                if type(event) is Data and not coalesce:
+                    send_data = getattr(writer, "send_data_uncoalesced",
+                                        writer.send_data)
+                    send_data(event.data, data_list.append)
+                else:
+                    writer(event, data_list.append)
                 return data_list
         except:
             self._process_error(self.our_role)
             raise
 
+    def flush(self):
+        """Return any outgoing body data that is being held back by
+        ``chunk_coalesce_size``.
+
+        Normally this is sent automatically when enough data accumulates or
+        when you send :class:`EndOfMessage`; call this when you want the peer
+        to see what you've sent so far without waiting for either of those,
+        e.g. before blocking on a slow upstream.
+
+        Returns:
+            A :term:`bytes-like object`, which will be empty if nothing was
+            buffered.
+
+        """
+        if self.our_state is ERROR:
+            raise ProtocolError("Can't send data when our state is ERROR")
+        flush = getattr(self._writer, "flush", None)
+        if flush is None:
+            return b""
+        data_list = []
+        flush(data_list.append)
+        return b"".join(data_list)
+
+    @property
+    def more_to_send(self):
+        """True if the message we're currently sending isn't finished yet, so
+        the bytes most recently returned by :meth:`send` are definitely going
+        to be followed by more.
+
+        For example, this is True right after sending a :class:`Response`
+        whose body is non-empty, or after a :class:`Data` event that doesn't
+        complete the declared ``Content-Length``. It's False whenever we
+        aren't in :data:`SEND_BODY`, and also once a ``Content-Length`` body
+        has been completely sent (in which case the :class:`EndOfMessage`
+        will produce no bytes at all).
+
+        See :ref:`corking`.
+
+        """
+        if self.our_state is not SEND_BODY:
+            return False
+        return self._writer.more_expected()
+
+    def send_message(self, event, body=b"", trailers=None):
+        """Send a complete message -- a :class:`Request` or :class:`Response`,
+        its body, and its :class:`EndOfMessage` -- in one call.
+
+        This is equivalent to calling :meth:`send` on the three events in
+        turn, and applies exactly the same validation, but it returns all the
+        bytes together in a single buffer. It's handy for small messages whose
+        body is known up front.
+
+        If *event* has neither a ``Content-Length`` nor a
+        ``Transfer-Encoding`` header, then one is filled in for you:
+        ``Content-Length: <len(body)>`` normally, or ``Transfer-Encoding:
+        chunked`` if you passed any *trailers*.
+
+        Args:
+            event: A :class:`Request` or :class:`Response`.
+            body (:term:`bytes-like object`): The complete message body.
+            trailers: Trailing headers for the :class:`EndOfMessage`, as a
+                list of (name, value) pairs.
+
+        Returns:
+            A :term:`bytes-like object`.
+
+        """
+        if type(event) not in (Request, Response):
+            raise TypeError(
+                "expected Request or Response, not {}"
+                .format(type(event).__name__))
+        if trailers is None:
+            trailers = []
+        eom = EndOfMessage(headers=trailers)
+        if (not get_comma_header(event.headers, "Content-Length")
+            and not get_comma_header(event.headers, "Transfer-Encoding")):
+            # Like _clean_up_response_headers_for_sending, we don't mutate the
+            # user's headers list in-place.
+            headers = list(event.headers)
+            if eom.headers:
+                set_comma_header(headers, "Transfer-Encoding", ["chunked"])
+            elif body or type(event) is Response:
+                framing_type, _ = _body_framing(self._request_method, event)
+                # Responses that are forced to have an empty body (HEAD, 204,
+                # 304, ...) come back as content-length framing; leave those
+                # alone.
+                if type(event) is Request or framing_type == "http/1.0":
+                    set_comma_header(
+                        headers, "Content-Length", [str(len(body))])
+            event.headers = headers
+        data_list = self._send(event)
+        # An empty Data event would be written as the terminating chunk by
+        # ChunkedWriter, so skip it entirely.
+        if body:
+            data_list += self._send(Data(data=body))
+        data_list += self._send(eom)
+        return b"".join(data_list)
+
     # When sending a Response, we take responsibility for a few things:
     #
     # - Sometimes you MUST set Connection: close. We take care of those
@@ -520,21 +1291,42 @@ class Connection:
     #   we'll respect that and close the connection at the right time. But you
     #   don't have to worry about that unless you want to.)
     #
+    # - If add_date_header is enabled, we fill in Date: unless the user
+    #   already set one.
+    #
     # - The user has to set Content-Length if they want it. Otherwise, for
     #   responses that have bodies (e.g. not HEAD), then we will automatically
     #   select the right mechanism for streaming a body of unknown length,
     #   which depends on depending on the peer's HTTP version.
     #
+    # - If compress_responses is enabled, we decide whether to gzip the body,
+    #   and if so set Content-Encoding and switch to chunked framing.
+    #
     # This function's *only* responsibility is making sure headers are set up
     # right -- everything downstream just looks at the headers. There are no
-    # side channels. It mutates the response event in-place (but not the
-    # response.headers list object).
+    # side channels, with one exception: whether we're compressing can't be
+    # inferred from the headers (the user might have set Content-Encoding
+    # themselves, on an already-compressed body), so that's recorded in
+    # self._compressing_response. It mutates the response event in-place (but
+    # not the response.headers list object).
     def _clean_up_response_headers_for_sending(self, response):
         assert type(response) is Response
 
         headers = list(response.headers)
         need_close = False
 
+        self._compressing_response = False
+        if self._compress_responses and self._should_compress(response):
+            self._compressing_response = True
+            set_comma_header(headers, "Content-Encoding", ["gzip"])
+            set_comma_header(headers, "Content-Length", [])
+            set_comma_header(headers, "Transfer-Encoding", ["chunked"])
+            vary = get_comma_header(headers, "Vary", lowercase=False)
+            if not any(v.lower() in (b"accept-encoding", b"*") for v in vary):
+                set_comma_header(headers, "Vary", vary + [b"Accept-Encoding"])
+            # Let the framing logic below see the new headers
+            response.headers = headers
+
         framing_type, _ = _body_framing(self._request_method, response)
         if framing_type in ("chunked", "http/1.0"):
             # This response has a body of unknown length.
@@ -556,19 +1348,57 @@ class Connection:
                 # or else we did get a valid HTTP/1.0 request, so we know that
                 # they don't understand chunked encoding.
                 set_comma_header(headers, "Transfer-Encoding", [])
-                # This is actually redundant ATM, since currently we
-                # unconditionally disable keep-alive when talking to HTTP/1.0
-                # peers. But let's be defensive just in case we add
-                # Connection: keep-alive support later:
+                # Without framing, the only way to mark the end of the body
+                # is to close the connection -- even if it's an HTTP/1.0 peer
+                # that asked for keep-alive.
                 need_close = True
             else:
                 set_comma_header(headers, "Transfer-Encoding", ["chunked"])
 
+        if self._add_date_header:
+            for name, _ in headers:
+                if name == b"date":
+                    break
+            else:
+                headers.append((b"date", get_date_header_value(self._clock)))
+
+        if (self._max_requests is not None
+              and self._request_count >= self._max_requests):
+            need_close = True
+
         if not self._cstate.keep_alive or need_close:
             # Make sure Connection: close is set
             connection = set(get_comma_header(headers, "Connection"))
             connection.discard(b"keep-alive")
             connection.add(b"close")
             set_comma_header(headers, "Connection", sorted(connection))
+        elif (self.their_http_version is not None
+              and self.their_http_version < b"1.1"
+              and _keep_alive(response)):
+            # We only get here with http10_keep_alive enabled, and an HTTP/1.0
+            # peer that asked for keep-alive. They'll assume we're closing
+            # unless we say otherwise -- which we don't, if the user has
+            # already said Connection: close.
+            connection = set(get_comma_header(headers, "Connection"))
+            connection.add(b"keep-alive")
+            set_comma_header(headers, "Connection", sorted(connection))
 
         response.headers = headers
+
+    def _should_compress(self, response):
+        if not self._request_accepts_gzip:
+            return False
+        if get_comma_header(response.headers, "Content-Encoding"):
+            return False
+        # Partial content is a range of the *encoded* representation, so
+        # compressing it on the fly would produce nonsense.
+        if response.status_code == 206:
+            return False
+        framing_type, args = _body_framing(self._request_method, response)
+        if framing_type == "content-length":
+            (length,) = args
+            # A length of 0 also catches responses that can't have a body at
+            # all, e.g. to HEAD requests.
+            if length == 0 or length < self._compress_min_size:
+                return False
+        return True
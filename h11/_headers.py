@@ -1,4 +1,6 @@
 import re
+import time
+from email.utils import formatdate
 from ._util import ProtocolError, bytesify, validate
 
 # Facts
@@ -58,6 +60,10 @@ from ._util import ProtocolError, bytesify, validate
 _content_length_re = re.compile(br"^[0-9]+$")
 
 def normalize_and_validate(headers):
+    # A Headers object has already been through here, and can't have changed
+    # since.
+    if type(headers) is Headers:
+        return headers
     new_headers = []
     saw_content_length = False
     saw_transfer_encoding = False
@@ -92,6 +98,50 @@ def normalize_and_validate(headers):
         new_headers.append((name, value))
     return new_headers
 
+# Normalizing and validating a header list isn't free, and lots of code builds
+# the same list over and over (e.g. a server's standard response headers), or
+# passes a received list straight back out again (e.g. a proxy). So we also
+# provide an immutable variant that is normalized once, at construction, and
+# then passes through normalize_and_validate untouched. The parser produces
+# these for received messages.
+#
+# It compares equal to a plain list (or tuple) with the same contents, so code
+# that checks event.headers == [...] keeps working.
+class Headers(tuple):
+    """An immutable, pre-validated sequence of headers.
+
+    Constructing a :class:`Headers` object normalizes and validates the given
+    (name, value) pairs exactly once, following :ref:`the header normalization
+    rules <headers-format>`. After that, passing it as the ``headers`` of an
+    event skips normalization entirely, so if you send the same headers many
+    times, it's cheaper to build a :class:`Headers` once and reuse it.
+
+    Headers in events received from the peer are always :class:`Headers`
+    objects, so they can be forwarded without being re-checked.
+
+    """
+    __slots__ = ()
+
+    def __new__(cls, headers=()):
+        if type(headers) is cls:
+            return headers
+        return tuple.__new__(cls, normalize_and_validate(headers))
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple)):
+            return tuple.__eq__(self, tuple(other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        if isinstance(other, (list, tuple)):
+            return tuple.__ne__(self, tuple(other))
+        return NotImplemented
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return "Headers({!r})".format(list(self))
+
 def get_comma_header(headers, name, *, lowercase=True):
     # Should only be used for headers whose value is a list of comma-separated
     # values. Use lowercase=True for case-insensitive ones.
@@ -139,15 +189,17 @@ def get_comma_header(headers, name, *, lowercase=True):
                     out.append(found_split_value)
     return out
 
+# headers must be a (mutable) list that's already been normalized, so only the
+# new entries need checking.
 def set_comma_header(headers, name, new_values):
     name = bytesify(name).lower()
     new_headers = []
     for found_name, found_raw_value in headers:
         if found_name != name:
             new_headers.append((found_name, found_raw_value))
-    for new_value in new_values:
-        new_headers.append((name, new_value))
-    headers[:] = normalize_and_validate(new_headers)
+    new_headers += normalize_and_validate(
+        [(name, new_value) for new_value in new_values])
+    headers[:] = new_headers
 
 def has_expect_100_continue(request):
     # https://tools.ietf.org/html/rfc7231#section-5.1.1
@@ -158,3 +210,30 @@ def has_expect_100_continue(request):
     # Expect: 100-continue is case *sensitive*
     expect = get_comma_header(request.headers, "Expect", lowercase=False)
     return (b"100-continue" in expect)
+
+# "An origin server MUST NOT send a Date header field if it does not have a
+# clock capable of providing a reasonable approximation of the current instance
+# in Coordinated Universal Time. An origin server MAY send a Date header field
+# if the response is in the 1xx (Informational) or 5xx (Server Error) class of
+# status codes. An origin server MUST send a Date header field in all other
+# cases." -- https://tools.ietf.org/html/rfc7231#section-7.1.1.2
+#
+# Formatting the date is surprisingly expensive relative to everything else we
+# do per response, and it only changes once a second, so we cache the
+# formatted value for the current second. The cache is keyed on the second
+# itself, so it gives correct results no matter what clock is passed in (which
+# is what lets tests use a fake one).
+class DateCache:
+    def __init__(self):
+        self._second = None
+        self._value = None
+
+    def __call__(self, clock=time.time):
+        second = int(clock())
+        if second != self._second:
+            # IMF-fixdate, e.g. b"Sun, 06 Nov 1994 08:49:37 GMT"
+            self._value = formatdate(second, usegmt=True).encode("ascii")
+            self._second = second
+        return self._value
+
+get_date_header_value = DateCache()
@@ -0,0 +1,239 @@
+# Incremental parsing of multipart bodies (RFC 2046 sec 5.1, RFC 7578).
+#
+# Like content codings, this is really a property of the representation rather
+# than the HTTP framing, so it lives off to the side: nothing in Connection
+# knows about it. Instead, you feed it the payloads of the Data events that
+# Connection gives you, and it gives you back its own little events for the
+# parts it finds inside.
+#
+# The whole trick is to never buffer more than we have to. Part bodies are
+# streamed out as soon as we can be sure that the bytes we're handing over
+# aren't the beginning of a delimiter; the only thing we ever hold back is a
+# tail shorter than the delimiter itself. (See
+# ReceiveBuffer.extract_until_before.) Part headers do have to be buffered,
+# but they're small, and we cap them at max_header_size.
+
+import re
+
+from ._util import ProtocolError
+from ._events import _EventBundle
+from ._headers import Headers
+from ._readers import _decode_header_lines
+from ._receivebuffer import ReceiveBuffer
+
+__all__ = ["MultipartParser", "PartHeaders", "PartData", "PartEnd"]
+
+DEFAULT_MAX_PART_HEADER_SIZE = 16 * 1024
+
+class PartHeaders(_EventBundle):
+    """The beginning of a new part of a multipart body.
+
+    Fields:
+
+    .. attribute:: headers
+
+       The part's headers, as a :class:`Headers` object; see
+       :ref:`the header normalization rules <headers-format>` for details.
+
+    """
+    _fields = ["headers"]
+
+
+class PartData(_EventBundle):
+    """Part of the body of the current part.
+
+    Fields:
+
+    .. attribute:: data
+
+       A :term:`bytes-like object` containing some part body data. Like
+       :class:`Data`, there's no particular meaning to where one
+       :class:`PartData` event ends and the next begins.
+
+    """
+    _fields = ["data"]
+
+
+class PartEnd(_EventBundle):
+    """The end of the current part. Takes no fields.
+
+    """
+    _fields = []
+
+
+# RFC 2046 sec 5.1.1:
+#
+#     boundary := 0*69<bchars> bcharsnospace
+#     bchars := bcharsnospace / " "
+#     bcharsnospace := DIGIT / ALPHA / "'" / "(" / ")" /
+#                      "+" / "_" / "," / "-" / "." /
+#                      "/" / ":" / "=" / "?"
+_bchars = rb"0-9A-Za-z'()+_,\-./:=?"
+_boundary_re = re.compile(
+    rb"^[" + _bchars + rb" ]{0,69}[" + _bchars + rb"]$")
+_boundary_param_re = re.compile(
+    rb';[ \t]*boundary[ \t]*=[ \t]*'
+    rb'(?:"(?P<quoted>[^"]*)"|(?P<token>[^; \t]+))',
+    re.IGNORECASE)
+
+def _boundary_from_headers(headers):
+    for name, value in headers:
+        if name == b"content-type":
+            break
+    else:
+        raise ProtocolError("missing Content-Type header")
+    if not value.lower().startswith(b"multipart/"):
+        raise ProtocolError("Content-Type is not multipart")
+    match = _boundary_param_re.search(value)
+    if match is None:
+        raise ProtocolError("multipart Content-Type has no boundary")
+    if match.group("quoted") is not None:
+        return match.group("quoted")
+    return match.group("token")
+
+# Parser states
+_PREAMBLE = "PREAMBLE"
+_AFTER_DELIMITER = "AFTER_DELIMITER"
+_HEADERS = "HEADERS"
+_BODY = "BODY"
+_EPILOGUE = "EPILOGUE"
+_CLOSED = "CLOSED"
+
+class MultipartParser:
+    """An incremental parser for multipart bodies, such as
+    ``multipart/form-data`` uploads.
+
+    Args:
+        boundary (bytes): The boundary parameter from the message's
+            Content-Type header. See :meth:`from_headers`.
+
+        max_header_size (int): The maximum size of any one part's header
+            block. Exceeding this raises :exc:`ProtocolError`.
+
+    """
+    def __init__(self, boundary, *,
+                 max_header_size=DEFAULT_MAX_PART_HEADER_SIZE):
+        if isinstance(boundary, str):
+            boundary = boundary.encode("ascii")
+        if not _boundary_re.match(boundary):
+            raise ProtocolError("invalid multipart boundary {!r}"
+                                .format(boundary))
+        # The delimiter includes the CRLF that precedes it, which belongs to
+        # the delimiter rather than to the preceding part's body.
+        self._delimiter = b"\r\n--" + boundary
+        self._max_header_size = max_header_size
+        self._buf = ReceiveBuffer()
+        # The first delimiter is allowed to appear at the very start of the
+        # body, with no CRLF before it. Pretending there was one lets us treat
+        # it like all the others.
+        self._buf += b"\r\n"
+        self._state = _PREAMBLE
+
+    @classmethod
+    def from_headers(cls, headers, **kwargs):
+        """Create a parser using the boundary from a Content-Type header.
+
+        Args:
+            headers: The headers of the message whose body you want to parse,
+                e.g. ``request.headers``.
+
+        Any other keyword arguments are passed on to the constructor.
+
+        Raises :exc:`ProtocolError` if there's no Content-Type header, or it
+        isn't ``multipart/*``, or it doesn't have a valid boundary.
+
+        """
+        return cls(_boundary_from_headers(headers), **kwargs)
+
+    def receive_data(self, data):
+        """Parse some more of the multipart body.
+
+        Args:
+            data (bytes-like): The next piece of the body -- normally the
+                ``data`` from a :class:`Data` event -- or ``b""`` to indicate
+                that the body has ended (i.e., when you get the
+                :class:`EndOfMessage`).
+
+        Returns:
+            A list of :class:`PartHeaders`, :class:`PartData`, and
+            :class:`PartEnd` events. This may be empty.
+
+        Raises :exc:`ProtocolError` if the body isn't valid multipart, or it
+        ends before the closing delimiter.
+
+        """
+        if self._state is _CLOSED:
+            raise RuntimeError("received data after end of body")
+        if not data:
+            if (self._state is _AFTER_DELIMITER
+                  and bytes(self._buf).startswith(b"--")):
+                self._close_delimiter()
+            if self._state is not _EPILOGUE:
+                raise ProtocolError("multipart body ended before closing "
+                                    "delimiter")
+            self._state = _CLOSED
+            return []
+        if self._state is _EPILOGUE:
+            # The epilogue is discarded unseen.
+            return []
+        self._buf += data
+        events = []
+        while True:
+            if not self._step(events):
+                break
+        self._buf.compress()
+        return events
+
+    def _close_delimiter(self):
+        self._buf = ReceiveBuffer()
+        self._state = _EPILOGUE
+
+    # Tries to make some progress; returns False if we need more data first.
+    def _step(self, events):
+        if self._state is _PREAMBLE:
+            # The preamble is discarded unseen.
+            _, found = self._buf.extract_until_before(self._delimiter)
+            if not found:
+                return False
+            self._buf.maybe_extract_at_most(len(self._delimiter))
+            self._state = _AFTER_DELIMITER
+        elif self._state is _AFTER_DELIMITER:
+            # Either "--" for the closing delimiter, or optional whitespace
+            # ("transport padding"); then CRLF. (The CRLF is optional after
+            # the closing delimiter -- see receive_data.)
+            line = self._buf.maybe_extract_until_next(b"\r\n")
+            if line is None:
+                if len(self._buf) > self._max_header_size:
+                    if bytes(self._buf).startswith(b"--"):
+                        self._close_delimiter()
+                    else:
+                        raise ProtocolError(
+                            "multipart delimiter line too long")
+                return False
+            if line.startswith(b"--"):
+                self._close_delimiter()
+                return False
+            if line[:-2].strip(b" \t"):
+                raise ProtocolError("junk after multipart delimiter")
+            self._state = _HEADERS
+        elif self._state is _HEADERS:
+            lines = self._buf.maybe_extract_lines()
+            if lines is None:
+                if len(self._buf) > self._max_header_size:
+                    raise ProtocolError("multipart part headers too long")
+                return False
+            events.append(
+                PartHeaders(headers=Headers(_decode_header_lines(lines))))
+            self._state = _BODY
+        elif self._state is _BODY:
+            data, found = self._buf.extract_until_before(self._delimiter)
+            if data:
+                events.append(PartData(data=data))
+            if not found:
+                return False
+            self._buf.maybe_extract_at_most(len(self._delimiter))
+            events.append(PartEnd())
+            self._state = _AFTER_DELIMITER
+        else:
+            return False
+        return True
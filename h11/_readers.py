@@ -15,7 +15,9 @@
 # - or, for body readers, a dict of per-framing reader factories
 
 import re
+from functools import partial, lru_cache
 from ._util import ProtocolError, validate
+from ._headers import Headers
 from ._state import *
 from ._events import *
 
@@ -114,6 +116,191 @@ def _decode_header_lines(lines):
         matches = validate(header_field_re, line)
         yield (matches["field_name"], matches["field_value"])
 
+# The same thing, but incremental: this is the parser that we give to
+# ReceiveBuffer.maybe_extract_parsed_lines, so each header line is validated
+# as soon as it arrives.
+#
+# Continuation lines are the awkward part, since we can't know whether a
+# field is finished until we see the start of the next line. So we validate
+# each line as it comes in -- the first line of a field against
+# header_field_re, and any continuations just for legal characters, which
+# between them is exactly equivalent to validating the joined-up field -- and
+# only when a field has been continued do we go back and pull the name and
+# value out of the joined-up line.
+#
+# This is also where we enforce the optional limits on the number of header
+# fields and the length of each line.
+obs_fold_content_re = re.compile(br"[ \t\x21-\xff]*\Z")
+_FOLD_STARTS = (b" ", b"\t")
+
+class _HeaderLinesParser:
+    def __init__(self, max_header_line=None, max_header_count=None):
+        self._max_header_line = max_header_line
+        self._max_header_count = max_header_count
+        self._fields = []
+        # The raw line for the last field, and, if it's been continued, the
+        # joined-up line.
+        self._last_line = None
+        self._folded = None
+
+    def _finish_folded(self):
+        if self._folded is not None:
+            matches = validate(header_field_re, self._folded)
+            self._fields[-1] = (matches["field_name"], matches["field_value"])
+            self._folded = None
+
+    def _check_line_length(self, length):
+        if (self._max_header_line is not None
+              and length > self._max_header_line):
+            raise ProtocolError("header line too long",
+                                error_status_hint=431)
+
+    # Called by ReceiveBuffer with the length so far of a line that hasn't
+    # finished arriving; this may include the \r of its \r\n.
+    def check_partial_line(self, length):
+        self._check_line_length(length - 1)
+
+    def add_line(self, line):
+        self._check_line_length(len(line))
+        match = obs_fold_re.match(line)
+        if match:
+            if not self._fields:
+                raise ProtocolError("continuation line at start of headers")
+            rest = line[match.end():]
+            validate(obs_fold_content_re, rest)
+            if self._folded is None:
+                self._folded = bytearray(self._last_line)
+            self._folded += b" "
+            self._folded += rest
+            self._check_line_length(len(self._folded))
+        else:
+            self._finish_folded()
+            if (self._max_header_count is not None
+                  and len(self._fields) >= self._max_header_count):
+                raise ProtocolError("too many header fields",
+                                    error_status_hint=431)
+            matches = validate(header_field_re, line)
+            self._fields.append(
+                (matches["field_name"], matches["field_value"]))
+            self._last_line = line
+
+    # Equivalent to calling add_line on each of lines, but with the common
+    # case inlined, since this is the hot path when a whole block arrives at
+    # once.
+    def add_lines(self, lines):
+        fields = self._fields
+        max_header_line = self._max_header_line
+        max_header_count = self._max_header_count
+        for line in lines:
+            if self._folded is not None or line[:1] in _FOLD_STARTS:
+                self.add_line(line)
+                continue
+            if max_header_line is not None and len(line) > max_header_line:
+                self._check_line_length(len(line))
+            if (max_header_count is not None
+                  and len(fields) >= max_header_count):
+                raise ProtocolError("too many header fields",
+                                    error_status_hint=431)
+            matches = validate(header_field_re, line)
+            fields.append((matches["field_name"], matches["field_value"]))
+            self._last_line = line
+
+    def finish(self):
+        self._finish_folded()
+        return self._fields
+
+# Clients that send lots of requests on the same connection tend to send
+# exactly the same headers every time. So, optionally, we remember the raw
+# bytes of the last header block we parsed, and the Headers that came out of
+# it. While the next block matches the remembered one line for line, all we
+# do is compare bytes; if it turns out to be identical, we return the same
+# Headers object again, without having to parse or validate anything. As
+# soon as a line doesn't match, we go back and parse it all the normal way.
+class _HeaderBlockMemo:
+    def __init__(self):
+        self.raw = None
+        self.headers = None
+
+# And the version for a request/response head, which starts with a
+# request-line or status-line, and returns a Headers object.
+class _HeadParser(_HeaderLinesParser):
+    start_line_re = None
+    start_line_name = None
+    # The error_status_hint for an over-long start line
+    start_line_status_hint = 400
+
+    def __init__(self, max_start_line=None, memo=None, **kwargs):
+        _HeaderLinesParser.__init__(self, **kwargs)
+        self._max_start_line = max_start_line
+        self._start_line = None
+        self._memo = memo
+        # The header lines, for updating the memo.
+        self._lines = []
+        # How much of memo.raw we've matched, or None if it didn't.
+        self._memo_offset = None
+        if memo is not None and memo.raw is not None:
+            self._memo_offset = 0
+
+    def _check_line_length(self, length):
+        if self._start_line is not None:
+            _HeaderLinesParser._check_line_length(self, length)
+        elif (self._max_start_line is not None
+              and length > self._max_start_line):
+            raise ProtocolError(
+                "{} too long".format(self.start_line_name),
+                error_status_hint=self.start_line_status_hint)
+
+    def add_line(self, line):
+        if self._start_line is None:
+            self._check_line_length(len(line))
+            self._start_line = self._parse_start_line(line)
+            return
+        if self._memo is not None:
+            self._lines.append(line)
+            if self._memo_offset is not None:
+                raw = self._memo.raw
+                end = self._memo_offset + len(line)
+                if (raw.startswith(line, self._memo_offset)
+                      and raw.startswith(b"\r\n", end)):
+                    self._memo_offset = end + 2
+                    return
+                self._memo_mismatch()
+                return
+        _HeaderLinesParser.add_line(self, line)
+
+    def add_lines(self, lines):
+        if self._start_line is None:
+            self.add_line(lines[0])
+            del lines[0]
+        if self._memo is not None:
+            for line in lines:
+                self.add_line(line)
+        else:
+            _HeaderLinesParser.add_lines(self, lines)
+
+    def _parse_start_line(self, line):
+        return validate(self.start_line_re, line)
+
+    # Parse the lines that we skipped while they matched the memo.
+    def _memo_mismatch(self):
+        self._memo_offset = None
+        for line in self._lines:
+            _HeaderLinesParser.add_line(self, line)
+
+    def finish(self):
+        if self._start_line is None:
+            raise ProtocolError("missing start line")
+        memo = self._memo
+        if self._memo_offset is not None:
+            if self._memo_offset == len(memo.raw):
+                return self._start_line, memo.headers
+            self._memo_mismatch()
+        headers = Headers(_HeaderLinesParser.finish(self))
+        if memo is not None:
+            memo.raw = b"".join(line + b"\r\n" for line in self._lines)
+            memo.headers = headers
+        return self._start_line, headers
+
 # https://svn.tools.ietf.org/svn/wg/httpbis/specs/rfc7230.html#request.line
 #
 #   request-line   = method SP request-target SP HTTP-version CRLF
@@ -136,12 +323,97 @@ request_line = (
     .format(**globals()))
 request_line_re = re.compile(request_line.encode("ascii"))
 
-def maybe_read_from_IDLE_client(buf):
-    lines = buf.maybe_extract_lines()
-    if lines is None:
+def _parse_request_line(line):
+    matches = validate(request_line_re, line)
+    return (matches["method"], matches["target"], matches["http_version"])
+
+# Most servers see the same few request lines over and over -- health checks,
+# popular pages, hot API endpoints -- so we keep the most recently parsed ones
+# in an LRU cache. This is shared by every connection in the process, since a
+# single connection rarely repeats itself enough to be worth it.
+DEFAULT_REQUEST_LINE_CACHE_SIZE = 512
+# Longer request lines are never cached; they're unlikely to repeat, and we
+# don't want a cache full of them hogging memory.
+MAX_CACHED_REQUEST_LINE = 1024
+
+class RequestLineCache:
+    """The process-wide cache of parsed request lines.
+
+    There's a single instance of this class, :data:`request_line_cache`,
+    which is used by every :class:`Connection` in the process. When a request
+    line (e.g. ``GET /health HTTP/1.1``) has been seen recently, it's looked
+    up in the cache instead of being parsed and validated again. Only lines
+    that were valid are cached, and only lines up to 1024 bytes long.
+
+    .. attribute:: maxsize
+
+       The most request lines to remember; the least recently used are
+       discarded first. Setting this clears the cache (and the counters), and
+       setting it to 0 disables the cache entirely. The default is 512.
+
+    """
+    def __init__(self, maxsize=DEFAULT_REQUEST_LINE_CACHE_SIZE):
+        self.maxsize = maxsize
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, maxsize):
+        if maxsize < 0:
+            raise ValueError("maxsize must be non-negative")
+        self._maxsize = maxsize
+        if maxsize:
+            self._parse = lru_cache(maxsize)(_parse_request_line)
+        else:
+            self._parse = None
+
+    @property
+    def hits(self):
+        """How many request lines were found in the cache."""
+        return self._parse.cache_info().hits if self._parse else 0
+
+    @property
+    def misses(self):
+        """How many request lines had to be parsed (not counting any that
+        were too long to cache, or parsed while the cache was disabled)."""
+        return self._parse.cache_info().misses if self._parse else 0
+
+    def __len__(self):
+        return self._parse.cache_info().currsize if self._parse else 0
+
+    def clear(self):
+        """Empty the cache, and reset :attr:`hits` and :attr:`misses` to
+        zero."""
+        if self._parse:
+            self._parse.cache_clear()
+
+    def parse(self, line):
+        if self._parse is None or len(line) > MAX_CACHED_REQUEST_LINE:
+            return _parse_request_line(line)
+        return self._parse(bytes(line))
+
+request_line_cache = RequestLineCache()
+
+class _RequestHeadParser(_HeadParser):
+    start_line_name = "request line"
+    # 414 is "URI Too Long", which is what's almost certainly happening
+    start_line_status_hint = 414
+
+    def _parse_start_line(self, line):
+        return request_line_cache.parse(line)
+
+def _read_request(buf, parser_factory):
+    head = buf.maybe_extract_parsed_lines(parser_factory)
+    if head is None:
         return None
-    matches = validate(request_line_re, lines[0])
-    return Request(headers=list(_decode_header_lines(lines[1:])), **matches)
+    (method, target, http_version), headers = head
+    return Request(method=method, target=target, headers=headers,
+                   http_version=http_version)
+
+def maybe_read_from_IDLE_client(buf):
+    return _read_request(buf, _RequestHeadParser)
 
 # https://svn.tools.ietf.org/svn/wg/httpbis/specs/rfc7230.html#status.line
 #
@@ -161,23 +433,65 @@ status_line = (
     .format(**globals()))
 status_line_re = re.compile(status_line.encode("ascii"))
 
-def maybe_read_from_SEND_RESPONSE_server(buf):
-    lines = buf.maybe_extract_lines()
-    if lines is None:
+class _ResponseHeadParser(_HeadParser):
+    start_line_re = status_line_re
+    start_line_name = "status line"
+
+def _read_response(buf, parser_factory):
+    head = buf.maybe_extract_parsed_lines(parser_factory)
+    if head is None:
         return None
-    matches = validate(status_line_re, lines[0])
+    matches, headers = head
     status_code = matches["status_code"] = int(matches["status_code"])
     class_ = InformationalResponse if status_code < 200 else Response
-    return class_(headers=list(_decode_header_lines(lines[1:])), **matches)
+    return class_(headers=headers, **matches)
+
+def maybe_read_from_SEND_RESPONSE_server(buf):
+    return _read_response(buf, _ResponseHeadParser)
+
 
+# The body readers all support a "discarding" mode, which is used by
+# Connection.discard_incoming_body. In this mode they still parse the framing,
+# but skip over the body data without ever creating Data events for it.
+#
+# They also all take a max_body_size, and raise an error as early as they can
+# tell that the body is going to exceed it.
+#
+# Received headers are always Headers objects, even when there aren't any
+# trailers; since they're immutable, one empty one can be shared.
+_NO_TRAILERS = Headers()
+
+def _body_too_large():
+    return ProtocolError("message body exceeds max_body_size",
+                         error_status_hint=413)
 
 class ContentLengthReader:
-    def __init__(self, length):
+    discarding = False
+
+    def __init__(self, length, max_body_size=None):
+        if max_body_size is not None and length > max_body_size:
+            raise _body_too_large()
         self._length = length
 
+    # See Connection.bytes_needed.
+    @property
+    def bytes_needed(self):
+        return self._length
+
+    # Used by Connection.start_raw_body: returns whatever body data is
+    # already buffered, plus the number of bytes that are still to come, and
+    # from then on acts as if the whole body had been read.
+    def hand_off(self, buf):
+        data = buf.maybe_extract_at_most(self._length) or b""
+        remaining = self._length - len(data)
+        self._length = 0
+        return data, remaining
+
     def __call__(self, buf):
+        if self.discarding:
+            self._length -= buf.skip_at_most(self._length)
         if self._length == 0:
-            return EndOfMessage()
+            return EndOfMessage(headers=_NO_TRAILERS)
         data = buf.maybe_extract_at_most(self._length)
         if data is None:
             return None
@@ -206,7 +520,13 @@ chunk_header = (
 
 chunk_header_re = re.compile(chunk_header.encode("ascii"))
 class ChunkedReader:
-    def __init__(self):
+    discarding = False
+
+    def __init__(self, max_body_size=None, trailer_parser=None):
+        self._max_body_size = max_body_size
+        # The parser factory for the trailer; see configured_readers.
+        self._trailer_parser = trailer_parser or _HeaderLinesParser
+        self._body_size = 0
         self._bytes_in_chunk = 0
         # After reading a chunk, we have to throw away the trailing \r\n; if
         # this is >0 then we discard that many bytes before resuming regular
@@ -214,51 +534,92 @@ class ChunkedReader:
         self._bytes_to_discard = 0
         self._reading_trailer = False
 
-    def __call__(self, buf):
+    # See Connection.bytes_needed. We can't tell how long a chunk header or
+    # the trailer will be, only how much of the current chunk is left.
+    @property
+    def bytes_needed(self):
         if self._reading_trailer:
-            lines = buf.maybe_extract_lines()
-            if lines is None:
-                return None
-            return EndOfMessage(headers=list(_decode_header_lines(lines)))
+            return None
+        if self._bytes_in_chunk > 0:
+            return self._bytes_in_chunk + 2
         if self._bytes_to_discard > 0:
-            data = buf.maybe_extract_at_most(self._bytes_to_discard)
-            if data is None:
-                return None
-            self._bytes_to_discard -= len(data)
+            return self._bytes_to_discard
+        return None
+
+    def __call__(self, buf):
+        # We only loop when discarding; otherwise each pass either returns an
+        # event or runs out of data.
+        while True:
+            if self._reading_trailer:
+                fields = buf.maybe_extract_parsed_lines(self._trailer_parser)
+                if fields is None:
+                    return None
+                return EndOfMessage(headers=Headers(fields))
             if self._bytes_to_discard > 0:
+                self._bytes_to_discard -= buf.skip_at_most(
+                    self._bytes_to_discard)
+                if self._bytes_to_discard > 0:
+                    return None
+                # else, fall through and read some more
+            assert self._bytes_to_discard == 0
+            if self._bytes_in_chunk == 0:
+                # We need to refill our chunk count
+                chunk_header = buf.maybe_extract_until_next(b"\r\n")
+                if chunk_header is None:
+                    return None
+                matches = validate(chunk_header_re, chunk_header)
+                # XX FIXME: we discard chunk extensions. Does anyone care?
+                self._bytes_in_chunk = int(matches["chunk_size"], base=16)
+                self._body_size += self._bytes_in_chunk
+                if (self._max_body_size is not None
+                      and self._body_size > self._max_body_size):
+                    raise _body_too_large()
+                if self._bytes_in_chunk == 0:
+                    self._reading_trailer = True
+                    continue
+            assert self._bytes_in_chunk > 0
+            if self.discarding:
+                skipped = buf.skip_at_most(self._bytes_in_chunk)
+                if not skipped:
+                    return None
+                self._bytes_in_chunk -= skipped
+                if self._bytes_in_chunk == 0:
+                    self._bytes_to_discard = 2
+                continue
+            data = buf.maybe_extract_at_most(self._bytes_in_chunk)
+            if data is None:
                 return None
-            # else, fall through and read some more
-        assert self._bytes_to_discard == 0
-        if self._bytes_in_chunk == 0:
-            # We need to refill our chunk count
-            chunk_header = buf.maybe_extract_until_next(b"\r\n")
-            if chunk_header is None:
-                return None
-            matches = validate(chunk_header_re, chunk_header)
-            # XX FIXME: we discard chunk extensions. Does anyone care?
-            self._bytes_in_chunk = int(matches["chunk_size"], base=16)
+            self._bytes_in_chunk -= len(data)
             if self._bytes_in_chunk == 0:
-                self._reading_trailer = True
-                return self(buf)
-        assert self._bytes_in_chunk > 0
-        data = buf.maybe_extract_at_most(self._bytes_in_chunk)
-        if data is None:
-            return None
-        self._bytes_in_chunk -= len(data)
-        if self._bytes_in_chunk == 0:
-            self._bytes_to_discard = 2
-        return Data(data=data)
+                self._bytes_to_discard = 2
+            return Data(data=data)
 
 
 class Http10Reader:
+    discarding = False
+
+    def __init__(self, max_body_size=None):
+        self._max_body_size = max_body_size
+        self._body_size = 0
+
+    def _count(self, size):
+        self._body_size += size
+        if (self._max_body_size is not None
+              and self._body_size > self._max_body_size):
+            raise _body_too_large()
+
     def __call__(self, buf):
+        if self.discarding:
+            self._count(buf.skip_at_most(len(buf)))
+            return None
         data = buf.maybe_extract_at_most(999999999)
         if data is None:
             return None
+        self._count(len(data))
         return Data(data=data)
 
     def read_eof(self):
-        return EndOfMessage()
+        return EndOfMessage(headers=_NO_TRAILERS)
 
 def expect_nothing(buf):
     if buf:
@@ -283,3 +644,40 @@ READERS = {
         "http/1.0": Http10Reader,
     },
 }
+
+# Returns a copy of READERS whose head readers (and chunked trailer readers)
+# enforce the given limits (see _HeaderLinesParser and _HeadParser), and
+# optionally memoize header blocks (see _HeaderBlockMemo). Since the memo is
+# mutable, each connection needs its own.
+def configured_readers(memoize_headers=False, max_start_line=None,
+                       max_header_line=None, max_header_count=None):
+    memo = _HeaderBlockMemo() if memoize_headers else None
+    # The parser factories have to be created once and reused, since
+    # ReceiveBuffer uses their identity to tell whether a partially-parsed
+    # block belongs to the current reader.
+    request_parser = partial(
+        _RequestHeadParser, max_start_line=max_start_line,
+        max_header_line=max_header_line, max_header_count=max_header_count,
+        memo=memo)
+    response_parser = partial(
+        _ResponseHeadParser, max_start_line=max_start_line,
+        max_header_line=max_header_line, max_header_count=max_header_count,
+        memo=memo)
+    trailer_parser = partial(
+        _HeaderLinesParser, max_header_line=max_header_line,
+        max_header_count=max_header_count)
+
+    def read_request(buf):
+        return _read_request(buf, request_parser)
+
+    def read_response(buf):
+        return _read_response(buf, response_parser)
+
+    readers = dict(READERS)
+    readers[CLIENT, IDLE] = read_request
+    readers[SERVER, IDLE] = read_response
+    readers[SERVER, SEND_RESPONSE] = read_response
+    readers[SEND_BODY] = dict(READERS[SEND_BODY])
+    readers[SEND_BODY]["chunked"] = partial(
+        ChunkedReader, trailer_parser=trailer_parser)
+    return readers
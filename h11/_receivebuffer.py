@@ -20,6 +20,12 @@ class ReceiveBuffer:
         self._start = 0
         self._looked_at = 0
         self._looked_for = b""
+        # State for maybe_extract_parsed_lines; the offsets are absolute.
+        self._line_parser_factory = None
+        self._line_parser = None
+        self._line_block_start = 0
+        self._next_line = 0
+        self._line_searched = 0
 
     def __bool__(self):
         return bool(len(self))
@@ -35,8 +41,37 @@ class ReceiveBuffer:
         if self._start > 0:
             self._data = self._data[self._start:]
             self._looked_at -= self._start
+            self._line_block_start -= self._start
+            self._next_line -= self._start
+            self._line_searched -= self._start
             self._start -= self._start
 
+    # For speculative parsing: mark() saves the current position, and
+    # rewind() goes back to it, un-extracting everything extracted since.
+    # Don't call compress() in between.
+    def mark(self):
+        return self._start
+
+    def rewind(self, mark):
+        self._start = mark
+        # Whatever we remember about previous searches may have been about
+        # data after the mark, so forget it.
+        self._looked_at = mark
+        self._looked_for = b""
+        self._line_parser_factory = None
+
+    # Hands over the unprocessed data without copying it, and leaves us
+    # empty. We give up our reference to the old bytearray, so the caller
+    # ends up as its only owner.
+    def detach(self):
+        data = memoryview(self._data)[self._start:]
+        self._data = bytearray()
+        self._start = 0
+        self._looked_at = 0
+        self._looked_for = b""
+        self._line_parser_factory = None
+        return data
+
     def __iadd__(self, byteslike):
         self._data += byteslike
         return self
@@ -48,6 +83,14 @@ class ReceiveBuffer:
         self._start += len(out)
         return out
 
+    # Like maybe_extract_at_most, but throws the data away instead of
+    # returning it, which saves allocating a copy. Returns the number of
+    # bytes skipped.
+    def skip_at_most(self, count):
+        skipped = min(count, len(self))
+        self._start += skipped
+        return skipped
+
     def maybe_extract_until_next(self, needle):
         # Returns extracted bytes on success (advancing offset), or None on
         # failure
@@ -65,6 +108,35 @@ class ReceiveBuffer:
         self._start = new_start
         return out
 
+    # Extracts everything before the next occurrence of needle, leaving the
+    # needle itself in the buffer, and returns (data, True). If the needle
+    # isn't there yet, then extracts everything that definitely *can't* be
+    # part of it -- i.e., everything except a trailing partial match, which
+    # might be the start of a needle that's still arriving -- and returns
+    # (data, False). data may be empty. This is for streaming through data
+    # that's terminated by a delimiter, without having to buffer it all.
+    def extract_until_before(self, needle):
+        if self._looked_for == needle:
+            search_start = max(self._start, self._looked_at - len(needle) + 1)
+        else:
+            search_start = self._start
+        offset = self._data.find(needle, search_start)
+        if offset == -1:
+            self._looked_at = len(self._data)
+            self._looked_for = needle
+            end = len(self._data)
+            for i in range(min(len(needle) - 1, len(self)), 0, -1):
+                if self._data.endswith(needle[:i], self._start):
+                    end -= i
+                    break
+            found = False
+        else:
+            end = offset
+            found = True
+        out = self._data[self._start:end]
+        self._start = end
+        return out, found
+
     # HTTP/1.1 has a number of constructs where you keep reading lines until
     # you see a blank one. This does that, and then returns the lines.
     def maybe_extract_lines(self):
@@ -79,3 +151,62 @@ class ReceiveBuffer:
             assert lines[-2] == lines[-1] == b""
             del lines[-2:]
             return lines
+
+    # Like maybe_extract_lines, except that instead of waiting for the blank
+    # line and then returning all the lines at once, we hand each line to a
+    # parser as soon as its \r\n arrives. That way a bad line gets rejected
+    # right away, instead of after we've buffered everything up to the end of
+    # the block, and the work of parsing is spread over however many calls it
+    # takes for the block to arrive.
+    #
+    # parser_factory is called at the start of each block to get a parser;
+    # each line is passed to its add_line method, and once the blank line
+    # arrives we extract the whole block and return parser.finish(). Until
+    # then nothing is extracted, and we return None -- but we hang onto the
+    # parser and our position, so the next call carries on where this one
+    # left off. We also tell the parser how long the incomplete last line is
+    # so far, by calling its check_partial_line method, so that it can reject
+    # over-long lines without waiting for them to end. (If the caller
+    # switches to a different parser_factory partway through, then we start
+    # again from the top of the block.)
+    #
+    # Usually, though, the whole block arrives at once. So when we start a
+    # new block, we first check whether it's all here, and if so we split it
+    # up in one go and pass the list of lines to the parser's add_lines
+    # method, which saves a lot of overhead.
+    def maybe_extract_parsed_lines(self, parser_factory):
+        data = self._data
+        if (self._line_parser_factory is not parser_factory
+              or self._line_block_start != self._start):
+            start = self._start
+            # (If the block starts with a blank line, then the first \r\n\r\n
+            # might be in the next block.)
+            if not data.startswith(b"\r\n", start):
+                end = data.find(b"\r\n\r\n", start)
+                if end != -1:
+                    self._line_parser_factory = None
+                    parser = parser_factory()
+                    parser.add_lines(data[start:end].split(b"\r\n"))
+                    self._start = end + 4
+                    return parser.finish()
+            self._line_parser_factory = parser_factory
+            self._line_parser = parser_factory()
+            self._line_block_start = start
+            self._next_line = start
+            self._line_searched = start
+        add_line = self._line_parser.add_line
+        next_line = self._next_line
+        end = data.find(b"\r\n", max(next_line, self._line_searched - 1))
+        while end != -1:
+            if end == next_line:
+                parser = self._line_parser
+                self._line_parser_factory = self._line_parser = None
+                self._start = end + 2
+                return parser.finish()
+            line = data[next_line:end]
+            self._next_line = next_line = end + 2
+            add_line(line)
+            end = data.find(b"\r\n", next_line)
+        self._line_searched = len(data)
+        self._line_parser.check_partial_line(len(data) - next_line)
+        return None
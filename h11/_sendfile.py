@@ -0,0 +1,62 @@
+# A concrete body object for zero-copy file transmission.
+#
+# h11's body writers are careful to only ever call len() on Data payloads and
+# then hand them to the write callback unchanged (see the comment above
+# ContentLengthWriter in _writers.py), so anything with a __len__ can pass
+# through send_with_data_passthrough and come out the other side surrounded by
+# whatever framing bytes are needed. FileSegment is just the obvious such
+# object, so that every user doesn't have to invent their own placeholder and
+# I/O adapters have a single type to look for.
+
+__all__ = ["FileSegment"]
+
+class FileSegment:
+    """A reference to a range of bytes in an open file, for use as the
+    :attr:`Data.data` payload when sending a body with ``sendfile(2)``.
+
+    h11 never reads from the file itself; it only uses the length to do its
+    framing bookkeeping. It's up to your I/O code to notice these objects in
+    the list returned by :meth:`Connection.send_with_data_passthrough` and
+    transmit them using something like :func:`os.sendfile` or
+    :meth:`asyncio.loop.sendfile`. See :ref:`sendfile` for details.
+
+    .. attribute:: fd
+
+       The file descriptor to send from, as an integer. You can also pass
+       any object with a ``fileno()`` method, like an open file, and its
+       descriptor will be used.
+
+    .. attribute:: offset
+
+       The position in the file to start sending from.
+
+    .. attribute:: count
+
+       The number of bytes to send. ``len(segment)`` returns this.
+
+    """
+    def __init__(self, fd, offset, count):
+        if not isinstance(fd, int):
+            fd = fd.fileno()
+        if offset < 0:
+            raise ValueError("offset must be non-negative")
+        if count < 0:
+            raise ValueError("count must be non-negative")
+        self.fd = fd
+        self.offset = offset
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def fileno(self):
+        return self.fd
+
+    def __repr__(self):
+        return "FileSegment(fd={}, offset={}, count={})".format(
+            self.fd, self.offset, self.count)
+
+    def __eq__(self, other):
+        return (type(other) is FileSegment
+                and (self.fd, self.offset, self.count)
+                    == (other.fd, other.offset, other.count))
@@ -62,6 +62,12 @@ class BodyWriter:
         else:  # pragma: no cover
             assert False
 
+    # Will finishing this body require writing any more bytes? For most
+    # framings the answer is yes until EndOfMessage (at the very least there's
+    # a terminating chunk to send).
+    def more_expected(self):
+        return True
+
 #
 # These are all careful not to do anything to 'data' except call len(data) and
 # write(data). This allows us to transparently pass-through funny objects,
@@ -78,19 +84,56 @@ class ContentLengthWriter(BodyWriter):
             raise ProtocolError("Too much data for declared Content-Length")
         write(data)
 
+    def more_expected(self):
+        return self._length > 0
+
     def send_eom(self, headers, write):
         if self._length != 0:
             raise ProtocolError("Too little data for declared Content-Length")
         if headers:
             raise ProtocolError("Content-Length and trailers don't mix")
 
+# If coalesce_size is set, then small bytes-like payloads are accumulated and
+# sent as a single chunk once coalesce_size bytes have built up (or when
+# flush() is called, or at EndOfMessage), instead of paying for a chunk header
+# and trailer on every tiny write. Payloads that are already at least
+# coalesce_size long, or that aren't bytes-like at all (e.g. sendfile
+# placeholders), are written straight through after flushing whatever is
+# pending, so ordering is preserved.
 class ChunkedWriter(BodyWriter):
-    def send_data(self, data, write):
+    def __init__(self, coalesce_size=None):
+        self._coalesce_size = coalesce_size
+        self._pending = bytearray()
+
+    def _send_chunk(self, data, write):
         write(bytesmod(b"%x\r\n", (len(data),)))
         write(data)
         write(b"\r\n")
 
+    def send_data(self, data, write):
+        if (self._coalesce_size is not None
+            and isinstance(data, (bytes, bytearray, memoryview))
+            and len(data) < self._coalesce_size):
+            self._pending += data
+            if len(self._pending) >= self._coalesce_size:
+                self.flush(write)
+        else:
+            self.send_data_uncoalesced(data, write)
+
+    # Used by Connection.send_with_data_passthrough, which promises to hand
+    # back the exact object it was given, so can't copy it into _pending.
+    def send_data_uncoalesced(self, data, write):
+        self.flush(write)
+        self._send_chunk(data, write)
+
+    def flush(self, write):
+        if self._pending:
+            # Hand off the buffer itself rather than copying it
+            pending, self._pending = self._pending, bytearray()
+            self._send_chunk(pending, write)
+
     def send_eom(self, headers, write):
+        self.flush(write)
         write(b"0\r\n")
         write_headers(headers, write)
 
@@ -7,6 +7,8 @@ from http.server import SimpleHTTPRequestHandler
 import json
 from urllib.request import urlopen
 
+import pytest
+
 import h11
 
 @contextmanager
@@ -92,3 +94,39 @@ def test_h11_as_server():
     assert info["method"] == "GET"
     assert info["target"] == "/some-path"
     assert "urllib" in info["headers"]["user-agent"]
+
+class H11SendfileRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        with self.request as s:
+            c = h11.Connection(h11.SERVER)
+            done = False
+            while not done:
+                for event in c.receive_data(s.recv(10)):
+                    if type(event) is h11.EndOfMessage:
+                        done = True
+                        break
+            def send_all(data_list):
+                for data in data_list:
+                    if isinstance(data, h11.FileSegment):
+                        offset, count = data.offset, data.count
+                        while count:
+                            sent = os.sendfile(
+                                s.fileno(), data.fd, offset, count)
+                            offset += sent
+                            count -= sent
+                    else:
+                        s.sendall(data)
+            with open(test_file_path, "rb") as f:
+                send_all(c.send_with_data_passthrough(
+                    h11.Response(status_code=200, headers=[])))
+                send_all(c.send_with_data_passthrough(h11.Data(
+                    data=h11.FileSegment(f, 0, len(test_file_data)))))
+                send_all(c.send_with_data_passthrough(h11.EndOfMessage()))
+
+@pytest.mark.skipif(not hasattr(os, "sendfile"), reason="needs os.sendfile")
+def test_h11_as_server_with_sendfile():
+    with socket_server(H11SendfileRequestHandler) as httpd:
+        host, port = httpd.server_address
+        with urlopen("http://{}:{}/".format(host, port)) as f:
+            assert f.getcode() == 200
+            assert f.read() == test_file_data
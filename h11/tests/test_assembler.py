@@ -0,0 +1,222 @@
+import gzip
+
+import pytest
+
+from .._util import ProtocolError
+from .._events import *
+from .._state import *
+from .._connection import Connection
+from .._assembler import MessageAssembler, SpooledBody
+
+def feed(assembler, conn, data):
+    done = []
+    for event in conn.receive_data(data):
+        if assembler.receive_event(event):
+            body = assembler.body
+            if isinstance(body, SpooledBody):
+                body = body.read()
+            done.append((assembler.head, bytes(body), assembler.trailers))
+    return done
+
+def test_MessageAssembler_content_length():
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn)
+    assert feed(a, conn,
+                b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n"
+                b"12345") == []
+    ((head, body, trailers),) = feed(a, conn, b"67890")
+    assert head.target == b"/"
+    assert body == b"1234567890"
+    assert trailers == []
+    # The body is a normal resizable bytearray, even though it was
+    # preallocated at the declared size
+    assert type(a.body) is bytearray
+    a.body += b"x"
+    assert a.body == b"1234567890x"
+
+def test_MessageAssembler_chunked_and_http10():
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn)
+    ((head, body, trailers),) = feed(
+        a, conn,
+        b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"3\r\nabc\r\n2\r\nde\r\n0\r\nSome: trailer\r\n\r\n")
+    assert body == b"abcde"
+    assert trailers == [(b"some", b"trailer")]
+
+    conn.send(Response(status_code=200, headers=[]))
+    conn.send(EndOfMessage())
+    conn.prepare_to_reuse()
+    ((head, body, trailers),) = feed(
+        a, conn, b"GET /2 HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert head.target == b"/2"
+    assert body == b""
+
+    conn = Connection(CLIENT)
+    a = MessageAssembler(conn)
+    conn.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    conn.send(EndOfMessage())
+    assert feed(a, conn, b"HTTP/1.0 100 Continue\r\n\r\n") == []
+    assert feed(a, conn, b"HTTP/1.0 200 OK\r\n\r\nhello ") == []
+    ((head, body, trailers),) = feed(a, conn, b"world") + feed(a, conn, b"")
+    assert head.status_code == 200
+    assert body == b"hello world"
+
+def test_MessageAssembler_HEAD():
+    conn = Connection(CLIENT)
+    a = MessageAssembler(conn)
+    conn.send(Request(method="HEAD", target="/", headers=[("Host", "a")]))
+    conn.send(EndOfMessage())
+    assert conn.request_method == b"HEAD"
+    ((head, body, _),) = feed(
+        a, conn, b"HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\n")
+    assert body == b""
+
+def test_MessageAssembler_decode_content():
+    conn = Connection(SERVER, decode_content=True)
+    a = MessageAssembler(conn)
+    compressed = gzip.compress(b"x" * 100)
+    ((_, body, _),) = feed(
+        a, conn,
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Encoding: gzip\r\n"
+        + "Content-Length: {}\r\n\r\n".format(len(compressed)).encode("ascii")
+        + compressed)
+    assert body == b"x" * 100
+
+def test_MessageAssembler_max_body_size():
+    # Declared length is checked before any body arrives
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn, max_body_size=10)
+    with pytest.raises(ProtocolError) as excinfo:
+        feed(a, conn,
+             b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 11\r\n\r\n")
+    assert excinfo.value.error_status_hint == 413
+
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn, max_body_size=10)
+    ((_, body, _),) = feed(
+        a, conn,
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n"
+        b"1234567890")
+    assert body == b"1234567890"
+
+    # Unknown length is checked as it goes
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn, max_body_size=10)
+    feed(a, conn,
+         b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n"
+         b"a\r\n1234567890\r\n")
+    with pytest.raises(ProtocolError) as excinfo:
+        feed(a, conn, b"1\r\nx\r\n")
+    assert excinfo.value.error_status_hint == 413
+
+def test_MessageAssembler_errors():
+    a = MessageAssembler(Connection(SERVER))
+    with pytest.raises(RuntimeError):
+        a.receive_event(Data(data=b"x"))
+    with pytest.raises(RuntimeError):
+        a.receive_event(EndOfMessage())
+    assert not a.receive_event(ConnectionClosed())
+
+    # A Content-Length body that we didn't get all of
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn)
+    feed(a, conn,
+         b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\nab")
+    conn.discard_incoming_body()
+    with pytest.raises(RuntimeError):
+        feed(a, conn, b"cdefghij")
+
+def test_SpooledBody(tmpdir):
+    # Stays in memory up to the threshold
+    body = SpooledBody(spool_threshold=10)
+    body.write(b"12345")
+    body.write(b"67890")
+    assert not body.rolled_over
+    assert body.file is None
+    body._finish()
+    assert len(body) == 10
+    assert body.read() == b"1234567890"
+    assert body.getbuffer() == b"1234567890"
+
+    # ...and then rolls over
+    body = SpooledBody(spool_threshold=10, dir=str(tmpdir))
+    body.write(b"12345")
+    body.write(b"678901")
+    assert body.rolled_over
+    body.write(b"2")
+    body._finish()
+    assert len(body) == 12
+    assert body.file.read() == b"123456789012"
+    assert body.read() == b"123456789012"
+    with body:
+        view = body.getbuffer()
+        assert view == b"123456789012"
+        assert view.readonly
+        assert body.getbuffer() is view
+    assert body.file.closed
+    # Nothing left behind
+    assert tmpdir.listdir() == []
+
+    # A known length over the threshold goes straight to disk
+    body = SpooledBody(11, spool_threshold=10)
+    assert body.rolled_over
+    body.write(b"x" * 11)
+    body._finish()
+    with body:
+        assert body.getbuffer() == b"x" * 11
+
+    # A known length under the threshold is preallocated
+    body = SpooledBody(10, spool_threshold=10)
+    assert not body.rolled_over
+    body.write(b"x" * 10)
+    body._finish()
+    assert body.file is None
+    assert len(body) == 10
+    assert body.read() == b"x" * 10
+
+    # Empty bodies on disk can still be viewed
+    body = SpooledBody(0, spool_threshold=-1)
+    body._finish()
+    assert body.rolled_over
+    with body:
+        assert body.getbuffer() == b""
+
+def test_MessageAssembler_spooling():
+    conn = Connection(SERVER)
+    a = MessageAssembler(conn, spool_threshold=5)
+    assert feed(a, conn,
+                b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n"
+                b"12345") == []
+    ((_, body, _),) = feed(a, conn, b"67890")
+    assert body == b"1234567890"
+    with a.body as body:
+        assert isinstance(body, SpooledBody)
+        assert body.rolled_over
+        assert body.file.read() == b"1234567890"
+        body.file.seek(0)
+        assert body.getbuffer() == b"1234567890"
+
+    def next_request(body):
+        conn.send(Response(status_code=200, headers=[]))
+        conn.send(EndOfMessage())
+        conn.prepare_to_reuse()
+        return feed(a, conn,
+                    b"POST / HTTP/1.1\r\nHost: a\r\n"
+                    b"Transfer-Encoding: chunked\r\n\r\n"
+                    + body + b"0\r\n\r\n")
+
+    # Bodies up to the threshold stay in memory...
+    assert next_request(b"3\r\nabc\r\n")
+    assert not a.body.rolled_over
+    assert a.body.file is None
+    assert a.body.read() == b"abc"
+    assert next_request(b"3\r\nabc\r\n2\r\nde\r\n")
+    assert not a.body.rolled_over
+    assert a.body.read() == b"abcde"
+    # ...and go to disk once they pass it
+    assert next_request(b"3\r\nabc\r\n3\r\ndef\r\n")
+    with a.body as body:
+        assert body.rolled_over
+        assert len(body) == 6
+        assert body.file.read() == b"abcdef"
@@ -0,0 +1,231 @@
+import gzip
+import zlib
+
+import pytest
+
+from .._util import ProtocolError
+from .._events import *
+from .._receivebuffer import ReceiveBuffer
+from .._readers import ContentLengthReader, ChunkedReader, Http10Reader
+from .._compression import (
+    ContentDecodingReader, decoding_reader, ContentEncodingWriter, accepts_gzip,
+)
+
+from .helpers import normalize_data_events
+
+def read_all(reader, buf, eof=False):
+    events = []
+    while True:
+        event = reader(buf)
+        if event is None:
+            if eof and hasattr(reader, "read_eof"):
+                event = reader.read_eof()
+            else:
+                break
+        events.append(event)
+        if type(event) is EndOfMessage:
+            break
+    return events
+
+def makebuf(data):
+    buf = ReceiveBuffer()
+    buf += data
+    return buf
+
+def test_decoding_reader_selection():
+    r = ContentLengthReader(10)
+    assert decoding_reader(r, [], 100, None) is r
+    assert decoding_reader(r, [(b"content-encoding", b"br")], 100, None) is r
+    assert decoding_reader(
+        r, [(b"content-encoding", b"gzip, gzip")], 100, None) is r
+    for coding in [b"gzip", b"x-gzip", b"deflate", b"GZIP"]:
+        d = decoding_reader(
+            r, [(b"content-encoding", coding)], 100, None)
+        assert type(d) is ContentDecodingReader
+
+def test_ContentDecodingReader():
+    body = b"hello world " * 1000
+    for coding, compressed in [(b"gzip", gzip.compress(body)),
+                               (b"deflate", zlib.compress(body))]:
+        # All at once
+        r = ContentDecodingReader(
+            ContentLengthReader(len(compressed)), coding, 10 ** 6, None)
+        events = read_all(r, makebuf(compressed))
+        assert normalize_data_events(events) == [Data(data=body),
+                                                 EndOfMessage()]
+
+        # Byte at a time, with bounded output size per event
+        r = ContentDecodingReader(
+            ContentLengthReader(len(compressed)), coding, 100, None)
+        buf = ReceiveBuffer()
+        events = []
+        for i in range(len(compressed)):
+            buf += compressed[i:i + 1]
+            events += read_all(r, buf)
+        assert all(len(e.data) <= 100 for e in events if type(e) is Data)
+        assert normalize_data_events(events) == [Data(data=body),
+                                                 EndOfMessage()]
+
+    # Chunked, with trailers
+    compressed = gzip.compress(body)
+    chunked = (("%x\r\n" % len(compressed)).encode("ascii")
+               + compressed + b"\r\n"
+               + b"0\r\nEtag: x\r\n\r\n")
+    r = ContentDecodingReader(ChunkedReader(), b"gzip", 1000, None)
+    events = read_all(r, makebuf(chunked))
+    assert normalize_data_events(events) == [
+        Data(data=body), EndOfMessage(headers=[("Etag", "x")])]
+
+    # Multi-member gzip
+    compressed = gzip.compress(b"abc") + gzip.compress(b"def")
+    r = ContentDecodingReader(
+        ContentLengthReader(len(compressed)), b"gzip", 1000, None)
+    events = read_all(r, makebuf(compressed))
+    assert normalize_data_events(events) == [Data(data=b"abcdef"),
+                                             EndOfMessage()]
+
+    # Empty body
+    r = ContentDecodingReader(ContentLengthReader(0), b"gzip", 1000, None)
+    assert read_all(r, makebuf(b"")) == [EndOfMessage()]
+
+    # HTTP/1.0-style bodies, where the EOF delivers EndOfMessage
+    compressed = gzip.compress(body)
+    r = ContentDecodingReader(Http10Reader(), b"gzip", 100, None)
+    assert hasattr(r, "read_eof")
+    events = read_all(r, makebuf(compressed), eof=True)
+    assert normalize_data_events(events) == [Data(data=body),
+                                             EndOfMessage()]
+    assert not hasattr(
+        ContentDecodingReader(ContentLengthReader(1), b"gzip", 100, None),
+        "read_eof")
+
+def test_ContentDecodingReader_errors():
+    # Garbage
+    r = ContentDecodingReader(ContentLengthReader(5), b"gzip", 100, None)
+    with pytest.raises(ProtocolError):
+        read_all(r, makebuf(b"12345"))
+
+    # Truncated
+    compressed = gzip.compress(b"x" * 100)[:-4]
+    r = ContentDecodingReader(
+        ContentLengthReader(len(compressed)), b"gzip", 1000, None)
+    with pytest.raises(ProtocolError):
+        read_all(r, makebuf(compressed))
+
+    # Trailing junk after deflate
+    compressed = zlib.compress(b"x") + b"junk"
+    r = ContentDecodingReader(
+        ContentLengthReader(len(compressed)), b"deflate", 1000, None)
+    with pytest.raises(ProtocolError):
+        read_all(r, makebuf(compressed))
+
+    # Decompression bomb
+    compressed = gzip.compress(b"\x00" * 10 ** 6)
+    r = ContentDecodingReader(
+        ContentLengthReader(len(compressed)), b"gzip", 1000, 100)
+    with pytest.raises(ProtocolError) as excinfo:
+        read_all(r, makebuf(compressed))
+    assert excinfo.value.error_status_hint == 413
+    # ...but no problem if the limit is disabled
+    r = ContentDecodingReader(
+        ContentLengthReader(len(compressed)), b"gzip", 1000, None)
+    events = read_all(r, makebuf(compressed))
+    assert len(normalize_data_events(events)[0].data) == 10 ** 6
+
+def test_accepts_gzip():
+    def t(value):
+        return accepts_gzip([(b"accept-encoding", value)])
+    assert not accepts_gzip([])
+    assert t(b"gzip")
+    assert t(b"deflate, gzip")
+    assert t(b"x-gzip")
+    assert t(b"gzip;q=0.5")
+    assert t(b"gzip ; q=1.0, identity; q=0.5")
+    assert not t(b"gzip;q=0")
+    assert not t(b"gzip;q=0.000")
+    assert not t(b"gzip;q=garbage")
+    assert not t(b"deflate, br")
+    assert t(b"*")
+    assert not t(b"*;q=0")
+    assert not t(b"gzip;q=0, *")
+    assert not t(b"identity")
+
+def test_ContentEncodingWriter():
+    from .._writers import ChunkedWriter
+    from .test_io import dowrite
+
+    body = b"hello world " * 1000
+    w = ContentEncodingWriter(ChunkedWriter(), 6, False)
+    assert w.more_expected()
+    wire = dowrite(w, Data(data=body[:6000]))
+    wire += dowrite(w, Data(data=body[6000:]))
+    wire += dowrite(w, EndOfMessage(headers=[("Etag", "x")]))
+    r = ContentDecodingReader(ChunkedReader(), b"gzip", 10 ** 6, None)
+    events = read_all(r, makebuf(wire))
+    assert normalize_data_events(events) == [
+        Data(data=body), EndOfMessage(headers=[("Etag", "x")])]
+    assert len(wire) < len(body) / 10
+
+    # Sync flush makes each write independently decodable
+    w = ContentEncodingWriter(ChunkedWriter(), 6, True)
+    wire = dowrite(w, Data(data=b"first"))
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    r = ChunkedReader()
+    buf = makebuf(wire)
+    assert d.decompress(bytes(r(buf).data)) == b"first"
+
+    # Explicit flush, passed through to the inner writer
+    w = ContentEncodingWriter(ChunkedWriter(coalesce_size=10 ** 6), 6, False)
+    assert dowrite(w, Data(data=b"second")) == b""
+    got = []
+    w.flush(got.append)
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    assert d.decompress(bytes(ChunkedReader()(makebuf(b"".join(got))).data)
+                        ) == b"second"
+
+    # Placeholders can't be compressed
+    with pytest.raises(TypeError):
+        dowrite(w, Data(data=object()))
+
+def test_parallel_gzip():
+    from concurrent.futures import ThreadPoolExecutor
+    from .._compression import parallel_gzip
+
+    body = bytes(range(256)) * 4000 + b"hello" * 20000
+    pieces = [body[i:i + 7777] for i in range(0, len(body), 7777)]
+
+    with ThreadPoolExecutor(4) as executor:
+        out = list(parallel_gzip(pieces, executor, block_size=10000,
+                                 max_pending=3))
+    assert gzip.decompress(b"".join(out)) == body
+    # Priming each block with the previous block's tail means that
+    # back-references work across block boundaries, so even though this body
+    # is split into >100 blocks it still compresses well
+    assert len(b"".join(out)) < len(body) / 50
+
+    # Creates its own executor if needed
+    assert gzip.decompress(b"".join(parallel_gzip([body]))) == body
+    assert gzip.decompress(
+        b"".join(parallel_gzip(pieces, block_size=10000, workers=2))) == body
+
+    # Empty input is still a valid gzip stream
+    assert gzip.decompress(b"".join(parallel_gzip([]))) == b""
+    assert gzip.decompress(b"".join(parallel_gzip([b"", b""]))) == b""
+
+    # And it can be sent through a Connection and decoded on the other side
+    from .._connection import Connection
+    from .._state import CLIENT, SERVER
+    server = Connection(SERVER)
+    client = Connection(CLIENT, decode_content=True,
+                        max_decompression_ratio=None)
+    wire = client.send(Request(method="GET", target="/",
+                               headers=[("Host", "a")]))
+    wire += client.send(EndOfMessage())
+    server.receive_data(wire)
+    wire = server.send(Response(status_code=200,
+                                headers=[("Content-Encoding", "gzip")]))
+    for piece in parallel_gzip(pieces, block_size=10000):
+        wire += server.send(Data(data=piece))
+    wire += server.send(EndOfMessage())
+    events = normalize_data_events(client.receive_data(wire))
+    assert events[1:] == [Data(data=body), EndOfMessage()]
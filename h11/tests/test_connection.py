@@ -3,12 +3,16 @@ import pytest
 from .._util import ProtocolError
 from .._events import *
 from .._state import *
+from .._sendfile import FileSegment
+from .._headers import Headers
+from .._readers import request_line_cache
 from .._connection import (
-    _keep_alive, _body_framing,
-    Connection,
+    _keep_alive, _keep_alive_params, _body_framing,
+    Connection, NEED_DATA, RECEIVE_BUFFERED, NEED_TO_SEND, SEND_100_CONTINUE,
+    PAUSED,
 )
 
-from .helpers import ConnectionPair
+from .helpers import ConnectionPair, normalize_data_events
 
 def test__keep_alive():
     assert _keep_alive(
@@ -33,6 +37,17 @@ def test__keep_alive():
     assert not _keep_alive(
         Response(status_code=200, headers=[], http_version="1.0"))
 
+    # HTTP/1.0 keep-alive is opt-in
+    for event in [Request(method="GET", target="/", http_version="1.0",
+                          headers=[("Connection", "Keep-Alive")]),
+                  Response(status_code=200, http_version="1.0",
+                           headers=[("Connection", "keep-alive")])]:
+        assert not _keep_alive(event)
+        assert _keep_alive(event, http10_keep_alive=True)
+    assert not _keep_alive(
+        Request(method="GET", target="/", headers=[], http_version="1.0"),
+        http10_keep_alive=True)
+
 
 def test__body_framing():
     def headers(cl, te):
@@ -540,6 +555,15 @@ def test_protocol_switch():
                 Paused(reason=SWITCHED_PROTOCOL),
             ]
             assert conn.trailing_data == (b"123456", False)
+            data, closed = conn.detach_receive_buffer()
+            assert type(data) is memoryview
+            assert (data, closed) == (b"123456", False)
+            with pytest.raises(RuntimeError):
+                conn.detach_receive_buffer()
+            with pytest.raises(RuntimeError):
+                conn.trailing_data
+            with pytest.raises(RuntimeError):
+                conn.receive_data(b"789")
 
         # Pausing in might-switch, then recovery
         # (weird artificial case where the trailing data actually is valid
@@ -554,6 +578,9 @@ def test_protocol_switch():
             Paused(reason=MIGHT_SWITCH_PROTOCOL),
         ]
         assert sc.trailing_data == (b"GET / HTTP/1.0\r\n\r\n", False)
+        # Not until the switch is accepted
+        with pytest.raises(RuntimeError):
+            sc.detach_receive_buffer()
         sc.send(deny)
         assert sc.receive_data(None) == [
             Paused(reason=DONE),
@@ -766,6 +793,17 @@ def test_sendfile():
     assert data == [placeholder]
     assert c.our_state is SEND_BODY
 
+    # FileSegment gets the same treatment, including when chunk coalescing is
+    # enabled
+    segment = FileSegment(0, 5, 10)
+    c = Connection(SERVER, chunk_coalesce_size=100)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    c.send(Response(status_code=200, headers=[]))
+    assert c.send(Data(data=b"abc")) == b""
+    data = c.send_with_data_passthrough(Data(data=segment))
+    assert data[-2] is segment
+    assert b"".join(data[:-2] + data[-1:]) == b"3\r\nabc\r\na\r\n\r\n"
+
 def test_errors():
     # After a receive error, you can't receive
     for role in [CLIENT, SERVER]:
@@ -837,3 +875,1001 @@ def test_408_request_timeout():
     # anything from client
     p = ConnectionPair()
     p.send(SERVER, Response(status_code=408, headers=[]))
+
+def test_send_message():
+    def setup(request_bytes=b"GET / HTTP/1.1\r\nHost: a\r\n\r\n"):
+        c = Connection(SERVER)
+        c.receive_data(request_bytes)
+        return c
+
+    # Content-Length is filled in automatically
+    c = setup()
+    assert (c.send_message(Response(status_code=200, headers=[]), b"hello")
+            == b"HTTP/1.1 200 \r\ncontent-length: 5\r\n\r\nhello")
+    assert c.our_state is DONE
+    c.prepare_to_reuse()
+
+    # ...including for an empty body
+    c = setup()
+    assert (c.send_message(Response(status_code=200, headers=[]))
+            == b"HTTP/1.1 200 \r\ncontent-length: 0\r\n\r\n")
+    assert c.our_state is DONE
+
+    # The user's headers list isn't mutated
+    c = setup()
+    headers = [("Content-Type", "text/plain")]
+    c.send_message(Response(status_code=200, headers=headers), b"x")
+    assert headers == [("Content-Type", "text/plain")]
+
+    # Same output as sending the events one at a time
+    p = ConnectionPair()
+    p.send(CLIENT,
+           [Request(method="GET", target="/", headers=[("Host", "a")]),
+            EndOfMessage()])
+    c = Connection(SERVER)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert (c.send_message(Response(status_code=200,
+                                    headers=[("Content-Length", "3")]),
+                           b"abc")
+            == p.send(SERVER,
+                      [Response(status_code=200,
+                                headers=[("Content-Length", "3")]),
+                       Data(data=b"abc"),
+                       EndOfMessage()],
+                      expect=[Response(status_code=200,
+                                       headers=[("Content-Length", "3")]),
+                              Data(data=b"abc"),
+                              EndOfMessage()]))
+
+    # Trailers force chunked framing
+    c = setup()
+    assert (c.send_message(Response(status_code=200, headers=[]), b"hello",
+                           trailers=[("Foo", "bar")])
+            == b"HTTP/1.1 200 \r\ntransfer-encoding: chunked\r\n\r\n"
+               b"5\r\nhello\r\n0\r\nfoo: bar\r\n\r\n")
+
+    # Explicit framing headers are respected and validated
+    c = setup()
+    with pytest.raises(ProtocolError):
+        c.send_message(Response(status_code=200,
+                                headers=[("Content-Length", "10")]),
+                       b"hello")
+    assert c.our_state is ERROR
+
+    # Responses that can't have a body don't get a Content-Length
+    c = setup(b"HEAD / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert (c.send_message(Response(status_code=200, headers=[]))
+            == b"HTTP/1.1 200 \r\n\r\n")
+    c = setup()
+    assert (c.send_message(Response(status_code=204, headers=[]))
+            == b"HTTP/1.1 204 \r\n\r\n")
+
+    # Works for clients too
+    c = Connection(CLIENT)
+    assert (c.send_message(Request(method="POST", target="/",
+                                   headers=[("Host", "a")]),
+                           b"xyz")
+            == b"POST / HTTP/1.1\r\nhost: a\r\ncontent-length: 3\r\n\r\nxyz")
+    assert c.our_state is DONE
+
+    with pytest.raises(TypeError):
+        Connection(CLIENT).send_message(Data(data=b"1"))
+
+def test_chunk_coalescing():
+    with pytest.raises(ValueError):
+        Connection(SERVER, chunk_coalesce_size=0)
+
+    c = Connection(SERVER, chunk_coalesce_size=100)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert c.flush() == b""
+    c.send(Response(status_code=200, headers=[]))
+    pieces = []
+    for i in range(10):
+        pieces.append(c.send(Data(data=b"x" * 5)))
+    assert pieces == [b""] * 10
+    assert c.flush() == b"32\r\n" + b"x" * 50 + b"\r\n"
+    assert c.flush() == b""
+    assert c.send(Data(data=b"y" * 5)) == b""
+    assert (c.send(EndOfMessage())
+            == b"5\r\nyyyyy\r\n0\r\n\r\n")
+    assert c.our_state is DONE
+    assert c.flush() == b""
+
+    # send_with_data_passthrough still returns the exact object
+    c = Connection(SERVER, chunk_coalesce_size=100)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    c.send(Response(status_code=200, headers=[]))
+    assert c.send(Data(data=b"x" * 5)) == b""
+    data = b"y" * 5
+    out = c.send_with_data_passthrough(Data(data=data))
+    assert b"".join(out) == b"5\r\nxxxxx\r\n5\r\nyyyyy\r\n"
+    assert any(piece is data for piece in out)
+
+    # Content-Length bodies are unaffected
+    c = Connection(SERVER, chunk_coalesce_size=100)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    c.send(Response(status_code=200, headers=[("Content-Length", "5")]))
+    assert c.send(Data(data=b"x" * 5)) == b"x" * 5
+
+def test_add_date_header():
+    def clock():
+        return 784111777
+
+    c = Connection(SERVER, add_date_header=True, clock=clock)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert (c.send(Response(status_code=200,
+                            headers=[("Content-Length", "0")]))
+            == b"HTTP/1.1 200 \r\ncontent-length: 0\r\n"
+               b"date: Sun, 06 Nov 1994 08:49:37 GMT\r\n\r\n")
+
+    # A user-supplied Date: wins
+    c = Connection(SERVER, add_date_header=True, clock=clock)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert (c.send(Response(status_code=200,
+                            headers=[("Date", "whenever"),
+                                     ("Content-Length", "0")]))
+            == b"HTTP/1.1 200 \r\ndate: whenever\r\ncontent-length: 0\r\n\r\n")
+
+    # Off by default, and never added to informational responses
+    c = Connection(SERVER)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert b"date" not in c.send(Response(status_code=200, headers=[]))
+    c = Connection(SERVER, add_date_header=True, clock=clock)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert (c.send(InformationalResponse(status_code=100, headers=[]))
+            == b"HTTP/1.1 100 \r\n\r\n")
+
+def test_more_to_send():
+    c = Connection(SERVER)
+    assert not c.more_to_send
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert not c.more_to_send
+    c.send(InformationalResponse(status_code=100, headers=[]))
+    # 100 Continue should go out immediately
+    assert not c.more_to_send
+    c.send(Response(status_code=200, headers=[("Content-Length", "5")]))
+    assert c.more_to_send
+    c.send(Data(data=b"123"))
+    assert c.more_to_send
+    c.send(Data(data=b"45"))
+    assert not c.more_to_send
+    c.send(EndOfMessage())
+    assert not c.more_to_send
+
+    # Empty body
+    c = Connection(SERVER)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    c.send(Response(status_code=204, headers=[]))
+    assert not c.more_to_send
+
+    # Chunked: there's always at least the final chunk to come
+    c = Connection(SERVER)
+    c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    c.send(Response(status_code=200, headers=[]))
+    assert c.more_to_send
+    c.send(Data(data=b"123"))
+    assert c.more_to_send
+    c.send(EndOfMessage())
+    assert not c.more_to_send
+
+    # Clients too
+    c = Connection(CLIENT)
+    c.send(Request(method="POST", target="/",
+                   headers=[("Host", "a"), ("Content-Length", "1")]))
+    assert c.more_to_send
+    c.send(Data(data=b"1"))
+    assert not c.more_to_send
+
+def test_received_headers_are_Headers():
+    c = Connection(SERVER)
+    events = c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"0\r\nSome: trailer\r\n\r\n")
+    assert type(events[0].headers) is Headers
+    assert type(events[1].headers) is Headers
+    # ...including when there are no trailers
+    head = b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: "
+    for data in [head + b"1\r\n\r\nx", head + b"0\r\n\r\n"]:
+        eom = Connection(SERVER).receive_data(data)[-1]
+        assert type(eom) is EndOfMessage
+        assert type(eom.headers) is Headers
+    client = Connection(CLIENT)
+    client.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    client.send(EndOfMessage())
+    client.receive_data(b"HTTP/1.0 200 OK\r\n\r\nx")
+    eom = client.receive_data(b"")[0]
+    assert type(eom) is EndOfMessage
+    assert type(eom.headers) is Headers
+
+    # A proxy can forward them without re-validation
+    forwarded = Request(method="POST", target="/", headers=events[0].headers)
+    assert forwarded.headers is events[0].headers
+    client = Connection(CLIENT)
+    assert (client.send(forwarded)
+            == b"POST / HTTP/1.1\r\nhost: a\r\ntransfer-encoding: chunked"
+               b"\r\n\r\n")
+
+    # Reusing a Headers for many responses works, and our automatic header
+    # fixups don't modify it
+    common = Headers([("Server", "test")])
+    for _ in range(2):
+        c = Connection(SERVER)
+        c.receive_data(b"GET / HTTP/1.0\r\n\r\n")
+        assert (c.send(Response(status_code=200, headers=common))
+                == b"HTTP/1.1 200 \r\nserver: test\r\nconnection: close"
+                   b"\r\n\r\n")
+    assert common == [(b"server", b"test")]
+
+def test_decode_content():
+    import gzip
+    body = b"some json " * 100
+    compressed = gzip.compress(body)
+    response = (b"HTTP/1.1 200 OK\r\n"
+                b"Content-Encoding: gzip\r\n"
+                b"Content-Length: " + str(len(compressed)).encode("ascii")
+                + b"\r\n\r\n" + compressed)
+
+    def client(**kwargs):
+        c = Connection(CLIENT, **kwargs)
+        c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+        c.send(EndOfMessage())
+        return c
+
+    # Off by default
+    c = client()
+    events = c.receive_data(response)
+    assert normalize_data_events(events[1:]) == [Data(data=compressed),
+                                                 EndOfMessage()]
+
+    c = client(decode_content=True, max_decoded_data_size=64)
+    events = c.receive_data(response)
+    # Headers are passed through untouched
+    assert events[0].headers == [
+        (b"content-encoding", b"gzip"),
+        (b"content-length", str(len(compressed)).encode("ascii")),
+    ]
+    assert all(len(e.data) <= 64 for e in events if type(e) is Data)
+    assert normalize_data_events(events[1:]) == [Data(data=body),
+                                                 EndOfMessage()]
+    assert c.their_state is DONE
+
+    c = client(decode_content=True, max_decompression_ratio=2)
+    with pytest.raises(ProtocolError):
+        c.receive_data(response)
+    assert c.their_state is ERROR
+
+def test_compress_responses():
+    import gzip
+    body = b"[" + b"{\"some\": \"json\"}, " * 200 + b"]"
+
+    def server(accept_encoding=b"gzip, deflate", method=b"GET", **kwargs):
+        kwargs.setdefault("compress_responses", True)
+        c = Connection(SERVER, **kwargs)
+        c.receive_data(method + b" / HTTP/1.1\r\nHost: a\r\n"
+                       b"Accept-Encoding: " + accept_encoding + b"\r\n\r\n")
+        return c
+
+    def roundtrip(c, response, chunks):
+        wire = c.send(response)
+        for chunk in chunks:
+            wire += c.send(Data(data=chunk))
+        wire += c.send(EndOfMessage())
+        client = Connection(CLIENT, decode_content=True)
+        client.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+        client.send(EndOfMessage())
+        events = normalize_data_events(client.receive_data(wire))
+        return wire, events
+
+    # Unknown length
+    c = server()
+    wire, events = roundtrip(c, Response(status_code=200, headers=[]),
+                             [body[:100], body[100:]])
+    assert events[0].headers == [
+        (b"content-encoding", b"gzip"),
+        (b"vary", b"Accept-Encoding"),
+        (b"transfer-encoding", b"chunked"),
+    ]
+    assert events[1:] == [Data(data=body), EndOfMessage()]
+    assert len(wire) < len(body) / 5
+    assert c.our_state is DONE
+    c.prepare_to_reuse()
+
+    # Known length above the threshold; existing Vary is preserved
+    c = server()
+    wire, events = roundtrip(
+        c, Response(status_code=200,
+                    headers=[("Content-Length", str(len(body))),
+                             ("Vary", "Cookie")]),
+        [body])
+    assert events[0].headers == [
+        (b"content-encoding", b"gzip"),
+        (b"vary", b"Cookie"),
+        (b"vary", b"Accept-Encoding"),
+        (b"transfer-encoding", b"chunked"),
+    ]
+    assert events[1:] == [Data(data=body), EndOfMessage()]
+
+    # send_message works too
+    c = server()
+    wire = c.send_message(Response(status_code=200, headers=[]), body)
+    assert b"content-encoding: gzip" in wire
+    assert c.our_state is DONE
+
+    # Cases where we don't compress
+    def uncompressed(c, response, chunks=[]):
+        wire, events = roundtrip(c, response, chunks)
+        assert b"content-encoding" not in wire.lower() or any(
+            name == b"content-encoding" for name, _ in response.headers)
+        return events
+    # Small known length
+    uncompressed(server(), Response(status_code=200,
+                                    headers=[("Content-Length", "5")]),
+                 [b"small"])
+    uncompressed(server(compress_min_size=10),
+                 Response(status_code=200, headers=[("Content-Length", "5")]),
+                 [b"small"])
+    # Client doesn't accept gzip
+    for accept in [b"identity", b"gzip;q=0", b"br"]:
+        uncompressed(server(accept_encoding=accept),
+                     Response(status_code=200, headers=[]), [body])
+    # Already encoded
+    pre = gzip.compress(body)
+    events = uncompressed(
+        server(), Response(status_code=200,
+                           headers=[("Content-Encoding", "gzip")]), [pre])
+    assert events[1:] == [Data(data=body), EndOfMessage()]
+    # Partial content, and responses that can't have a body
+    uncompressed(server(), Response(status_code=206, headers=[]), [body])
+    uncompressed(server(compress_min_size=0),
+                 Response(status_code=204, headers=[]))
+    c = server(method=b"HEAD", compress_min_size=0)
+    assert (c.send(Response(status_code=200, headers=[]))
+            == b"HTTP/1.1 200 \r\n\r\n")
+    c.send(EndOfMessage())
+    # Disabled by default
+    uncompressed(server(compress_responses=False),
+                 Response(status_code=200, headers=[]), [body])
+
+def test_discard_incoming_body():
+    def server(**kwargs):
+        c = Connection(SERVER, **kwargs)
+        events = c.receive_data(
+            b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 100\r\n\r\n"
+            b"0123456789")
+        assert events == [
+            Request(method="POST", target="/",
+                    headers=[("Host", "a"), ("Content-Length", "100")]),
+            Data(data=b"0123456789"),
+        ]
+        c.send(Response(status_code=401, headers=[("Content-Length", "0")]))
+        c.send(EndOfMessage())
+        return c
+
+    c = server()
+    assert c.discard_incoming_body() == []
+    assert c.receive_data(b"x" * 50) == []
+    # Only the EndOfMessage comes out, and the connection can be reused
+    events = c.receive_data(
+        b"x" * 40 + b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert events == [EndOfMessage(), Paused(reason=DONE)]
+    c.prepare_to_reuse()
+    assert c.receive_data(None) == [
+        Request(method="GET", target="/", headers=[("Host", "a")]),
+        EndOfMessage(),
+    ]
+    # Discarding stops at the end of the body
+    c.send(Response(status_code=200, headers=[("Content-Length", "0")]))
+    c.send(EndOfMessage())
+    c.prepare_to_reuse()
+    assert c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 2\r\n\r\nhi") == [
+            Request(method="POST", target="/",
+                    headers=[("Host", "a"), ("Content-Length", "2")]),
+            Data(data=b"hi"),
+            EndOfMessage(),
+        ]
+    # Nothing to do once the body has been received
+    assert c.discard_incoming_body() == []
+
+    # Exceeding the limit
+    c = server()
+    assert c.discard_incoming_body(max_bytes=50) == []
+    c.receive_data(b"x" * 50)
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(b"x")
+    assert excinfo.value.error_status_hint == 413
+    assert c.their_state is ERROR
+
+    # Data that was already buffered (here, a partial chunk header) is
+    # discarded along with the rest
+    c = Connection(SERVER)
+    c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n")
+    assert c.receive_data(b"3") == []
+    assert c.discard_incoming_body() == []
+    assert c.receive_data(b"\r\nabc\r\n0\r\n\r\n") == [EndOfMessage()]
+
+    # Compressed bodies are skipped without being decompressed
+    import gzip
+    compressed = gzip.compress(b"x" * 1000)
+    c = Connection(SERVER, decode_content=True)
+    c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Encoding: gzip\r\n"
+        b"Content-Length: " + str(len(compressed)).encode("ascii")
+        + b"\r\n\r\n")
+    c.discard_incoming_body()
+    assert c.receive_data(compressed[:-1]) == []
+    assert c.receive_data(compressed[-1:]) == [EndOfMessage()]
+
+    with pytest.raises(RuntimeError):
+        Connection(SERVER).discard_incoming_body()
+
+def test_max_body_size():
+    # Rejected as soon as the headers arrive
+    c = Connection(SERVER, max_body_size=10)
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(
+            b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 11\r\n\r\n")
+    assert excinfo.value.error_status_hint == 413
+    assert c.their_state is ERROR
+    # ...and we can still send the error response
+    assert c.our_state is SEND_RESPONSE
+    c.send(Response(status_code=413, headers=[("Content-Length", "0")]))
+
+    c = Connection(SERVER, max_body_size=10)
+    events = c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"a\r\n0123456789\r\n")
+    assert normalize_data_events(events[1:]) == [Data(data=b"0123456789")]
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(b"1\r\n")
+    assert excinfo.value.error_status_hint == 413
+
+    # Applies to responses too
+    c = Connection(CLIENT, max_body_size=10)
+    c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    c.send(EndOfMessage())
+    with pytest.raises(ProtocolError):
+        c.receive_data(b"HTTP/1.0 200 OK\r\n\r\n" + b"x" * 11)
+
+    # Bodies within the limit are fine
+    c = Connection(SERVER, max_body_size=10)
+    events = c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n"
+        b"0123456789")
+    assert events[1:] == [Data(data=b"0123456789"), EndOfMessage()]
+
+def test_raw_body():
+    c = Connection(SERVER)
+    events = c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 20\r\n\r\n01234")
+    assert events[1:] == [Data(data=b"01234")]
+    assert c.receive_data(b"56789") == [Data(data=b"56789")]
+    # receive_data has already returned everything buffered, so there's
+    # nothing to hand off, just the count of what's still to come...
+    data, remaining = c.start_raw_body()
+    assert not data
+    assert remaining == 10
+    with pytest.raises(RuntimeError):
+        c.receive_data(b"abcde")
+    # ...the caller relays the rest...
+    assert c.end_raw_body() == [EndOfMessage()]
+    assert c.their_state is DONE
+    with pytest.raises(RuntimeError):
+        c.end_raw_body()
+
+    # Taking over straight after the head
+    c = Connection(SERVER)
+    events = c.receive_data(
+        b"POST / HTTP/1.1\r\nHost: a\r\nContent-Length: 10\r\n\r\n")
+    assert len(events) == 1
+    data, remaining = c.start_raw_body()
+    assert not data
+    assert remaining == 10
+    assert c.end_raw_body() == [EndOfMessage()]
+    # and parsing carries on afterwards
+    assert c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n") == [
+        Paused(reason=DONE)]
+    c.send(Response(status_code=200, headers=[("Content-Length", "0")]))
+    c.send(EndOfMessage())
+    c.prepare_to_reuse()
+    assert c.receive_data(None)[0] == Request(method="GET", target="/",
+                                              headers=[("Host", "a")])
+
+    # Only for Content-Length bodies that we aren't decoding
+    for kwargs, framing in [({}, b"Transfer-Encoding: chunked"),
+                            ({"decode_content": True},
+                             b"Content-Encoding: gzip\r\nContent-Length: 3")]:
+        c = Connection(SERVER, **kwargs)
+        c.receive_data(b"POST / HTTP/1.1\r\nHost: a\r\n" + framing
+                       + b"\r\n\r\n")
+        with pytest.raises(RuntimeError):
+            c.start_raw_body()
+    with pytest.raises(RuntimeError):
+        Connection(SERVER).start_raw_body()
+
+def test_http10_keep_alive():
+    request = (b"GET / HTTP/1.0\r\nConnection: keep-alive\r\n\r\n")
+
+    # Off by default
+    c = Connection(SERVER)
+    c.receive_data(request)
+    assert c.their_state is MUST_CLOSE
+
+    c = Connection(SERVER, http10_keep_alive=True)
+    for _ in range(3):
+        assert c.receive_data(request) == [
+            Request(method="GET", target="/", http_version="1.0",
+                    headers=[("Connection", "keep-alive")]),
+            EndOfMessage(),
+        ]
+        assert c.their_state is DONE
+        # We echo back Connection: keep-alive
+        assert c.send(Response(status_code=200,
+                               headers=[("Content-Length", "2")])) == (
+            b"HTTP/1.1 200 \r\n"
+            b"content-length: 2\r\n"
+            b"connection: keep-alive\r\n\r\n")
+        c.send(Data(data=b"hi"))
+        c.send(EndOfMessage())
+        assert (c.our_state, c.their_state) == (DONE, DONE)
+        c.prepare_to_reuse()
+
+    # Without a Content-Length, we have to close after all
+    c.receive_data(request)
+    assert c.send(Response(status_code=200, headers=[])) == (
+        b"HTTP/1.1 200 \r\nconnection: close\r\n\r\n")
+    c.send(EndOfMessage())
+    assert c.our_state is MUST_CLOSE
+
+    # If the user says close, then that's all we say
+    c = Connection(SERVER, http10_keep_alive=True)
+    c.receive_data(request)
+    assert c.send(Response(status_code=200,
+                           headers=[("Content-Length", "0"),
+                                    ("Connection", "close")])) == (
+        b"HTTP/1.1 200 \r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+    c.send(EndOfMessage())
+    assert c.our_state is MUST_CLOSE
+
+    # Plain HTTP/1.0 requests still close
+    c = Connection(SERVER, http10_keep_alive=True)
+    c.receive_data(b"GET / HTTP/1.0\r\n\r\n")
+    assert c.their_state is MUST_CLOSE
+    assert c.send(Response(status_code=200,
+                           headers=[("Content-Length", "0")])) == (
+        b"HTTP/1.1 200 \r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+
+    # As a client, an HTTP/1.0 server's keep-alive is honored
+    c = Connection(CLIENT, http10_keep_alive=True)
+    c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    c.send(EndOfMessage())
+    c.receive_data(b"HTTP/1.0 200 OK\r\nConnection: keep-alive\r\n"
+                   b"Content-Length: 2\r\n\r\nhi")
+    assert (c.our_state, c.their_state) == (DONE, DONE)
+
+def test_pipeline_depth():
+    with pytest.raises(ValueError):
+        Connection(CLIENT, pipeline_depth=1)
+
+    def request(n, extra=b""):
+        return ("GET /{} HTTP/1.1\r\nHost: a\r\n".format(n).encode("ascii")
+                + extra + b"\r\n")
+
+    def respond(c):
+        c.send(Response(status_code=200, headers=[("Content-Length", "0")]))
+        c.send(EndOfMessage())
+        c.prepare_to_reuse()
+
+    c = Connection(SERVER, pipeline_depth=2)
+    events = c.receive_data(
+        request(1)
+        + request(2, b"Content-Length: 3\r\n") + b"abc"
+        + request(3) + request(4))
+    # Parses ahead up to 2 requests beyond the current one
+    assert [e.target for e in events if type(e) is Request] == [
+        b"/1", b"/2", b"/3"]
+    assert events[2:5] == [
+        Request(method="GET", target="/2",
+                headers=[("Host", "a"), ("Content-Length", "3")]),
+        Data(data=b"abc"), EndOfMessage()]
+    assert events[-1] == Paused(reason=DONE)
+    # The state machine is still on the first request
+    assert c.their_state is DONE
+    assert c.our_state is SEND_RESPONSE
+
+    # Responding to /1 moves it on to /2 without needing receive_data
+    respond(c)
+    assert c.their_state is DONE
+    assert c.our_state is SEND_RESPONSE
+    # ...and there's room in the queue for /4 now
+    events = c.receive_data(None)
+    assert events == [Request(method="GET", target="/4",
+                              headers=[("Host", "a")]),
+                      EndOfMessage(), Paused(reason=DONE)]
+    respond(c)  # /2
+    respond(c)  # /3
+    assert c.receive_data(None) == []
+    respond(c)  # /4
+    assert c.their_state is IDLE
+    assert c.receive_data(None) == []
+
+    # Incomplete requests are left for later
+    c = Connection(SERVER, pipeline_depth=5)
+    events = c.receive_data(
+        request(1) + request(2) + request(3, b"Content-Length: 10\r\n")
+        + b"abc")
+    assert [e.target for e in events if type(e) is Request] == [b"/1", b"/2"]
+    assert c.receive_data(b"defghij") == [
+        Request(method="GET", target="/3",
+                headers=[("Host", "a"), ("Content-Length", "10")]),
+        Data(data=b"abcdefghij"), EndOfMessage(), Paused(reason=DONE)]
+    # Client closing doesn't cut off the queued requests
+    assert c.receive_data(b"") == [Paused(reason=DONE)]
+    respond(c)
+    respond(c)
+    c.send(Response(status_code=200, headers=[("Content-Length", "0")]))
+    c.send(EndOfMessage())
+    assert c.receive_data(None) == [ConnectionClosed()]
+
+    # Once the incomplete request is complete, we carry on parsing ahead
+    # past it
+    c = Connection(SERVER, pipeline_depth=4)
+    c.receive_data(request(1) + request(2, b"Content-Length: 10\r\n")
+                   + b"01234")
+    events = c.receive_data(b"56789" + request(3) + request(4))
+    assert [e.target for e in events if type(e) is Request] == [
+        b"/2", b"/3", b"/4"]
+
+    # Broken requests are left for the regular parser to complain about, in
+    # order
+    c = Connection(SERVER, pipeline_depth=5)
+    events = c.receive_data(request(1) + request(2) + b"garbage\r\n\r\n")
+    assert [e.target for e in events if type(e) is Request] == [b"/1", b"/2"]
+    respond(c)
+    respond(c)
+    with pytest.raises(ProtocolError):
+        c.receive_data(None)
+
+    # ...including ones that break the size limits, which we notice straight
+    # away, and stop buffering
+    c = Connection(SERVER, pipeline_depth=5, max_header_line=100)
+    c.receive_data(request(1) + b"GET /2 HTTP/1.1\r\nX: ")
+    assert c.receive_data(b"x" * 1000) == [Paused(reason=DONE)]
+    assert c.trailing_data == (b"", False)
+    respond(c)
+    assert c.next_action() is RECEIVE_BUFFERED
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(None)
+    assert excinfo.value.error_status_hint == 431
+    c = Connection(SERVER, pipeline_depth=5, max_buffer_size=100)
+    c.receive_data(request(1) + b"GET /2 HTTP/1.1\r\n")
+    for _ in range(20):
+        c.receive_data(b"X: y\r\n")
+    assert c.trailing_data == (b"", False)
+    respond(c)
+    with pytest.raises(ProtocolError):
+        c.receive_data(None)
+
+    # Trickling in a request doesn't upset anything
+    c = Connection(SERVER, pipeline_depth=5)
+    c.receive_data(request(1))
+    for byte in request(2, b"Content-Length: 3\r\n") + b"abc":
+        events = c.receive_data(bytes([byte]))
+    assert events == [
+        Request(method="GET", target="/2",
+                headers=[("Host", "a"), ("Content-Length", "3")]),
+        Data(data=b"abc"), EndOfMessage(), Paused(reason=DONE)]
+
+    # We don't parse past a request that closes the connection or switches
+    # protocols
+    for extra in [b"Connection: close\r\n",
+                  b"Upgrade: websocket\r\nConnection: upgrade\r\n"]:
+        c = Connection(SERVER, pipeline_depth=5)
+        events = c.receive_data(request(1) + request(2, extra) + request(3))
+        assert [e.target for e in events if type(e) is Request] == [
+            b"/1", b"/2"]
+
+    # Queued requests are limited by max_buffer_size
+    c = Connection(SERVER, pipeline_depth=5, max_buffer_size=100)
+    big = request(2, b"Content-Length: 80\r\n") + b"x" * 80
+    events = c.receive_data(request(1) + big)
+    assert [e.target for e in events if type(e) is Request] == [b"/1"]
+    respond(c)
+    assert c.receive_data(None)[0].target == b"/2"
+
+def test__keep_alive_params():
+    assert _keep_alive_params([]) == (None, None)
+    assert _keep_alive_params([(b"keep-alive", b"timeout=5, max=100")]) == (
+        5, 100)
+    assert _keep_alive_params(
+        [(b"keep-alive", b"Timeout = 5"), (b"keep-alive", b"max=x, foo")]) == (
+            5, None)
+
+def test_keep_alive_params_and_max_requests():
+    with pytest.raises(ValueError):
+        Connection(CLIENT, max_requests=1)
+    with pytest.raises(ValueError):
+        Connection(SERVER, max_requests=0)
+
+    # Keep-Alive parameters are exposed
+    c = Connection(CLIENT)
+    assert c.their_keep_alive_timeout is None
+    assert c.their_keep_alive_max is None
+    c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    c.send(EndOfMessage())
+    c.receive_data(b"HTTP/1.1 200 OK\r\nKeep-Alive: timeout=5, max=99\r\n"
+                   b"Content-Length: 0\r\n\r\n")
+    assert c.their_keep_alive_timeout == 5
+    assert c.their_keep_alive_max == 99
+
+    c = Connection(SERVER, max_requests=2)
+    for i in range(2):
+        c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+        data = c.send(Response(status_code=200,
+                               headers=[("Content-Length", "0")]))
+        c.send(EndOfMessage())
+        if i == 0:
+            assert b"connection: close" not in data
+            c.prepare_to_reuse()
+    # The last one gets Connection: close
+    assert b"connection: close" in data
+    assert c.our_state is MUST_CLOSE
+
+    # Parsing ahead stops at the limit
+    c = Connection(SERVER, max_requests=2, pipeline_depth=5)
+    events = c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n" * 3)
+    assert len([e for e in events if type(e) is Request]) == 2
+
+def test_next_action_and_bytes_needed():
+    p = ConnectionPair()
+    c, s = p.conn[CLIENT], p.conn[SERVER]
+    assert c.next_action() is NEED_TO_SEND
+    assert s.next_action() is NEED_DATA
+    assert s.bytes_needed is None
+
+    p.send(CLIENT, Request(method="POST", target="/",
+                           headers=[("Host", "a"), ("Content-Length", "10"),
+                                    ("Expect", "100-continue")]))
+    # The client waits for the go-ahead, and the server should give it
+    assert c.next_action() is NEED_DATA
+    assert c.bytes_needed is None
+    assert s.next_action() is SEND_100_CONTINUE
+    p.send(SERVER, InformationalResponse(status_code=100, headers=[]))
+    assert c.next_action() is NEED_TO_SEND
+    assert s.next_action() is NEED_DATA
+    assert s.bytes_needed == 10
+    p.send(CLIENT, Data(data=b"1234"))
+    assert s.bytes_needed == 6
+    p.send(CLIENT, [Data(data=b"567890"), EndOfMessage()])
+    assert c.next_action() is NEED_DATA
+    assert s.next_action() is NEED_TO_SEND
+
+    p.send(SERVER, Response(status_code=200,
+                            headers=[("Transfer-Encoding", "chunked")]))
+    assert c.bytes_needed is None
+    # Part of a chunk: the rest of it plus the CRLF
+    data = s.send(Data(data=b"12345"))
+    c.receive_data(data[:5])
+    assert c.bytes_needed == 5
+    c.receive_data(data[5:-1])
+    assert c.bytes_needed == 1
+    c.receive_data(data[-1:])
+    assert c.bytes_needed is None
+    p.send(SERVER, EndOfMessage())
+    assert c.next_action() is PAUSED
+    assert s.next_action() is PAUSED
+
+    # Pipelined data that arrived while paused
+    s.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\n\r\n")
+    assert s.next_action() is PAUSED
+    s.prepare_to_reuse()
+    assert s.next_action() is RECEIVE_BUFFERED
+    # Receiving nothing doesn't count
+    assert s.receive_data_many([]) == []
+    assert s.next_action() is RECEIVE_BUFFERED
+    assert type(s.receive_data(None)[0]) is Request
+    assert s.next_action() is NEED_TO_SEND
+
+    # Closing
+    p = ConnectionPair()
+    p.send(CLIENT, [Request(method="GET", target="/",
+                            headers=[("Host", "a"), ("Connection", "close")]),
+                    EndOfMessage()])
+    assert p.conn[SERVER].next_action() is NEED_TO_SEND
+    p.conn[CLIENT].receive_data(
+        p.conn[SERVER].send_message(Response(status_code=200, headers=[])))
+    for conn in p.conns:
+        assert conn.next_action() is MUST_CLOSE
+
+    # Errors
+    c = Connection(SERVER)
+    with pytest.raises(ProtocolError):
+        c.receive_data(b"garbage\r\n\r\n")
+    assert c.next_action() is ERROR
+
+def test_receive_data_many():
+    data = (b"POST / HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b"5\r\n12345\r\n0\r\n\r\n"
+            b"GET / HTTP/1.0\r\n\r\n")
+    pieces = [data[i:i + 7] for i in range(0, len(data), 7)]
+    sequential = Connection(SERVER)
+    expected = []
+    for piece in pieces:
+        expected += sequential.receive_data(piece)
+    batched = Connection(SERVER)
+    events = batched.receive_data_many(pieces)
+    # Sequential calls repeat the Paused event
+    del expected[expected.index(Paused(reason=DONE)) + 1:]
+    assert (normalize_data_events(events)
+            == normalize_data_events(expected))
+    assert events == [
+        Request(method="POST", target="/",
+                headers=[("Host", "a"), ("Transfer-Encoding", "chunked")]),
+        Data(data=b"12345"),
+        EndOfMessage(),
+        Paused(reason=DONE),
+    ]
+    batched.send(Response(status_code=200, headers=[]))
+    batched.send(EndOfMessage())
+    batched.prepare_to_reuse()
+    # None and EOF work like they do in receive_data
+    assert batched.receive_data_many([None, b""]) == [
+        Request(method="GET", target="/", headers=[], http_version="1.0"),
+        EndOfMessage(),
+        ConnectionClosed(),
+    ]
+    assert batched.their_state is CLOSED
+    c = Connection(SERVER)
+    with pytest.raises(RuntimeError):
+        c.receive_data_many([b"GET", b"", b" / HTTP/1.0"])
+
+    # The buffer limit is enforced just as if the buffers had arrived one at
+    # a time: here, the request would be complete by the end, but it's too
+    # big by the time the second buffer arrives
+    head = b"GET / HTTP/1.1\r\nHost: a\r\nX: " + b"x" * 100
+    c = Connection(SERVER, max_buffer_size=100)
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data_many([head[:50], head[50:], b"\r\n\r\n"])
+    assert excinfo.value.error_status_hint == 431
+    c = Connection(SERVER, max_buffer_size=200)
+    assert len(c.receive_data_many([head[:50], head[50:], b"\r\n\r\n"])) == 2
+
+def test_head_limits():
+    def check(data, status_hint, **kwargs):
+        c = Connection(SERVER, **kwargs)
+        with pytest.raises(ProtocolError) as excinfo:
+            c.receive_data(data)
+        assert excinfo.value.error_status_hint == status_hint
+
+    long_target = b"GET /" + b"x" * 100 + b" HTTP/1.1\r\n"
+    # Rejected before the line is even complete
+    check(long_target[:60], 414, max_request_line=50)
+    check(long_target, 414, max_request_line=50)
+    c = Connection(SERVER, max_request_line=len(long_target) - 2)
+    assert c.receive_data(long_target + b"Host: a\r\n\r\n")[0].target == (
+        b"/" + b"x" * 100)
+
+    head = b"GET / HTTP/1.1\r\nHost: a\r\n"
+    check(head + b"X: " + b"y" * 60, 431, max_header_line=50)
+    # Folded lines are counted all together
+    check(head + b"X: " + b"y" * 30 + b"\r\n " + b"y" * 30 + b"\r\n",
+          431, max_header_line=50)
+    # The request line isn't a header line
+    c = Connection(SERVER, max_header_line=10)
+    assert type(c.receive_data(head + b"\r\n")[0]) is Request
+
+    check(head + b"A: 1\r\nB: 2\r\nC: 3\r\n", 431, max_header_count=3)
+    c = Connection(SERVER, max_header_count=3)
+    assert len(c.receive_data(head + b"A: 1\r\nB: 2\r\n\r\n")[0].headers) == 3
+
+    # Clients apply the limits to responses
+    c = Connection(CLIENT, max_header_count=1)
+    c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    c.send(EndOfMessage())
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(b"HTTP/1.1 200 OK\r\nA: 1\r\nB: 2\r\n\r\n")
+    assert excinfo.value.error_status_hint == 431
+    # ...where an over-long status line is just a 400
+    c = Connection(CLIENT, max_request_line=10)
+    c.send(Request(method="GET", target="/", headers=[("Host", "a")]))
+    c.send(EndOfMessage())
+    with pytest.raises(ProtocolError) as excinfo:
+        c.receive_data(b"HTTP/1.1 200 OK\r\n\r\n")
+    assert excinfo.value.error_status_hint == 400
+
+    # Trailers get the same header limits
+    chunked = (b"POST / HTTP/1.1\r\nHost: a\r\n"
+               b"Transfer-Encoding: chunked\r\n\r\n0\r\n")
+    check(chunked + b"X: " + b"y" * 60, 431, max_header_line=50)
+    check(chunked + b"A: 1\r\nB: 2\r\n\r\n", 431, max_header_count=1)
+    c = Connection(SERVER, max_header_count=2)
+    events = c.receive_data(chunked + b"A: 1\r\nB: 2\r\n\r\n")
+    assert events[-1] == EndOfMessage(headers=[("A", "1"), ("B", "2")])
+
+def test_memoize_headers():
+    def request(c, data):
+        events = c.receive_data(data)
+        assert type(events[0]) is Request
+        assert type(events[-1]) is Paused or type(events[-1]) is EndOfMessage
+        c.send(Response(status_code=200, headers=[("Content-Length", "0")]))
+        c.send(EndOfMessage())
+        c.prepare_to_reuse()
+        return events[0]
+
+    headers = b"Host: a\r\nUser-Agent: foo\r\nAccept: */*\r\n\r\n"
+    c = Connection(SERVER, memoize_headers=True)
+    first = request(c, b"GET /1 HTTP/1.1\r\n" + headers)
+    second = request(c, b"GET /2 HTTP/1.1\r\n" + headers)
+    assert second.target == b"/2"
+    assert second.headers is first.headers
+    # Trickled in a byte at a time
+    for byte in (b"GET /3 HTTP/1.1\r\n" + headers)[:-1]:
+        assert c.receive_data(bytes([byte])) == []
+    third = c.receive_data(b"\n")[0]
+    assert third.headers is first.headers
+
+    c = Connection(SERVER, memoize_headers=True)
+    first = request(c, b"GET / HTTP/1.1\r\n" + headers)
+    for other in [
+            # Different in the middle
+            b"Host: a\r\nUser-Agent: bar\r\nAccept: */*\r\n\r\n",
+            # Shorter
+            b"Host: a\r\nUser-Agent: bar\r\n\r\n",
+            # Longer, with a folded line
+            b"Host: a\r\nUser-Agent: bar\r\n  baz\r\nAccept: */*\r\n"
+            b"X: y\r\n\r\n",
+            b"Host: b\r\n\r\n",
+    ]:
+        event = request(c, b"GET / HTTP/1.1\r\n" + other)
+        assert event.headers == Connection(SERVER).receive_data(
+            b"GET / HTTP/1.1\r\n" + other)[0].headers
+        assert event.headers is not first.headers
+
+    # Errors in a previously-seen block are still caught
+    c = Connection(SERVER, memoize_headers=True)
+    request(c, b"GET / HTTP/1.1\r\n" + headers)
+    with pytest.raises(ProtocolError):
+        c.receive_data(b"GET / HTTP/1.1\r\nHost: a\r\nUser-Agent foo\r\n\r\n")
+
+def test_request_line_cache():
+    cache = request_line_cache
+    old_maxsize = cache.maxsize
+    try:
+        cache.maxsize = 2
+        assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+
+        def target_of(data):
+            c = Connection(SERVER)
+            return c.receive_data(data + b"Host: a\r\n\r\n")[0].target
+
+        assert target_of(b"GET /a HTTP/1.1\r\n") == b"/a"
+        assert target_of(b"GET /a HTTP/1.1\r\n") == b"/a"
+        assert target_of(b"GET /b HTTP/1.1\r\n") == b"/b"
+        assert (cache.hits, cache.misses, len(cache)) == (1, 2, 2)
+        # Least recently used goes first
+        assert target_of(b"GET /c HTTP/1.1\r\n") == b"/c"
+        assert target_of(b"GET /a HTTP/1.1\r\n") == b"/a"
+        assert (cache.hits, cache.misses, len(cache)) == (1, 4, 2)
+        # Bad lines are never cached, and fail every time
+        for _ in range(2):
+            with pytest.raises(ProtocolError):
+                target_of(b"GET /a\r\n")
+        assert len(cache) == 2
+        # Nor are long ones
+        long_target = b"/" + b"x" * 2000
+        assert target_of(b"GET " + long_target + b" HTTP/1.1\r\n") \
+            == long_target
+        assert (cache.hits, cache.misses, len(cache)) == (1, 6, 2)
+
+        cache.clear()
+        assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+
+        cache.maxsize = 0
+        assert target_of(b"GET /a HTTP/1.1\r\n") == b"/a"
+        assert target_of(b"GET /a HTTP/1.1\r\n") == b"/a"
+        assert (cache.hits, cache.misses, len(cache)) == (0, 0, 0)
+        with pytest.raises(ValueError):
+            cache.maxsize = -1
+    finally:
+        cache.maxsize = old_maxsize
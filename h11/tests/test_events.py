@@ -102,3 +102,15 @@ def test_events():
 
     paused = Paused(reason="some-reason")
     assert paused.reason == "some-reason"
+
+def test_events_with_Headers():
+    from .._headers import Headers
+
+    headers = Headers([("Host", "example.com")])
+    req = Request(method="GET", target="/", headers=headers)
+    assert req.headers is headers
+    assert req == Request(method="GET", target="/",
+                          headers=[("host", "example.com")])
+    # Event-specific validation still happens
+    with pytest.raises(ProtocolError):
+        Request(method="GET", target="/", headers=Headers([]))
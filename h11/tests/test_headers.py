@@ -93,3 +93,53 @@ def test_has_100_continue():
         target="/",
         headers=[("Host", "example.com"), ("Expect", "100-continue")],
         http_version="1.0"))
+
+def test_DateCache():
+    now = [784111777.5]
+    calls = []
+    def clock():
+        calls.append(None)
+        return now[0]
+
+    cache = DateCache()
+    assert cache(clock) == b"Sun, 06 Nov 1994 08:49:37 GMT"
+    first = cache(clock)
+    # Same second -> same cached object
+    now[0] = 784111777.9
+    assert cache(clock) is first
+    now[0] = 784111778.1
+    assert cache(clock) == b"Sun, 06 Nov 1994 08:49:38 GMT"
+    assert len(calls) == 4
+
+    # The module-level cache works with the real clock
+    assert get_date_header_value().endswith(b" GMT")
+
+def test_Headers():
+    h = Headers([("Foo", " bar "), (b"Content-Length", b"10")])
+    assert h == [(b"foo", b"bar"), (b"content-length", b"10")]
+    assert [(b"foo", b"bar"), (b"content-length", b"10")] == h
+    assert h == ((b"foo", b"bar"), (b"content-length", b"10"))
+    assert h != [(b"foo", b"bar")]
+    assert not (h == "something else")
+    assert repr(h) == "Headers([(b'foo', b'bar'), (b'content-length', b'10')])"
+    assert hash(h) == hash(Headers(h))
+    # Immutable
+    with pytest.raises(TypeError):
+        h[0] = (b"a", b"b")
+    with pytest.raises(AttributeError):
+        h.append((b"a", b"b"))
+
+    # Validation happens at construction time
+    with pytest.raises(ProtocolError):
+        Headers([("Content-Length", "asdf")])
+
+    # ...and then never again
+    assert Headers(h) is h
+    assert normalize_and_validate(h) is h
+
+    # set_comma_header only validates what it adds
+    headers = list(h)
+    set_comma_header(headers, "Content-Length", ["5"])
+    assert headers == [(b"foo", b"bar"), (b"content-length", b"5")]
+    with pytest.raises(ProtocolError):
+        set_comma_header(headers, "Content-Length", ["asdf"])
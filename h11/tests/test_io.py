@@ -14,7 +14,7 @@ from .._writers import (
 from .._readers import (
     READERS,
     ContentLengthReader, ChunkedReader, Http10Reader,
-    _obsolete_line_fold,
+    _obsolete_line_fold, _decode_header_lines,
 )
 
 from .helpers import normalize_data_events
@@ -186,6 +186,40 @@ def test_readers_unusual():
            None)
 
 
+def test_readers_validate_each_line():
+    # A bad header line is rejected as soon as it arrives, without waiting
+    # for the end of the head
+    buf = makebuf(b"GET / HTTP/1.1\r\nHost: example.com\r\n")
+    assert READERS[CLIENT, IDLE](buf) is None
+    buf += b"bad header line\r\nmore headers..."
+    with pytest.raises(ProtocolError):
+        READERS[CLIENT, IDLE](buf)
+    # Same for the request line
+    buf = makebuf(b"GET /\r\n")
+    with pytest.raises(ProtocolError):
+        READERS[CLIENT, IDLE](buf)
+    # And continuation lines
+    buf = makebuf(b"HTTP/1.1 200 OK\r\nFoo: bar\r\n baz\x00\r\n")
+    with pytest.raises(ProtocolError):
+        READERS[SERVER, SEND_RESPONSE](buf)
+    # And trailers
+    buf = makebuf(b"0\r\nbad trailer\r\n")
+    with pytest.raises(ProtocolError):
+        ChunkedReader()(buf)
+
+    # Incremental parsing of folded lines gives the same answers as parsing
+    # them all at once
+    for lines in [
+            [b"a: b  ", b"  c  ", b"\td"],
+            [b"a:", b"  c  "],
+            [b"a: b", b"   ", b"c: d"],
+            [b"a: b", b" c", b"d:e", b" f"],
+    ]:
+        head = b"GET / HTTP/1.0\r\n" + b"\r\n".join(lines) + b"\r\n\r\n"
+        tr(READERS[CLIENT, IDLE], head,
+           Request(method="GET", target="/", http_version="1.0",
+                   headers=list(_decode_header_lines(lines))))
+
 def test__obsolete_line_fold_bytes():
     # _obsolete_line_fold has a defensive cast to bytearray, which is
     # necessary to protect against O(n^2) behavior in case anyone ever passes
@@ -288,10 +322,79 @@ def test_ChunkedReader():
                   + b"0; random=\"junk\"; some=more; canbe=lonnnnngg\r\n\r\n",
                   [Data(data=b"xxxxx"), EndOfMessage()])
 
+def test_body_readers_discarding():
+    def discarding(thunk):
+        def make():
+            reader = thunk()
+            reader.discarding = True
+            return reader
+        return make
+
+    t_body_reader(discarding(lambda: ContentLengthReader(10)),
+                  b"0123456789",
+                  [EndOfMessage()])
+
+    t_body_reader(discarding(Http10Reader), b"asdf", [EndOfMessage()],
+                  do_eof=True)
+
+    t_body_reader(discarding(ChunkedReader),
+                  b"5\r\n01234\r\n"
+                  + b"10\r\n0123456789abcdef\r\n"
+                  + b"0\r\n"
+                  + b"Some: header\r\n\r\n",
+                  [EndOfMessage(headers=[("Some", "header")])])
+
+    # Lots of chunks at once don't blow the stack
+    t_body_reader(discarding(ChunkedReader),
+                  b"1\r\nx\r\n" * 5000 + b"0\r\n\r\n",
+                  [EndOfMessage()])
+
+    # Framing is still validated
+    with pytest.raises(ProtocolError):
+        buf = makebuf(b"1\r\nx\r\nzz\r\n")
+        list(_run_reader_iter(discarding(ChunkedReader)(), buf, False))
+
+    # Switching to discarding partway through
+    reader = ContentLengthReader(10)
+    buf = makebuf(b"01234")
+    assert reader(buf) == Data(data=b"01234")
+    reader.discarding = True
+    buf += b"56789trailing"
+    assert reader(buf) == EndOfMessage()
+    assert bytes(buf) == b"trailing"
+
+def test_body_readers_max_body_size():
+    def too_large(thunk, data):
+        with pytest.raises(ProtocolError) as excinfo:
+            list(_run_reader_iter(thunk(), makebuf(data), False))
+        assert excinfo.value.error_status_hint == 413
+
+    # Declared length is checked up front
+    with pytest.raises(ProtocolError) as excinfo:
+        ContentLengthReader(11, max_body_size=10)
+    assert excinfo.value.error_status_hint == 413
+    t_body_reader(lambda: ContentLengthReader(10, max_body_size=10),
+                  b"0123456789",
+                  [Data(data=b"0123456789"), EndOfMessage()])
+
+    # Chunk sizes are checked before reading the chunk
+    t_body_reader(lambda: ChunkedReader(max_body_size=10),
+                  b"5\r\n01234\r\n5\r\n56789\r\n0\r\n\r\n",
+                  [Data(data=b"0123456789"), EndOfMessage()])
+    too_large(lambda: ChunkedReader(max_body_size=10),
+              b"5\r\n01234\r\n6\r\n")
+
+    t_body_reader(lambda: Http10Reader(max_body_size=4), b"asdf",
+                  [Data(data=b"asdf"), EndOfMessage()], do_eof=True)
+    too_large(lambda: Http10Reader(max_body_size=4), b"asdfg")
+
 def test_ContentLengthWriter():
     w = ContentLengthWriter(5)
+    assert w.more_expected()
     assert dowrite(w, Data(data=b"123")) == b"123"
+    assert w.more_expected()
     assert dowrite(w, Data(data=b"45")) == b"45"
+    assert not w.more_expected()
     assert dowrite(w, EndOfMessage()) == b""
 
     w = ContentLengthWriter(5)
@@ -316,6 +419,7 @@ def test_ContentLengthWriter():
 
 def test_ChunkedWriter():
     w = ChunkedWriter()
+    assert w.more_expected()
     assert dowrite(w, Data(data=b"aaa")) == b"3\r\naaa\r\n"
     assert dowrite(w, Data(data=b"a" * 20)) == b"14\r\n" + b"a" * 20 + b"\r\n"
 
@@ -324,6 +428,39 @@ def test_ChunkedWriter():
     assert (dowrite(w, EndOfMessage(headers=[("Etag", "asdf"), ("a", "b")]))
             == b"0\r\netag: asdf\r\na: b\r\n\r\n")
 
+def test_ChunkedWriter_coalescing():
+    w = ChunkedWriter(coalesce_size=10)
+    assert dowrite(w, Data(data=b"aaa")) == b""
+    assert dowrite(w, Data(data=bytearray(b"bbb"))) == b""
+    # Crossing the threshold emits everything as one chunk
+    assert dowrite(w, Data(data=b"cccc")) == b"a\r\naaabbbcccc\r\n"
+    assert dowrite(w, Data(data=b"dd")) == b""
+    # Big payloads go straight through, after whatever was pending
+    assert (dowrite(w, Data(data=b"e" * 10))
+            == b"2\r\ndd\r\n" + b"a\r\n" + b"e" * 10 + b"\r\n")
+    assert dowrite(w, Data(data=b"ff")) == b""
+    got = []
+    w.flush(got.append)
+    assert b"".join(got) == b"2\r\nff\r\n"
+    got = []
+    w.flush(got.append)
+    assert got == []
+    assert dowrite(w, Data(data=b"gg")) == b""
+    assert (dowrite(w, EndOfMessage(headers=[("Etag", "asdf")]))
+            == b"2\r\ngg\r\n0\r\netag: asdf\r\n\r\n")
+
+    # Non-bytes-like placeholders are passed through untouched
+    class Placeholder:
+        def __len__(self):
+            return 3
+    placeholder = Placeholder()
+    w = ChunkedWriter(coalesce_size=10)
+    assert dowrite(w, Data(data=b"xy")) == b""
+    got = []
+    w(Data(data=placeholder), got.append)
+    assert got[-2] is placeholder
+    assert b"".join(got[:-2]) == b"2\r\nxy\r\n3\r\n"
+
 def test_Http10Writer():
     w = Http10Writer()
     assert dowrite(w, Data(data=b"1234")) == b"1234"
@@ -0,0 +1,124 @@
+import pytest
+
+from .._util import ProtocolError
+from .._multipart import *
+
+BODY = (b"preamble\r\n"
+        b"--xyz\r\n"
+        b'Content-Disposition: form-data; name="a"\r\n'
+        b"\r\n"
+        b"value a\r\n"
+        b"--xyz  \r\n"
+        b'Content-Disposition: form-data; name="b"; filename="b.txt"\r\n'
+        b"Content-Type: text/plain\r\n"
+        b"\r\n"
+        b"line 1\r\n--xy\r\n--\r\n"
+        b"--xyz--\r\n"
+        b"epilogue")
+
+EXPECTED = [
+    PartHeaders(headers=[("Content-Disposition", 'form-data; name="a"')]),
+    PartData(data=b"value a"),
+    PartEnd(),
+    PartHeaders(headers=[
+        ("Content-Disposition", 'form-data; name="b"; filename="b.txt"'),
+        ("Content-Type", "text/plain"),
+    ]),
+    # Things that look a bit like delimiters, but aren't
+    PartData(data=b"line 1\r\n--xy\r\n--"),
+    PartEnd(),
+]
+
+def run(parser, pieces):
+    events = []
+    for piece in pieces:
+        events += parser.receive_data(piece)
+    events += parser.receive_data(b"")
+    # Merge adjacent PartData events, since their boundaries are arbitrary
+    merged = []
+    for event in events:
+        if (type(event) is PartData and merged
+              and type(merged[-1]) is PartData):
+            merged[-1] = PartData(data=merged[-1].data + event.data)
+        else:
+            merged.append(event)
+    for event in merged:
+        if type(event) is PartData:
+            event.data = bytes(event.data)
+    return merged
+
+def test_MultipartParser():
+    assert run(MultipartParser(b"xyz"), [BODY]) == EXPECTED
+    # All at once, or one byte at a time, gives the same results
+    pieces = [BODY[i:i + 1] for i in range(len(BODY))]
+    assert run(MultipartParser("xyz"), pieces) == EXPECTED
+
+    # No preamble, no epilogue, no CRLF after the close delimiter, empty part
+    # headers, empty part body
+    p = MultipartParser(b"xyz")
+    assert run(p, [b"--xyz\r\n\r\n\r\n--xyz--"]) == [
+        PartHeaders(headers=[]), PartEnd()]
+    with pytest.raises(RuntimeError):
+        p.receive_data(b"more")
+
+def test_MultipartParser_streams_bodies():
+    p = MultipartParser(b"xyz")
+    assert p.receive_data(b"--xyz\r\n\r\n") == [PartHeaders(headers=[])]
+    # Part data is handed back immediately, except for a possible partial
+    # delimiter at the end
+    for _ in range(100):
+        (event,) = p.receive_data(b"x" * 1000 + b"\r\n--x")
+        assert len(p._buf) == len(b"\r\n--x")
+    assert p.receive_data(b"yz--") == [PartEnd()]
+    assert p.receive_data(b"") == []
+
+def test_MultipartParser_errors():
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"")
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"x" * 71)
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"trailing space ")
+
+    # Truncated
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"xyz").receive_data(b"")
+    for body in [b"preamble", b"--xyz\r\n", b"--xyz\r\n\r\nasdf",
+                 b"--xyz\r\n\r\n--xyz"]:
+        p = MultipartParser(b"xyz")
+        p.receive_data(body)
+        with pytest.raises(ProtocolError):
+            p.receive_data(b"")
+
+    # Junk after delimiter
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"xyz").receive_data(b"--xyz junk\r\n")
+
+    # Bad part headers
+    with pytest.raises(ProtocolError):
+        MultipartParser(b"xyz").receive_data(b"--xyz\r\nno colon\r\n\r\n")
+
+    # Part headers too big
+    p = MultipartParser(b"xyz", max_header_size=100)
+    p.receive_data(b"--xyz\r\n")
+    with pytest.raises(ProtocolError):
+        p.receive_data(b"a: " + b"b" * 100)
+
+def test_MultipartParser_from_headers():
+    for value in [b"multipart/form-data; boundary=xyz",
+                  b'multipart/form-data; boundary="xyz"',
+                  b"Multipart/Mixed;charset=utf-8;BOUNDARY = xyz"]:
+        p = MultipartParser.from_headers([(b"content-type", value)])
+        assert p._delimiter == b"\r\n--xyz"
+
+    p = MultipartParser.from_headers(
+        [(b"content-type", b'multipart/form-data; boundary="x y"')],
+        max_header_size=10)
+    assert p._delimiter == b"\r\n--x y"
+    assert p._max_header_size == 10
+
+    for headers in [[],
+                    [(b"content-type", b"text/plain; boundary=xyz")],
+                    [(b"content-type", b"multipart/form-data")]]:
+        with pytest.raises(ProtocolError):
+            MultipartParser.from_headers(headers)
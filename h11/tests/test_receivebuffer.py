@@ -1,3 +1,5 @@
+import pytest
+
 from .._receivebuffer import ReceiveBuffer
 
 def test_receivebuffer():
@@ -28,6 +30,13 @@ def test_receivebuffer():
     assert b.maybe_extract_at_most(10) is None
     assert not b
 
+    b += b"12345"
+    assert b.skip_at_most(2) == 2
+    assert bytes(b) == b"345"
+    assert b.skip_at_most(10) == 3
+    assert b.skip_at_most(10) == 0
+    assert not b
+
     ################################################################
     # maybe_extract_until_next
     ################################################################
@@ -75,3 +84,115 @@ def test_receivebuffer():
     b += b"\r\ntrailing"
     assert b.maybe_extract_lines() == []
     assert bytes(b) == b"trailing"
+
+def test_receivebuffer_extract_until_before():
+    b = ReceiveBuffer()
+    b += b"12345--"
+    # Holds back anything that might be the start of the needle
+    assert b.extract_until_before(b"--x") == (b"12345", False)
+    assert bytes(b) == b"--"
+    assert b.extract_until_before(b"--x") == (b"", False)
+    b += b"x6"
+    assert b.extract_until_before(b"--x") == (b"", True)
+    assert bytes(b) == b"--x6"
+    assert b.maybe_extract_at_most(3) == b"--x"
+
+    b += b"789"
+    assert b.extract_until_before(b"--x") == (b"6789", False)
+    assert not b
+    b += b"a--"
+    assert b.extract_until_before(b"--x") == (b"a", False)
+    b.compress()
+    b += b"-x"
+    assert b.extract_until_before(b"--x") == (b"-", True)
+    assert bytes(b) == b"--x"
+
+def test_receivebuffer_maybe_extract_parsed_lines():
+    seen = []
+    class Parser:
+        def __init__(self):
+            self.lines = []
+        def check_partial_line(self, length):
+            if length > 10:
+                raise ValueError
+        def add_line(self, line):
+            seen.append(bytes(line))
+            self.lines.append(bytes(line))
+        def add_lines(self, lines):
+            seen.append([bytes(line) for line in lines])
+            self.lines += [bytes(line) for line in lines]
+        def finish(self):
+            return self.lines
+
+    b = ReceiveBuffer()
+    b += b"line 1\r\nline"
+    assert b.maybe_extract_parsed_lines(Parser) is None
+    assert seen == [b"line 1"]
+    # Nothing is extracted until the block is complete
+    assert bytes(b) == b"line 1\r\nline"
+    b.compress()
+    b += b" 2\r"
+    assert b.maybe_extract_parsed_lines(Parser) is None
+    b += b"\n\r\nrest"
+    assert b.maybe_extract_parsed_lines(Parser) == [b"line 1", b"line 2"]
+    # Each line was only parsed once
+    assert seen == [b"line 1", b"line 2"]
+    assert bytes(b) == b"rest"
+
+    # A block that's all there already is handled in one go
+    b = ReceiveBuffer()
+    b += b"a\r\nb\r\n\r\n\r\n"
+    del seen[:]
+    assert b.maybe_extract_parsed_lines(Parser) == [b"a", b"b"]
+    assert seen == [[b"a", b"b"]]
+    assert b.maybe_extract_parsed_lines(Parser) == []
+    assert seen == [[b"a", b"b"]]
+    assert not b
+
+    # Empty block
+    b = ReceiveBuffer()
+    b += b"\r\n"
+    assert b.maybe_extract_parsed_lines(Parser) == []
+    assert not b
+
+    # Rewinding starts over
+    b = ReceiveBuffer()
+    b += b"a\r\nb\r\n"
+    mark = b.mark()
+    del seen[:]
+    assert b.maybe_extract_parsed_lines(Parser) is None
+    b.rewind(mark)
+    b += b"\r\n"
+    assert b.maybe_extract_parsed_lines(Parser) == [b"a", b"b"]
+    assert seen == [b"a", b"b", [b"a", b"b"]]
+
+    # The parser sees the length of incomplete lines
+    b = ReceiveBuffer()
+    b += b"a\r\n0123456789"
+    assert b.maybe_extract_parsed_lines(Parser) is None
+    b += b"a"
+    with pytest.raises(ValueError):
+        b.maybe_extract_parsed_lines(Parser)
+
+def test_receivebuffer_detach():
+    b = ReceiveBuffer()
+    b += b"GET / HTTP/1.1\r\n\r\ntunneled"
+    assert b.maybe_extract_lines() == [b"GET / HTTP/1.1"]
+    data = b.detach()
+    assert type(data) is memoryview
+    assert data == b"tunneled"
+    assert not b
+    b += b"more"
+    assert bytes(b) == b"more"
+    assert data == b"tunneled"
+
+def test_receivebuffer_mark_rewind():
+    b = ReceiveBuffer()
+    b += b"a: b\r\n\r\nc: d\r\n"
+    mark = b.mark()
+    assert b.maybe_extract_lines() == [b"a: b"]
+    assert b.maybe_extract_lines() is None
+    b.rewind(mark)
+    assert bytes(b) == b"a: b\r\n\r\nc: d\r\n"
+    # The failed search for the second block doesn't hide the first one
+    assert b.maybe_extract_lines() == [b"a: b"]
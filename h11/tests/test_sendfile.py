@@ -0,0 +1,27 @@
+import pytest
+
+from .._sendfile import FileSegment
+
+def test_FileSegment(tmpdir):
+    seg = FileSegment(3, 10, 20)
+    assert seg.fd == 3
+    assert seg.fileno() == 3
+    assert seg.offset == 10
+    assert seg.count == 20
+    assert len(seg) == 20
+    assert repr(seg) == "FileSegment(fd=3, offset=10, count=20)"
+    assert seg == FileSegment(3, 10, 20)
+    assert seg != FileSegment(3, 10, 21)
+    with pytest.raises(TypeError):
+        hash(seg)
+
+    with pytest.raises(ValueError):
+        FileSegment(3, -1, 20)
+    with pytest.raises(ValueError):
+        FileSegment(3, 0, -1)
+
+    # File objects are accepted too
+    path = tmpdir.join("f")
+    path.write(b"x")
+    with open(str(path), "rb") as f:
+        assert FileSegment(f, 0, 1).fd == f.fileno()